@@ -0,0 +1,80 @@
+"""Measure import-to-first-request time of the StudyGenie API.
+
+Each run starts a fresh interpreter that imports server.py, runs the app
+lifespan and serves one request in-process, so the numbers reflect what a
+new uvicorn worker (or a test process) pays before it can answer traffic.
+
+Usage (from the backend directory):
+    python benchmarks/cold_start.py --runs 5
+    python benchmarks/cold_start.py --path /api/health/ready --prewarm
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+PROBE = r"""
+import asyncio, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {backend_dir!r})
+import server
+imported = time.perf_counter()
+
+if {mongo!r} == "mock":
+    from mongomock_motor import AsyncMongoMockClient
+    server.client = AsyncMongoMockClient()
+    server.db = server.client["studygenie_benchmark"]
+
+async def first_request():
+    import httpx
+    transport = httpx.ASGITransport(app=server.app)
+    async with server.app.router.lifespan_context(server.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            while True:
+                response = await client.get({path!r})
+                if response.status_code != 503:
+                    return response.status_code
+                await asyncio.sleep(0.01)
+
+status = asyncio.run(first_request())
+done = time.perf_counter()
+print(json.dumps({{"import_s": imported - start, "first_request_s": done - start, "status": status}}))
+"""
+
+
+def run_once(args) -> dict:
+    env = dict(os.environ)
+    env.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    env.setdefault("DB_NAME", "studygenie_benchmark")
+    if args.prewarm:
+        env["PREWARM_ON_STARTUP"] = "1"
+    code = PROBE.format(backend_dir=str(BACKEND_DIR), mongo=args.mongo, path=args.path)
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=env, cwd=BACKEND_DIR,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure StudyGenie import-to-first-request time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/api/", help="endpoint used as the first request")
+    parser.add_argument("--mongo", default="mock", help='"mock" for mongomock or a MongoDB URL via MONGO_URL')
+    parser.add_argument("--prewarm", action="store_true", help="set PREWARM_ON_STARTUP=1 for the server")
+    args = parser.parse_args()
+
+    runs = [run_once(args) for _ in range(args.runs)]
+    for key in ("import_s", "first_request_s"):
+        values = [run[key] for run in runs]
+        print(f"{key:<16} median {statistics.median(values) * 1000:8.1f} ms   "
+              f"min {min(values) * 1000:8.1f} ms   max {max(values) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
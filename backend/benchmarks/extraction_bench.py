@@ -0,0 +1,123 @@
+"""Compare the PDF extraction engines on the benchmark corpus.
+
+Every engine extracts every corpus PDF through ``server.run_extraction`` (so
+the per-page timeout and process isolation are part of the measurement when
+enabled) and is scored on throughput and on text quality against the
+ground-truth ``.txt`` files written by make_corpus.py. Quality is the token
+F1 between extracted and ground-truth words, which ignores differences in
+whitespace and line breaks between engines.
+
+Usage (from the backend directory):
+    python benchmarks/extraction_bench.py
+    python benchmarks/extraction_bench.py --engines pypdf2,pypdfium2 --pdf large --isolation process
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from make_corpus import CORPUS_DIR, CORPUS_SIZES, load_corpus  # noqa: E402
+
+WORD_RE = re.compile(r"\w+")
+
+
+def token_f1(extracted: str, truth: str) -> float:
+    """F1 of the word multisets of ``extracted`` and ``truth``."""
+    got = Counter(WORD_RE.findall(extracted.lower()))
+    want = Counter(WORD_RE.findall(truth.lower()))
+    overlap = sum((got & want).values())
+    if not overlap:
+        return 0.0
+    precision = overlap / sum(got.values())
+    recall = overlap / sum(want.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def bench_engine(server, engine: str, name: str, pdf_bytes: bytes, args) -> dict:
+    truth = (CORPUS_DIR / f"{name}.txt").read_text(encoding="utf-8")
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        extracted = server.run_extraction(
+            pdf_bytes, lambda page_count, outline: range(1, page_count + 1),
+            engine=engine, isolation=args.isolation, timeout=args.timeout,
+        )
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    text = "\n".join(text for _, text in sorted(extracted["pages"].items()))
+    return {
+        "engine": engine,
+        "pdf": name,
+        "pages": extracted["page_count"],
+        "skipped": len(extracted["skipped"]),
+        "seconds": best,
+        "pages_per_second": extracted["page_count"] / best if best else 0.0,
+        "chars": len(text),
+        "truth_chars": len(truth),
+        "token_f1": token_f1(text, truth),
+    }
+
+
+def main(args) -> list:
+    import server
+
+    corpus = load_corpus()
+    results = []
+    for engine in args.engines:
+        for name in args.pdf:
+            try:
+                results.append(bench_engine(server, engine, name, corpus[name], args))
+            except ImportError as e:
+                print(f"skipping {engine}: {e}", file=sys.stderr)
+                break
+    return results
+
+
+def print_report(results: list, args):
+    print(f"isolation={args.isolation} timeout={args.timeout}s repeat={args.repeat}")
+    header = f"{'engine':<11}{'pdf':<8}{'pages':>6}{'skip':>5}{'sec':>9}{'pages/s':>10}{'chars':>9}{'F1':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['engine']:<11}{r['pdf']:<8}{r['pages']:>6}{r['skipped']:>5}{r['seconds']:>9.3f}"
+              f"{r['pages_per_second']:>10.1f}{r['chars']:>9}{r['token_f1']:>8.3f}")
+
+
+def parse_args(argv=None):
+    import server
+
+    engines = sorted(server.EXTRACTION_ENGINES)
+    parser = argparse.ArgumentParser(description="Benchmark the PDF extraction engines")
+    parser.add_argument("--engines", default=",".join(engines),
+                        type=lambda value: [e for e in value.split(",") if e],
+                        help="comma separated subset of: " + ", ".join(engines))
+    parser.add_argument("--pdf", default=",".join(CORPUS_SIZES),
+                        type=lambda value: [p for p in value.split(",") if p],
+                        help="comma separated subset of: " + ", ".join(CORPUS_SIZES))
+    parser.add_argument("--isolation", choices=["inline", "process"], default="inline",
+                        help="extract in-thread or in a killable child process")
+    parser.add_argument("--timeout", type=float, default=server.PDF_PAGE_TIMEOUT_SECONDS,
+                        help="per-page timeout (process isolation only)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per engine and PDF; the best is reported")
+    parser.add_argument("--json", type=Path, help="also write results to this file")
+    args = parser.parse_args(argv)
+    for option, known in (("engines", engines), ("pdf", CORPUS_SIZES)):
+        unknown = set(getattr(args, option)) - set(known)
+        if unknown:
+            parser.error(f"unknown {option}: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    report = main(arguments)
+    print_report(report, arguments)
+    if arguments.json:
+        arguments.json.write_text(json.dumps(report, indent=2))
@@ -0,0 +1,125 @@
+"""Local stand-in for ``emergentintegrations.llm.chat.LlmChat``.
+
+The fake mimics the subset of the LlmChat API used by server.py
+(``with_model`` and ``send_message``) and returns well-formed MCQ, flashcard,
+digest summary or chat payloads depending on the prompt. Latency is modelled
+as a time-to-first-token drawn from a configurable distribution plus
+generation time at a fixed token rate, so benchmarks exercise realistic
+concurrency without network calls or API keys.
+"""
+import asyncio
+import json
+import math
+import random
+import re
+from dataclasses import dataclass, field
+
+
+@dataclass
+class FakeLlmConfig:
+    """Latency model for the fake provider (all times in seconds)."""
+    distribution: str = "lognormal"  # fixed | uniform | exponential | lognormal
+    latency: float = 0.4             # mean time to first token
+    jitter: float = 0.5              # spread (sigma for lognormal, +/- fraction for uniform)
+    tokens_per_second: float = 80.0  # 0 disables generation time
+    seed: int = 0
+    rng: random.Random = field(default=None, repr=False)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def first_token_delay(self) -> float:
+        if self.distribution == "fixed":
+            return self.latency
+        if self.distribution == "uniform":
+            return self.rng.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter))
+        if self.distribution == "exponential":
+            return self.rng.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+        if self.distribution == "lognormal":
+            # Parameterised so that the mean of the distribution equals ``latency``
+            if self.latency <= 0:
+                return 0.0
+            mu = math.log(self.latency) - self.jitter ** 2 / 2
+            return self.rng.lognormvariate(mu, self.jitter)
+        raise ValueError(f"Unknown latency distribution: {self.distribution}")
+
+    def generation_delay(self, text: str) -> float:
+        if self.tokens_per_second <= 0:
+            return 0.0
+        return estimate_tokens(text) / self.tokens_per_second
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)."""
+    return max(1, len(text) // 4)
+
+
+class FakeUserMessage:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeLlmChat:
+    """Drop-in replacement for LlmChat that never leaves the process."""
+
+    config = FakeLlmConfig()
+    calls = 0
+    prompt_tokens = 0
+    completion_tokens = 0
+
+    def __init__(self, api_key: str, session_id: str, system_message: str = ""):
+        self.api_key = api_key
+        self.session_id = session_id
+        self.system_message = system_message
+        self.provider = None
+        self.model = None
+
+    @classmethod
+    def configure(cls, config: FakeLlmConfig):
+        cls.config = config
+        cls.calls = cls.prompt_tokens = cls.completion_tokens = 0
+
+    def with_model(self, provider: str, model: str) -> "FakeLlmChat":
+        self.provider = provider
+        self.model = model
+        return self
+
+    async def send_message(self, message) -> str:
+        text = getattr(message, "text", str(message))
+        response = self._respond(text)
+        cls = type(self)
+        cls.calls += 1
+        cls.prompt_tokens += estimate_tokens(self.system_message) + estimate_tokens(text)
+        cls.completion_tokens += estimate_tokens(response)
+        await asyncio.sleep(self.config.first_token_delay() + self.config.generation_delay(response))
+        return response
+
+    def _respond(self, prompt: str) -> str:
+        # Checked first: digest prompts quote document text, which may mention anything
+        sections = re.search(r"Summarize each of the following (\d+) sections", prompt)
+        if sections:
+            return json.dumps([
+                f"Section {i + 1} summarized by the fake LLM provider." for i in range(int(sections.group(1)))
+            ])
+        count = _requested_count(prompt)
+        if "multiple choice" in prompt:
+            return json.dumps([
+                {
+                    "question": f"Benchmark question {i + 1}?",
+                    "options": ["Option A", "Option B", "Option C", "Option D"],
+                    "correct_answer": i % 4,
+                    "explanation": "Generated by the fake LLM provider.",
+                }
+                for i in range(count)
+            ])
+        if "flashcards" in prompt:
+            return json.dumps([
+                {"front": f"Benchmark term {i + 1}", "back": "Definition from the fake LLM provider."}
+                for i in range(count)
+            ])
+        return "This is a benchmark answer based on the document. " * 4
+
+
+def _requested_count(prompt: str, default: int = 10) -> int:
+    match = re.search(r"create (\d+)", prompt)
+    return int(match.group(1)) if match else default
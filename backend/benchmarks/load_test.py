@@ -0,0 +1,202 @@
+"""Offline load test for the StudyGenie API.
+
+Runs the FastAPI app in-process (no uvicorn, no network) against the fake LLM
+provider and either mongomock or a local MongoDB, drives the upload, chat and
+list endpoints at a fixed concurrency and reports latency percentiles,
+throughput and peak RSS.
+
+Every upload sends a different PDF of the chosen size, so uploads go through
+extraction and generation; ``--duplicate-uploads`` sends the same PDF every
+time, which measures the near-duplicate shortcut instead.
+
+Usage (from the backend directory):
+    python benchmarks/load_test.py --scenarios upload,chat,list --concurrency 16
+    python benchmarks/load_test.py --mongo mongodb://localhost:27017 --pdf large
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_llm import FakeLlmChat, FakeLlmConfig, FakeUserMessage  # noqa: E402
+from make_corpus import CORPUS_SIZES, build_variant, load_corpus  # noqa: E402
+
+BENCH_DB_NAME = "studygenie_benchmark"
+SCENARIOS = ("upload", "chat", "list")
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, round(pct / 100 * len(samples) + 0.5) - 1))
+    return samples[rank]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_server(mongo: str, verbose: bool = False):
+    """Import server.py with the fake LLM provider and the chosen database."""
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", BENCH_DB_NAME)
+    os.environ.setdefault("EMERGENT_LLM_KEY", "benchmark-key")
+
+    import server
+
+    if not verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    server.LlmChat = FakeLlmChat
+    server.UserMessage = FakeUserMessage
+
+    if mongo == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+        server.client = AsyncMongoMockClient()
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        server.client = AsyncIOMotorClient(mongo)
+    server.db = server.client[BENCH_DB_NAME]
+    return server
+
+
+async def run_scenario(client, name: str, total: int, concurrency: int, make_request) -> dict:
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await make_request(client, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def main(args) -> list:
+    import httpx
+
+    FakeLlmChat.configure(FakeLlmConfig(
+        distribution=args.distribution,
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.token_rate,
+        seed=args.seed,
+    ))
+    server = load_server(args.mongo, args.verbose)
+    pdf_bytes = load_corpus()[args.pdf]
+    filename = f"{args.pdf}.pdf"
+    # Built up front so generating them is not part of the measurement
+    variants = [] if args.duplicate_uploads or "upload" not in args.scenarios else [
+        build_variant(args.pdf, i) for i in range(args.requests)
+    ]
+
+    async def upload(client, i):
+        content = variants[i] if variants and i >= 0 else pdf_bytes
+        files = {"file": (filename, content, "application/pdf")}
+        return await client.post("/api/upload", files=files)
+
+    transport = httpx.ASGITransport(app=server.app)
+    results = []
+    async with server.app.router.lifespan_context(server.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            # Seed one document so chat and list have something to work on
+            seed = await upload(client, -1)
+            seed.raise_for_status()
+            document_id = seed.json()["document_id"]
+
+            async def chat(client, i):
+                payload = {"document_id": document_id, "message": f"Explain concept number {i}"}
+                return await client.post("/api/chat", json=payload)
+
+            async def list_documents(client, i):
+                return await client.get("/api/documents")
+
+            handlers = {"upload": upload, "chat": chat, "list": list_documents}
+            for name in args.scenarios:
+                results.append(await run_scenario(client, name, args.requests, args.concurrency, handlers[name]))
+
+        if args.mongo != "mock":
+            await server.client.drop_database(BENCH_DB_NAME)
+    return results
+
+
+def print_report(results: list, args):
+    print(f"LLM: {args.distribution} latency={args.latency}s jitter={args.jitter} "
+          f"token_rate={args.token_rate}/s | mongo={args.mongo} | pdf={args.pdf}"
+          f"{' (duplicate uploads)' if args.duplicate_uploads else ''}")
+    print(f"LLM calls: {FakeLlmChat.calls}, prompt tokens: {FakeLlmChat.prompt_tokens}, "
+          f"completion tokens: {FakeLlmChat.completion_tokens}")
+    header = f"{'scenario':<10}{'reqs':>7}{'conc':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'RSS MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<10}{r['requests']:>7}{r['concurrency']:>6}{r['errors']:>5}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['throughput_rps']:>10.1f}{r['peak_rss_mb']:>9.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline StudyGenie load test")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [s for s in value.split(",") if s],
+                        help="comma separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--pdf", choices=sorted(CORPUS_SIZES), default="medium")
+    parser.add_argument("--duplicate-uploads", action="store_true",
+                        help="upload the identical PDF every time (measures near-duplicate reuse)")
+    parser.add_argument("--mongo", default="mock", help='"mock" for mongomock or a MongoDB URL')
+    parser.add_argument("--distribution", default="lognormal",
+                        choices=["fixed", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--latency", type=float, default=0.4, help="mean LLM time to first token (s)")
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--token-rate", type=float, default=80.0, help="LLM tokens per second")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="also write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's INFO logging")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    report = asyncio.run(main(arguments))
+    print_report(report, arguments)
+    if arguments.json:
+        arguments.json.write_text(json.dumps(report, indent=2))
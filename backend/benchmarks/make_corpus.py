@@ -0,0 +1,150 @@
+"""Generate the PDF corpus used by the StudyGenie benchmarks.
+
+The PDFs are written by hand (no reportlab dependency) and are fully
+deterministic, so benchmark runs on different machines see the same input.
+A ground-truth ``.txt`` file is written next to every PDF so extraction
+quality can be compared against the text that was actually put on the page.
+
+Usage:
+    python benchmarks/make_corpus.py [--out benchmarks/corpus]
+"""
+import argparse
+import random
+import textwrap
+from pathlib import Path
+
+CORPUS_DIR = Path(__file__).parent / "corpus"
+
+# name -> number of pages
+CORPUS_SIZES = {
+    "small": 1,
+    "medium": 10,
+    "large": 50,
+    "xlarge": 200,
+}
+
+LINES_PER_PAGE = 40
+CHARS_PER_LINE = 90
+PAGES_PER_CHAPTER = 10
+
+TOPICS = [
+    "photosynthesis", "cellular respiration", "mitochondria", "chlorophyll",
+    "gradient descent", "neural networks", "backpropagation", "overfitting",
+    "supply and demand", "inflation", "monetary policy", "elasticity",
+    "thermodynamics", "entropy", "kinetic energy", "momentum",
+    "the french revolution", "industrialization", "the cold war", "colonialism",
+]
+
+VERBS = [
+    "describes", "explains", "depends on", "is influenced by", "determines",
+    "is measured by", "contrasts with", "builds upon", "limits", "enables",
+]
+
+QUALIFIERS = [
+    "in most practical settings", "under controlled conditions",
+    "according to the standard model", "when other factors are held constant",
+    "as discussed in the previous section", "for introductory courses",
+]
+
+
+def _sentence(rng: random.Random) -> str:
+    subject, obj = rng.sample(TOPICS, 2)
+    return f"{subject.capitalize()} {rng.choice(VERBS)} {obj} {rng.choice(QUALIFIERS)}."
+
+
+def page_lines(rng: random.Random, page_number: int) -> list:
+    """Return the text lines for a single page."""
+    lines = []
+    if page_number % PAGES_PER_CHAPTER == 0:
+        chapter = page_number // PAGES_PER_CHAPTER + 1
+        lines.append(f"Chapter {chapter}: {rng.choice(TOPICS).title()}")
+        lines.append("")
+    paragraph = " ".join(_sentence(rng) for _ in range(LINES_PER_PAGE))
+    lines.extend(textwrap.wrap(paragraph, CHARS_PER_LINE))
+    return lines[:LINES_PER_PAGE]
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def build_pdf(pages: list) -> bytes:
+    """Serialize a list of pages (each a list of lines) into a PDF document."""
+    objects = []
+
+    def add(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog_id = add(b"")  # placeholder, filled in once the page tree exists
+    pages_id = add(b"")
+    font_id = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    page_ids = []
+    for lines in pages:
+        stream = ["BT", "/F1 10 Tf", "12 TL", "50 760 Td"]
+        for line in lines:
+            stream.append(f"({_escape(line)}) Tj T*")
+        stream.append("ET")
+        data = "\n".join(stream).encode("latin-1")
+        content_id = add(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(data), data))
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>"
+            % (pages_id, font_id, content_id)
+        ))
+
+    kids = b" ".join(b"%d 0 R" % pid for pid in page_ids)
+    objects[pages_id - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+    objects[catalog_id - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref_offset = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, catalog_id, xref_offset
+    )
+    return bytes(out)
+
+
+def generate_corpus(out_dir: Path = CORPUS_DIR) -> list:
+    """Write every corpus PDF (and its ground truth) and return the PDF paths."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, page_count in CORPUS_SIZES.items():
+        rng = random.Random(f"studygenie-{name}")
+        pages = [page_lines(rng, number) for number in range(page_count)]
+        pdf_path = out_dir / f"{name}.pdf"
+        pdf_path.write_bytes(build_pdf(pages))
+        (out_dir / f"{name}.txt").write_text(
+            "\n".join("\n".join(lines) for lines in pages), encoding="utf-8"
+        )
+        paths.append(pdf_path)
+    return paths
+
+
+def build_variant(name: str, variant: int) -> bytes:
+    """A PDF with the page count of corpus PDF ``name`` but different text, for upload runs that must not deduplicate."""
+    rng = random.Random(f"studygenie-{name}-variant-{variant}")
+    return build_pdf([page_lines(rng, number) for number in range(CORPUS_SIZES[name])])
+
+
+def load_corpus(out_dir: Path = CORPUS_DIR) -> dict:
+    """Return ``{name: pdf_bytes}``, generating the corpus if it is missing."""
+    if not all((out_dir / f"{name}.pdf").exists() for name in CORPUS_SIZES):
+        generate_corpus(out_dir)
+    return {name: (out_dir / f"{name}.pdf").read_bytes() for name in CORPUS_SIZES}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", type=Path, default=CORPUS_DIR)
+    args = parser.parse_args()
+    for path in generate_corpus(args.out):
+        print(f"{path} ({path.stat().st_size // 1024} KiB)")
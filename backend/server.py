@@ -1,45 +1,172 @@
-from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, BackgroundTasks, File, Form, Header, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from bson import json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Literal, AsyncIterator
 import uuid
-from datetime import datetime, timezone
-import PyPDF2
+from datetime import datetime, timezone, timedelta
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import io
 import json
 import re
-from emergentintegrations.llm.chat import LlmChat, UserMessage
+import hashlib
+import html
+import math
+from collections import Counter, OrderedDict
+import orjson
+import zlib
+import asyncio
+import multiprocessing
+import threading
+import sqlite3
+import socket
+import sys
+import tempfile
+import time
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Heavy dependencies are imported on first use (see load_pypdf2 / load_llm_client)
+# so importing this module and starting a worker stays fast
+PyPDF2 = None
+np = None
+pd = None
+LlmChat = None
+UserMessage = None
+
+# MongoDB connection, opened in the app lifespan (see connect_database)
+client = None
+db = None
+
+# Set PREWARM_ON_STARTUP=1 to import heavy dependencies in the background during
+# startup; readiness then waits for it so autoscaled instances take traffic warm
+PREWARM_ON_STARTUP = os.environ.get('PREWARM_ON_STARTUP', '').lower() in ('1', 'true', 'yes')
+
+# Warm-up progress reported by /api/health/ready
+warmup_state: Dict[str, str] = {"database": "pending", "dependencies": "cold"}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    connect_database()
+    UPLOAD_DIR.mkdir(exist_ok=True)
+    background = [asyncio.create_task(warm_up())]
+    # Write buffers are stopped rather than cancelled, so no batch is left half written
+    stopping = asyncio.Event()
+    writers = [asyncio.create_task(buffer.run(stopping)) for buffer in WRITE_BUFFERS]
+    if DOCUMENT_ARCHIVE_DAYS > 0:
+        background.append(asyncio.create_task(retention_loop()))
+    try:
+        yield
+    finally:
+        for task in background:
+            task.cancel()
+        stopping.set()
+        await asyncio.gather(*writers, return_exceptions=True)
+        for buffer in WRITE_BUFFERS:
+            await buffer.close()
+        stop_extraction_workers()
+        client.close()
 
 # Create the main app without a prefix
-app = FastAPI(title="StudyGenie API", description="AI-powered study guide generator")
+app = FastAPI(
+    title="StudyGenie API",
+    description="AI-powered study guide generator",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-# Ensure uploads directory exists
+# Generation prompts see at most this many characters; documents are split into
+# chunks of this size so later "generate more" calls can target uncovered parts
+GENERATION_CHUNK_CHARS = 3000
+
+# Retention (0 disables the corresponding policy)
+CHAT_RETENTION_DAYS = int(os.environ.get('CHAT_RETENTION_DAYS', '0'))
+DOCUMENT_ARCHIVE_DAYS = int(os.environ.get('DOCUMENT_ARCHIVE_DAYS', '0'))
+RETENTION_INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', '3600'))
+# Access times are written at most this often per document and worker, which
+# remembers that for up to this many documents (or user/document pairs)
+ACCESS_TOUCH_INTERVAL = timedelta(hours=1)
+ACCESS_TOUCH_MAX_ENTRIES = 10000
+
+# Reviews are per user; requests without an X-User-Id header share this one
+DEFAULT_USER_ID = "anonymous"
+
+# Quiz attempts and chat messages are written behind in batches of up to this
+# many, at least every interval; batches the database rejects are spilled here
+QUIZ_BUFFER_SIZE = int(os.environ.get('QUIZ_BUFFER_SIZE', '500'))
+QUIZ_FLUSH_INTERVAL_SECONDS = float(os.environ.get('QUIZ_FLUSH_INTERVAL_SECONDS', '1'))
+CHAT_BUFFER_SIZE = int(os.environ.get('CHAT_BUFFER_SIZE', '200'))
+CHAT_FLUSH_INTERVAL_SECONDS = float(os.environ.get('CHAT_FLUSH_INTERVAL_SECONDS', '0.5'))
+WRITE_SPILL_DIR = Path(os.environ.get('WRITE_SPILL_DIR', str(ROOT_DIR / "spill")))
+# Questions are only flagged once they have this many responses
+QUIZ_MIN_RESPONSES = int(os.environ.get('QUIZ_MIN_RESPONSES', '20'))
+
+# LLM usage: rollups are kept this long (0 = forever); token budgets per document (lifetime)
+# and per UTC day across all documents, 0 = unlimited; prices per million tokens
+LLM_USAGE_RETENTION_DAYS = int(os.environ.get('LLM_USAGE_RETENTION_DAYS', '90'))
+LLM_DOCUMENT_TOKEN_BUDGET = int(os.environ.get('LLM_DOCUMENT_TOKEN_BUDGET', '0'))
+LLM_DAILY_TOKEN_BUDGET = int(os.environ.get('LLM_DAILY_TOKEN_BUDGET', '0'))
+LLM_PROMPT_COST_PER_MTOK = float(os.environ.get('LLM_PROMPT_COST_PER_MTOK', '0.15'))
+LLM_COMPLETION_COST_PER_MTOK = float(os.environ.get('LLM_COMPLETION_COST_PER_MTOK', '0.60'))
+# Usage rollups and token counters are written behind at least every interval,
+# so other workers see this worker's tokens against the budgets that much later
+LLM_USAGE_BUFFER_SIZE = int(os.environ.get('LLM_USAGE_BUFFER_SIZE', '500'))
+LLM_USAGE_FLUSH_INTERVAL_SECONDS = float(os.environ.get('LLM_USAGE_FLUSH_INTERVAL_SECONDS', '1'))
+
+# Document digests: outline size, key terms per entry, summary length, the
+# token budget of the rendered chat prompt, and the excerpts sent with each
+# chat message in place of the raw document text
+DIGEST_MAX_SECTIONS = 12
+DIGEST_KEY_TERMS = 8
+DIGEST_SUMMARY_CHARS = 240
+DIGEST_PREFIX_TOKENS = 600
+CHAT_EXCERPTS = 3
+CHAT_EXCERPT_CHARS = 500
+
+# PDF extraction: backend (pypdf2 | pypdfium2 | pdfminer), whether pages are
+# extracted in a child process that can be killed ("process") or in-thread
+# ("inline", no timeout), and how long a single page may take
+PDF_EXTRACTION_ENGINE = os.environ.get('PDF_EXTRACTION_ENGINE', 'pypdf2').lower()
+PDF_EXTRACTION_ISOLATION = os.environ.get('PDF_EXTRACTION_ISOLATION', 'process').lower()
+PDF_PAGE_TIMEOUT_SECONDS = float(os.environ.get('PDF_PAGE_TIMEOUT_SECONDS', '10'))
+# Extraction processes per API worker; further uploads wait for a free one
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', '2'))
+
+# Uploads directory, created on startup
 UPLOAD_DIR = ROOT_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
 
 # Models
+class DocumentSection(BaseModel):
+    title: str
+    start_page: int  # 1-based, inclusive
+    end_page: int    # 1-based, inclusive
+
 class Document(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     filename: str
     content: str
+    page_count: int = 0
+    extracted_pages: List[int] = []
+    sections: List[DocumentSection] = []
+    skipped_pages: List[int] = []  # pages whose extraction failed or timed out
+    minhash: Optional[List[int]] = None  # only for whole-document uploads
+    lsh_bands: List[str] = []
     upload_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_accessed: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class MCQuestion(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -58,8 +185,16 @@ class StudyMaterial(BaseModel):
     document_id: str
     mcqs: List[MCQuestion]
     flashcards: List[Flashcard]
+    pages: Optional[List[int]] = None  # None means the whole document
+    chunk_count: int = 1
+    coverage: Dict[str, List[int]] = Field(default_factory=lambda: {"mcqs": [0], "flashcards": [0]})
+    reused_from: Optional[str] = None  # near-duplicate document the materials were copied from
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class MoreMaterialsRequest(BaseModel):
+    kind: Literal["mcqs", "flashcards"] = "mcqs"
+    count: int = Field(5, ge=1, le=20)
+
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     document_id: str
@@ -70,46 +205,1991 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     document_id: str
     message: str
+    pages: Optional[str] = None    # e.g. "12-30,41"
+    section: Optional[str] = None  # section title or 1-based section number
 
 class ChatResponse(BaseModel):
     response: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+class FlashcardReview(BaseModel):
+    """SM-2 review state of one flashcard for one user; card text is copied so the due queue needs no join"""
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    card_id: str
+    document_id: str
+    front: str
+    back: str
+    easiness: float = 2.5
+    interval: int = 0  # days
+    repetitions: int = 0
+    due_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_reviewed: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class ReviewRequest(BaseModel):
+    quality: int = Field(..., ge=0, le=5)  # 0 = no recall ... 5 = perfect recall
+
+class QuizAnswer(BaseModel):
+    question_id: str
+    selected: int = Field(..., ge=0)
+
+class QuizAttemptRequest(BaseModel):
+    answers: List[QuizAnswer] = Field(..., min_length=1, max_length=500)
+
+class QuizAttempt(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    document_id: str
+    user_id: str
+    answers: List[dict]  # {question_id, selected, correct}
+    score: int
+    submitted_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+# Startup and lazy loading
+def connect_database():
+    """Open the MongoDB client unless one was already configured (e.g. by the benchmarks)"""
+    global client, db
+    if db is not None:
+        return
+    # tz_aware so datetimes read back from BSON are UTC-aware like the ones we store
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], tz_aware=True)
+    db = client[os.environ['DB_NAME']]
+
+def load_pypdf2():
+    global PyPDF2
+    if PyPDF2 is None:
+        import PyPDF2 as module
+        PyPDF2 = module
+    return PyPDF2
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy as module
+        np = module
+    return np
+
+def load_pandas():
+    global pd
+    if pd is None:
+        import pandas as module
+        pd = module
+    return pd
+
+def load_llm_client():
+    """Import the LLM integration on first use; it pulls in litellm, which takes seconds to import"""
+    global LlmChat, UserMessage
+    if LlmChat is None or UserMessage is None:
+        from emergentintegrations.llm.chat import LlmChat as chat_class, UserMessage as message_class
+        LlmChat, UserMessage = chat_class, message_class
+    return LlmChat, UserMessage
+
+def prewarm():
+    """Import all lazily loaded dependencies (blocking)"""
+    warmup_state["dependencies"] = "warming"
+    load_pypdf2()
+    load_numpy()
+    load_pandas()
+    load_llm_client()
+    warmup_state["dependencies"] = "warm"
+
+async def warm_up():
+    """Create indexes and optionally pre-warm dependencies without blocking startup"""
+    try:
+        await create_indexes()
+        warmup_state["database"] = "ready"
+    except Exception as e:
+        warmup_state["database"] = "error"
+        logging.error(f"Error preparing database: {str(e)}")
+    if PREWARM_ON_STARTUP:
+        try:
+            await asyncio.to_thread(prewarm)
+        except Exception as e:
+            warmup_state["dependencies"] = "error"
+            logging.error(f"Error pre-warming dependencies: {str(e)}")
+
+async def create_indexes():
+    await db.document_pages.create_index([("document_id", 1), ("page", 1)], unique=True)
+    await db.documents.create_index("last_accessed")
+    await db.documents.create_index("lsh_bands")
+    await db.archived_documents.create_index("document_id", unique=True)
+    await db.shared_state.create_index("expires_at", expireAfterSeconds=0)
+    await db.search_postings.create_index([("term", 1), ("impact", -1)])
+    # Also serves chat excerpts: a document's postings for the question terms
+    await db.search_postings.create_index([("document_id", 1), ("term", 1)])
+    await db.search_units.create_index("document_id")
+    await db.study_materials.create_index("flashcards.id")
+    await db.flashcard_reviews.create_index([("user_id", 1), ("card_id", 1)], unique=True)
+    await db.flashcard_reviews.create_index([("user_id", 1), ("due_at", 1)])
+    await db.flashcard_reviews.create_index([("user_id", 1), ("document_id", 1), ("due_at", 1)])
+    await db.flashcard_reviews.create_index("document_id")
+    await db.quiz_attempts.create_index("document_id")
+    await db.document_digests.create_index("document_id", unique=True)
+    # Keys that imports upsert on
+    await db.documents.create_index("id")
+    await db.study_materials.create_index("document_id")
+    await db.chat_messages.create_index("id")
+    await db.quiz_attempts.create_index("id")
+    await db.llm_usage.create_index([("document_id", 1), ("minute", 1)])
+    await ensure_ttl_index("chat_messages", "timestamp", "chat_messages_ttl", CHAT_RETENTION_DAYS)
+    # Keeps the default name it was first created with
+    await ensure_ttl_index("llm_usage", "minute", "minute_1", LLM_USAGE_RETENTION_DAYS)
+
+# Shared state
+class LocalStateTier:
+    """Node-local state tier in a SQLite file on tmpfs, shared by all workers on the machine.
+
+    Values are kept for at most ``ttl`` seconds, so other nodes' writes to the
+    Mongo-backed state become visible here within that window. Calls block the
+    event loop, so a busy database file fails fast (sqlite3.OperationalError)
+    and SharedState falls back to Mongo instead of waiting.
+    """
+
+    def __init__(self, path: str, ttl: float = 1.0):
+        self.path = path
+        self.ttl = ttl
+        self._connection = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=0.05, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+            self._connection = connection
+        return self._connection
+
+    def get(self, key: str) -> tuple:
+        """Return (found, value); a cached None is a hit"""
+        row = self.connection.execute("SELECT value, expires FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, orjson.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+            (key, orjson.dumps(value), time.time() + self.ttl)
+        )
+
+    def delete(self, key: str):
+        self.connection.execute("DELETE FROM state WHERE key = ?", (key,))
+
+class SharedState:
+    """Small key/value state shared across workers and nodes (cache versions, locks, counters).
+
+    MongoDB's shared_state collection is the source of truth; expired entries
+    are removed by a TTL index. With a LocalStateTier, reads are served from
+    the node-local tier when fresh and writes go through to both.
+    """
+
+    def __init__(self, local: Optional[LocalStateTier] = None):
+        self.local = local
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    @staticmethod
+    def _expiry(ttl: Optional[float]) -> Optional[datetime]:
+        return datetime.now(timezone.utc) + timedelta(seconds=ttl) if ttl else None
+
+    def _local(self, operation: str, *args) -> Any:
+        """Run a local tier call; a locked or unusable SQLite file counts as a miss"""
+        try:
+            return getattr(self.local, operation)(*args)
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Local state tier unavailable, using MongoDB: {str(e)}")
+            return (False, None) if operation == "get" else None
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        if self.local:
+            found, value = self._local("get", key)
+            if found:
+                return default if value is None else value
+        record = await db.shared_state.find_one({
+            "_id": key,
+            "$or": [{"expires_at": None}, {"expires_at": {"$gt": datetime.now(timezone.utc)}}]
+        })
+        value = record["value"] if record else None
+        if self.local:
+            self._local("set", key, value)
+        return default if value is None else value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        await db.shared_state.update_one(
+            {"_id": key},
+            {"$set": {"value": value, "expires_at": self._expiry(ttl)}},
+            upsert=True
+        )
+        if self.local:
+            self._local("set", key, value)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Atomically add to a counter. For windowed rate limits put the window in the key."""
+        record = await db.shared_state.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"value": amount}, "$setOnInsert": {"expires_at": self._expiry(ttl)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if self.local:
+            self._local("set", key, record["value"])
+        return record["value"]
+
+    async def delete(self, key: str):
+        await db.shared_state.delete_one({"_id": key})
+        if self.local:
+            self._local("delete", key)
+
+    async def incr_many(self, keys: list, amount: int = 1):
+        """Add to many counters in one round-trip; the new values are not returned"""
+        if not keys:
+            return
+        await db.shared_state.bulk_write(
+            [UpdateOne({"_id": key}, {"$inc": {"value": amount}, "$setOnInsert": {"expires_at": None}}, upsert=True) for key in keys],
+            ordered=False
+        )
+        if self.local:
+            # Dropped rather than set, so the next read picks up the new value from MongoDB
+            for key in keys:
+                self._local("delete", key)
+
+    async def delete_many(self, keys: list):
+        if not keys:
+            return
+        await db.shared_state.delete_many({"_id": {"$in": keys}})
+        if self.local:
+            for key in keys:
+                self._local("delete", key)
+
+    async def try_lock(self, key: str, ttl: float, owner: Optional[str] = None) -> bool:
+        """Take a cluster-wide lease on ``key`` for ``ttl`` seconds unless someone else holds it.
+
+        The lease is re-entrant for its ``owner``, this worker by default; pass
+        a token of your own to keep holders within one worker apart.
+        """
+        owner = owner or self.owner
+        now = datetime.now(timezone.utc)
+        try:
+            await db.shared_state.update_one(
+                {"_id": key, "$or": [{"expires_at": {"$lt": now}}, {"value": owner}]},
+                {"$set": {"value": owner, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def unlock(self, key: str, owner: Optional[str] = None):
+        """Release a lease unless it expired and someone else has taken it since"""
+        await db.shared_state.delete_one({"_id": key, "value": owner or self.owner})
+
+def create_shared_state() -> SharedState:
+    path = os.environ.get('SHARED_STATE_LOCAL_PATH')
+    if not path:
+        return SharedState()
+    return SharedState(LocalStateTier(path, float(os.environ.get('SHARED_STATE_LOCAL_TTL', '1.0'))))
+
+shared_state = create_shared_state()
+
+# Response caching
+class ResponseCache:
+    """Small per-worker LRU of serialized GET responses and their ETags.
+
+    Each key has a version counter in the shared state. Write paths bump it,
+    which invalidates the entry in every worker; an entry is only served while
+    the version it was built from is current, so a read that raced with a
+    write cannot keep serving the stale payload it loaded.
+
+    Without a node-local state tier, versions read from Mongo are reused for
+    ``version_ttl`` seconds, so other workers' writes show up within that
+    window and a cache hit (or 304) usually needs no database round-trip.
+    """
+
+    def __init__(self, max_entries: int = 512, version_ttl: float = 1.0):
+        self.max_entries = max_entries
+        self.version_ttl = version_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._versions: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def generation(self, key: str) -> int:
+        if shared_state.local or self.version_ttl <= 0:
+            # The local tier already caches versions for its own TTL
+            return await shared_state.get(f"cache-version:{key}", 0)
+        cached = self._versions.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return self._remember_version(key, await shared_state.get(f"cache-version:{key}", 0))
+
+    def _remember_version(self, key: str, generation: int) -> int:
+        self._versions[key] = (generation, time.monotonic() + self.version_ttl)
+        self._versions.move_to_end(key)
+        while len(self._versions) > self.max_entries:
+            self._versions.popitem(last=False)
+        return generation
+
+    async def get(self, key: str) -> tuple:
+        """Return (generation, entry); entry is None on a miss"""
+        generation = await self.generation(key)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != generation:
+            return generation, None
+        self._entries.move_to_end(key)
+        return generation, entry[1:]
+
+    def set(self, key: str, generation: int, etag: str, body: bytes) -> tuple:
+        self._entries[key] = (generation, etag, body)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return etag, body
+
+    def discard(self, key: str):
+        """Drop this worker's entry only; other workers keep theirs until the version is bumped"""
+        self._entries.pop(key, None)
+
+    async def invalidate(self, *keys: str):
+        for key in keys:
+            self._entries.pop(key, None)
+            generation = await shared_state.incr(f"cache-version:{key}")
+            if key in self._versions:
+                self._remember_version(key, generation)
+
+    async def invalidate_many(self, keys: list):
+        """Like invalidate, but one bulk version bump for all keys; for write paths touching many documents"""
+        for key in keys:
+            self._entries.pop(key, None)
+            self._versions.pop(key, None)
+        await shared_state.incr_many([f"cache-version:{key}" for key in keys])
+
+response_cache = ResponseCache(
+    int(os.environ.get('RESPONSE_CACHE_SIZE', '512')),
+    float(os.environ.get('RESPONSE_CACHE_VERSION_TTL', '1.0'))
+)
+
+class BulkWriteBuffer:
+    """Write-behind buffer for inserts into one collection, written with insert_many.
+
+    A batch is written once ``max_size`` documents are pending, otherwise by
+    ``run()`` every ``interval`` seconds, and finally by ``close()`` on
+    shutdown. ``on_flush`` is awaited with each written batch.
+
+    With a ``spill_dir``, a batch that cannot be written is appended to a
+    per-process JSONL file instead of being held in memory, and ``run()``
+    writes spilled batches back once the database accepts writes again,
+    including those left behind by processes that have since exited.
+    ``prune``, if given, is awaited with every batch right before it is
+    written and returns the documents that should still be written.
+    """
+
+    def __init__(self, collection: str, max_size: int = 500, interval: float = 1.0,
+                 on_flush=None, spill_dir: Optional[Path] = None, prune=None):
+        self.collection = collection
+        self.max_size = max_size
+        self.interval = interval
+        self.on_flush = on_flush
+        self.spill_dir = spill_dir
+        self.prune = prune
+        self.pending: List[dict] = []
+        self.writing: List[dict] = []
+        self.spilled: List[dict] = []
+        self._lock = asyncio.Lock()
+
+    async def add(self, document: dict):
+        self.pending.append(document)
+        if len(self.pending) >= self.max_size:
+            await self.flush()
+
+    def buffered(self, predicate) -> List[dict]:
+        """Documents accepted by this process but not yet written that match ``predicate``"""
+        return [document for document in self.spilled + self.writing + self.pending if predicate(document)]
+
+    def discard(self, predicate) -> int:
+        """Drop pending documents that match ``predicate``, e.g. for a deleted document.
+
+        Documents already being written or spilled cannot be taken back; see ``prune``.
+        """
+        count = len(self.pending)
+        self.pending = [document for document in self.pending if not predicate(document)]
+        self.spilled = [document for document in self.spilled if not predicate(document)]
+        return count - len(self.pending)
+
+    async def wait_for_writes(self):
+        """Wait until the batch being written, if any, is in the database (or spilled)"""
+        async with self._lock:
+            pass
+
+    async def _insert(self, batch: List[dict]):
+        if self.prune:
+            batch = await self.prune(batch)
+            if not batch:
+                return
+        try:
+            await db[self.collection].insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Documents that made it in on an earlier, partly failed attempt are duplicates now
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, []
+            self.writing = batch
+            try:
+                await self._insert(batch)
+            except BaseException as e:
+                # Cancelled, or nowhere to spill to: the batch is written with the next flush
+                if not self.spill_dir or not isinstance(e, Exception):
+                    self.pending[:0] = batch
+                    raise
+                await asyncio.to_thread(self._spill, batch)
+                self.spilled += batch
+                logging.error(f"Spilled {len(batch)} buffered {self.collection} to disk: {str(e)}")
+                return 0
+            finally:
+                self.writing = []
+        if self.on_flush:
+            await self.on_flush(batch)
+        return len(batch)
+
+    def _spill(self, batch: List[dict]):
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        path = self.spill_dir / f"{self.collection}-{os.getpid()}.jsonl"
+        with open(path, "a", encoding="utf-8") as spill:
+            # Extended JSON keeps datetimes and the _ids assigned by an earlier attempt
+            spill.write("".join(json_util.dumps(document) + "\n" for document in batch))
+            spill.flush()
+            os.fsync(spill.fileno())
+
+    def _spill_files(self) -> List[Path]:
+        """Spill files of this process and of processes that no longer exist"""
+        if not self.spill_dir or not self.spill_dir.exists():
+            return []
+        files = []
+        for path in sorted(self.spill_dir.glob(f"{self.collection}-*.jsonl")):
+            pid = int(path.stem.rsplit("-", 1)[1])
+            if pid != os.getpid():
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            files.append(path)
+        return files
+
+    @staticmethod
+    def _read_spill(path: Path) -> List[dict]:
+        documents = []
+        for line in path.read_text(encoding="utf-8").splitlines():
+            try:
+                documents.append(json_util.loads(line))
+            except ValueError:
+                logging.warning(f"Skipping unreadable line in {path.name}")
+        return documents
+
+    async def replay_spilled(self) -> int:
+        """Write spilled batches back to the database"""
+        replayed = 0
+        async with self._lock:
+            for path in self._spill_files():
+                claimed = path.with_name(f"{path.name}.replay-{os.getpid()}")
+                path.rename(claimed)
+                try:
+                    documents = await asyncio.to_thread(self._read_spill, claimed)
+                    for start in range(0, len(documents), self.max_size):
+                        await self._insert(documents[start:start + self.max_size])
+                except BaseException:
+                    # Replayed whole next time; documents written already are skipped as duplicates.
+                    # Nothing else writes to the file meanwhile: spilling also holds the lock.
+                    claimed.rename(path)
+                    raise
+                claimed.unlink()
+                replayed += len(documents)
+                if self.on_flush:
+                    await self.on_flush(documents)
+            if replayed:
+                self.spilled = []
+                logger.info(f"Wrote {replayed} spilled {self.collection} back to the database")
+        return replayed
+
+    async def run(self, stopping: Optional[asyncio.Event] = None):
+        """Write batches every ``interval`` seconds until ``stopping`` is set"""
+        stopping = stopping or asyncio.Event()
+        while not stopping.is_set():
+            try:
+                await self.flush()
+                await self.replay_spilled()
+            except Exception as e:
+                logging.error(f"Error writing buffered {self.collection}: {str(e)}")
+            try:
+                await asyncio.wait_for(stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Lost {len(self.pending)} buffered {self.collection} on shutdown: {str(e)}")
+
+class RollupBuffer:
+    """Write-behind buffer for counter rollups, merged in process and written as batched ``$inc`` upserts.
+
+    ``add`` folds an event into the pending rollup with the same key, so a
+    busy key costs one upsert per flush rather than one per event, and
+    ``count`` does the same for shared_state counters. Both are written once
+    ``max_size`` rollups are pending, otherwise by ``run()`` every
+    ``interval`` seconds, and finally by ``close()`` on shutdown. Whatever
+    cannot be written stays pending and is merged with later events.
+    """
+
+    def __init__(self, collection: str, max_size: int = 500, interval: float = 1.0):
+        self.collection = collection
+        self.max_size = max_size
+        self.interval = interval
+        self.pending: Dict[tuple, dict] = {}
+        self.counters: Dict[str, list] = {}
+        self.writing_counters: Dict[str, list] = {}
+        self._lock = asyncio.Lock()
+
+    async def add(self, key: dict, increments: Dict[str, float], maximums: Optional[Dict[str, float]] = None,
+                  on_insert: Optional[dict] = None):
+        rollup = self.pending.get(tuple(key.items()))
+        if rollup is None:
+            rollup = self.pending[tuple(key.items())] = {"key": key, "$inc": {}, "$max": {}, "$setOnInsert": on_insert or {}}
+        for field, amount in increments.items():
+            rollup["$inc"][field] = rollup["$inc"].get(field, 0) + amount
+        for field, value in (maximums or {}).items():
+            rollup["$max"][field] = max(rollup["$max"].get(field, value), value)
+        if len(self.pending) >= self.max_size:
+            await self.flush()
+
+    def count(self, key: str, amount: int, ttl: Optional[float] = None):
+        """Add to a shared_state counter on the next flush"""
+        counter = self.counters.setdefault(key, [0, ttl])
+        counter[0] += amount
+
+    def unwritten(self, key: str) -> int:
+        """Amount added to a counter by this process that shared_state does not have yet"""
+        return sum(counters[key][0] for counters in (self.counters, self.writing_counters) if key in counters)
+
+    def discard_counter(self, key: str):
+        self.counters.pop(key, None)
+        self.writing_counters.pop(key, None)
+
+    def _merge(self, rollups: List[dict]):
+        for rollup in rollups:
+            pending = self.pending.setdefault(tuple(rollup["key"].items()), rollup)
+            if pending is not rollup:
+                for field, amount in rollup["$inc"].items():
+                    pending["$inc"][field] = pending["$inc"].get(field, 0) + amount
+                for field, value in rollup["$max"].items():
+                    pending["$max"][field] = max(pending["$max"].get(field, value), value)
+
+    async def flush(self) -> int:
+        async with self._lock:
+            rollups, self.pending = list(self.pending.values()), {}
+            self.writing_counters, self.counters = self.counters, {}
+            try:
+                if rollups:
+                    operations = [
+                        UpdateOne(rollup["key"], {operator: rollup[operator] for operator in ("$inc", "$max", "$setOnInsert") if rollup[operator]}, upsert=True)
+                        for rollup in rollups
+                    ]
+                    try:
+                        await db[self.collection].bulk_write(operations, ordered=False)
+                    except BulkWriteError as e:
+                        # The other upserts went through; only the failed ones are retried
+                        self._merge([rollups[error["index"]] for error in e.details.get("writeErrors", [])])
+                        raise
+                    except BaseException:
+                        # Also when cancelled: nothing was acknowledged, so all of it is retried
+                        self._merge(rollups)
+                        raise
+                # Counters are incremented one by one, so each leaves writing_counters once it is in
+                for key in list(self.writing_counters):
+                    if key in self.writing_counters:
+                        amount, ttl = self.writing_counters[key]
+                        await shared_state.incr(key, amount, ttl=ttl)
+                        self.writing_counters.pop(key, None)
+            finally:
+                for key, (amount, ttl) in self.writing_counters.items():
+                    self.counters.setdefault(key, [0, ttl])[0] += amount
+                self.writing_counters = {}
+        return len(rollups)
+
+    async def run(self, stopping: Optional[asyncio.Event] = None):
+        """Write rollups every ``interval`` seconds until ``stopping`` is set"""
+        stopping = stopping or asyncio.Event()
+        while not stopping.is_set():
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error writing buffered {self.collection}: {str(e)}")
+            try:
+                await asyncio.wait_for(stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Lost {len(self.pending)} buffered {self.collection} rollups on shutdown: {str(e)}")
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight task.
+
+    The first caller starts the task and later callers with the same key await
+    it too, so all of them get the same result or exception; results must be
+    treated as read-only. A caller that is cancelled only stops waiting: the
+    task is cancelled once no caller is waiting for it any more. Keys are
+    forgotten as soon as the task finishes, so nothing is cached.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, dict] = {}
+        self.metrics = Counter()
+
+    async def do(self, key: str, factory):
+        self.metrics["calls"] += 1
+        call = self._calls.get(key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(factory()), "waiters": 0}
+            call["task"].add_done_callback(lambda task, key=key, call=call: self._finished(key, call))
+            self._calls[key] = call
+            self.metrics["executions"] += 1
+        else:
+            self.metrics["coalesced"] += 1
+        
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"])
+        except asyncio.CancelledError:
+            if call["waiters"] == 1 and not call["task"].done():
+                # Forget the key first: a caller arriving before the done-callback runs
+                # must start a new task, not join the one being cancelled
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                call["task"].cancel()
+                self.metrics["cancelled"] += 1
+            raise
+        finally:
+            call["waiters"] -= 1
+
+    def _finished(self, key: str, call: dict):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Mark the outcome as retrieved even if every caller gave up waiting
+        if not call["task"].cancelled() and call["task"].exception() is not None:
+            self.metrics["errors"] += 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            **{name: self.metrics[name] for name in ("calls", "executions", "coalesced", "cancelled", "errors")}
+        }
+
+# One group per kind of work; keys only need to be unique within a group
+llm_flight = SingleFlight("llm")
+generation_flight = SingleFlight("generation")
+read_flight = SingleFlight("read")
+SINGLE_FLIGHTS = (llm_flight, generation_flight, read_flight)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison as required for If-None-Match (RFC 9110 13.1.2)"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in [tag[2:] if tag.startswith('W/') else tag for tag in candidates]
+
+async def cached_json_response(request: Request, key: str, load) -> Response:
+    """Serve a JSON GET from the response cache, answering 304 when the client's ETag is current"""
+    generation, entry = await response_cache.get(key)
+    if entry is None:
+        async def build() -> tuple:
+            payload = await load()
+            body = orjson.dumps(payload, option=orjson.OPT_NAIVE_UTC)
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            return response_cache.set(key, generation, etag, body)
+        
+        # Concurrent misses for the same version share one load
+        entry = await read_flight.do(f"{key}@{generation}", build)
+    
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # Utility Functions
-def extract_text_from_pdf(pdf_file: bytes) -> str:
-    """Extract text from PDF file"""
+CHAPTER_HEADING = re.compile(
+    r"^\s*(chapter|unit|part|lecture|module)\s+([0-9]+|[ivxlc]+)\b.*$",
+    re.IGNORECASE,
+)
+
+def parse_page_range(spec: str, page_count: Optional[int] = None) -> List[int]:
+    """Parse a page spec like "1-5,8" into a sorted list of 1-based page numbers"""
+    pages = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d+)\s*(?:-\s*(\d+))?", part)
+        if not match:
+            raise HTTPException(status_code=400, detail=f"Invalid page range: {spec}")
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start < 1 or end < start:
+            raise HTTPException(status_code=400, detail=f"Invalid page range: {spec}")
+        if page_count is not None and end > page_count:
+            raise HTTPException(status_code=400, detail=f"Page range {spec} exceeds document length ({page_count} pages)")
+        pages.update(range(start, end + 1))
+    if not pages:
+        raise HTTPException(status_code=400, detail="Empty page range")
+    return sorted(pages)
+
+def heading_sections(page_texts: Dict[int, str], page_count: int) -> List[DocumentSection]:
+    """Detect chapters from headings such as "Chapter 3: ..." at the top of a page"""
+    starts = []
+    for page_number in sorted(page_texts):
+        for line in page_texts[page_number].splitlines()[:5]:
+            if CHAPTER_HEADING.match(line):
+                starts.append((page_number, line.strip()[:120]))
+                break
+    return sections_from_starts(starts, page_count)
+
+def sections_from_starts(starts: List[tuple], page_count: int) -> List[DocumentSection]:
+    starts = sorted(dict(starts).items())
+    sections = []
+    for i, (start_page, title) in enumerate(starts):
+        end_page = starts[i + 1][0] - 1 if i + 1 < len(starts) else page_count
+        if end_page >= start_page:
+            sections.append(DocumentSection(title=title, start_page=start_page, end_page=end_page))
+    return sections
+
+def find_section(sections: List[DocumentSection], section: str) -> DocumentSection:
+    """Look up a section by 1-based number or (case-insensitive) title"""
+    key = section.strip()
+    if key.isdigit() and 1 <= int(key) <= len(sections):
+        return sections[int(key) - 1]
+    for candidate in sections:
+        if candidate.title.lower() == key.lower():
+            return candidate
+    for candidate in sections:
+        if key.lower() in candidate.title.lower():
+            return candidate
+    raise HTTPException(status_code=404, detail=f"Section not found: {section}")
+
+# PDF extraction engines
+class PdfExtractionEngine(ABC):
+    """A PDF library wrapped behind a common interface: page count, outline and per-page text"""
+    name = None
+    page_count = 0
+
+    @abstractmethod
+    def __init__(self, pdf_file: bytes):
+        """Open the PDF and set ``page_count``"""
+
+    def outline(self) -> List[tuple]:
+        """Top-level outline entries as (1-based start page, title)"""
+        return []
+
+    @abstractmethod
+    def page_text(self, number: int) -> str:
+        """Text of a 1-based page"""
+
+class PyPDF2Engine(PdfExtractionEngine):
+    name = "pypdf2"
+
+    def __init__(self, pdf_file: bytes):
+        self.reader = load_pypdf2().PdfReader(io.BytesIO(pdf_file))
+        self.page_count = len(self.reader.pages)
+
+    def outline(self) -> List[tuple]:
+        starts = []
+        for item in self.reader.outline:
+            # Nested lists hold sub-entries of the previous item; only chapters matter here
+            if isinstance(item, list):
+                continue
+            try:
+                page_index = self.reader.get_destination_page_number(item)
+            except Exception:
+                continue
+            if page_index is not None and page_index >= 0:
+                starts.append((page_index + 1, str(item.title).strip()))
+        return starts
+
+    def page_text(self, number: int) -> str:
+        return self.reader.pages[number - 1].extract_text() or ""
+
+class PdfiumEngine(PdfExtractionEngine):
+    name = "pypdfium2"
+
+    def __init__(self, pdf_file: bytes):
+        import pypdfium2
+        self.document = pypdfium2.PdfDocument(pdf_file)
+        self.page_count = len(self.document)
+
+    def outline(self) -> List[tuple]:
+        starts = []
+        for item in self.document.get_toc():
+            if item.level != 0:
+                continue
+            # pypdfium2 5.x uses getters, 4.x plain attributes
+            if hasattr(item, "get_dest"):
+                dest = item.get_dest()
+                page_index = dest.get_index() if dest else None
+                title = item.get_title()
+            else:
+                page_index, title = item.page_index, item.title
+            if page_index is not None and page_index >= 0:
+                starts.append((page_index + 1, title.strip()))
+        return starts
+
+    def page_text(self, number: int) -> str:
+        page = self.document[number - 1]
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_range().replace("\r\n", "\n")
+        finally:
+            textpage.close()
+            page.close()
+
+class PdfMinerEngine(PdfExtractionEngine):
+    """pdfminer.six; slower, but has the most careful layout analysis. No outline support."""
+    name = "pdfminer"
+
+    def __init__(self, pdf_file: bytes):
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfinterp import PDFResourceManager
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdfparser import PDFParser
+        self.document = PDFDocument(PDFParser(io.BytesIO(pdf_file)))
+        self.pages = list(PDFPage.create_pages(self.document))
+        self.page_count = len(self.pages)
+        self.resources = PDFResourceManager(caching=True)
+
+    def page_text(self, number: int) -> str:
+        from pdfminer.converter import TextConverter
+        from pdfminer.layout import LAParams
+        from pdfminer.pdfinterp import PDFPageInterpreter
+        output = io.StringIO()
+        device = TextConverter(self.resources, output, laparams=LAParams())
+        try:
+            PDFPageInterpreter(self.resources, device).process_page(self.pages[number - 1])
+        finally:
+            device.close()
+        return output.getvalue()
+
+EXTRACTION_ENGINES = {engine.name: engine for engine in (PyPDF2Engine, PdfiumEngine, PdfMinerEngine)}
+_extraction_context = None
+
+def get_extraction_context():
+    """Process context for isolated extraction; the forkserver preloads this module once"""
+    global _extraction_context
+    if _extraction_context is None:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            _extraction_context = multiprocessing.get_context("forkserver")
+            _extraction_context.set_forkserver_preload([__name__])
+        else:
+            _extraction_context = multiprocessing.get_context("spawn")
+    return _extraction_context
+
+def _extraction_worker(conn):
+    """Child side of isolated extraction: serves requests until the pipe closes.
+
+    A request is (pdf bytes, engine name, pages). Without a page list the
+    worker first reports the page count and outline and waits for the parent
+    to choose the pages. Every request ends with a "done" or "fatal" message.
+    """
+    while True:
+        try:
+            pdf_file, engine_name, pages = conn.recv()
+        except EOFError:
+            return
+        try:
+            engine = EXTRACTION_ENGINES[engine_name](pdf_file)
+            if pages is None:
+                try:
+                    outline = engine.outline()
+                except Exception:
+                    outline = []
+                conn.send(("meta", engine.page_count, outline))
+                pages = conn.recv()
+            for number in pages:
+                try:
+                    conn.send(("page", number, engine.page_text(number)))
+                except Exception as e:
+                    conn.send(("error", number, str(e)))
+            conn.send(("done",))
+        except Exception as e:
+            conn.send(("fatal", str(e)))
+
+class ExtractionWorker:
+    """A long-lived extraction child process; discarded and replaced when a page hangs or crashes it"""
+
+    def __init__(self):
+        context = get_extraction_context()
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_extraction_worker, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+_idle_extraction_workers: List[ExtractionWorker] = []
+_extraction_workers_lock = threading.Lock()
+# Held by uploads around the extraction thread, so waiting uploads do not tie up executor threads
+extraction_slots = asyncio.Semaphore(PDF_EXTRACTION_WORKERS)
+
+def acquire_extraction_worker() -> ExtractionWorker:
+    with _extraction_workers_lock:
+        while _idle_extraction_workers:
+            worker = _idle_extraction_workers.pop()
+            if worker.process.is_alive():
+                return worker
+            worker.stop()
+    return ExtractionWorker()
+
+def release_extraction_worker(worker: ExtractionWorker):
+    with _extraction_workers_lock:
+        _idle_extraction_workers.append(worker)
+
+def stop_extraction_workers():
+    with _extraction_workers_lock:
+        workers = list(_idle_extraction_workers)
+        _idle_extraction_workers.clear()
+    for worker in workers:
+        worker.stop()
+
+def _extract_inline(engine_class, pdf_file: bytes, choose_pages) -> Dict[str, Any]:
+    engine = engine_class(pdf_file)
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_file))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text.strip()
+        outline = engine.outline()
+    except Exception as e:
+        logging.warning(f"Could not read PDF outline: {str(e)}")
+        outline = []
+    texts, skipped = {}, []
+    for number in choose_pages(engine.page_count, outline):
+        try:
+            texts[number] = engine.page_text(number)
+        except Exception as e:
+            logging.warning(f"Skipping page {number}: {str(e)}")
+            skipped.append(number)
+    return {"page_count": engine.page_count, "pages": texts, "skipped": skipped}
+
+def _extract_isolated(engine_name: str, pdf_file: bytes, choose_pages, timeout: float) -> Dict[str, Any]:
+    """Extract in a worker process; a page that hangs or crashes it is skipped and a fresh worker resumes after it"""
+    page_count = None
+    remaining = None
+    texts, skipped = {}, []
+    while remaining is None or remaining:
+        worker = acquire_extraction_worker()
+        finished = False
+        try:
+            worker.connection.send((pdf_file, engine_name, remaining))
+            if remaining is None:
+                if not worker.connection.poll(timeout):
+                    raise ValueError("Timed out reading the PDF structure")
+                message = worker.connection.recv()
+                if message[0] == "fatal":
+                    finished = True
+                    raise ValueError(message[1])
+                _, page_count, outline = message
+                remaining = list(choose_pages(page_count, outline))
+                worker.connection.send(remaining)
+            while True:
+                if not worker.connection.poll(timeout):
+                    logging.warning(f"Skipping page {remaining[0]}: extraction took longer than {timeout}s")
+                    skipped.append(remaining.pop(0))
+                    break
+                message = worker.connection.recv()
+                if message[0] == "page":
+                    texts[message[1]] = message[2]
+                    remaining.remove(message[1])
+                elif message[0] == "error":
+                    logging.warning(f"Skipping page {message[1]}: {message[2]}")
+                    skipped.append(message[1])
+                    remaining.remove(message[1])
+                elif message[0] == "done":
+                    finished = True
+                    break
+                elif message[0] == "fatal":
+                    finished = True
+                    raise ValueError(message[1])
+        except EOFError:
+            # The worker died (e.g. a crash inside a native library) on the current page
+            if not remaining:
+                raise ValueError("PDF extraction process exited unexpectedly")
+            logging.warning(f"Skipping page {remaining[0]}: extraction process exited unexpectedly")
+            skipped.append(remaining.pop(0))
+        finally:
+            # Only a worker that completed its request is in a known state
+            if finished:
+                release_extraction_worker(worker)
+            else:
+                worker.stop()
+    return {"page_count": page_count, "pages": texts, "skipped": skipped}
+
+def run_extraction(pdf_file: bytes, choose_pages, engine: Optional[str] = None,
+                   isolation: Optional[str] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Extract page text with the configured engine.
+
+    ``choose_pages(page_count, outline)`` picks the 1-based pages to extract
+    once the document structure is known. Returns the page count, the text of
+    each extracted page and the pages that were skipped.
+    """
+    engine = (engine or PDF_EXTRACTION_ENGINE).lower()
+    if engine not in EXTRACTION_ENGINES:
+        raise ValueError(f"Unknown PDF extraction engine: {engine}")
+    if (isolation or PDF_EXTRACTION_ISOLATION) == "inline":
+        return _extract_inline(EXTRACTION_ENGINES[engine], pdf_file, choose_pages)
+    return _extract_isolated(engine, pdf_file, choose_pages, timeout or PDF_PAGE_TIMEOUT_SECONDS)
+
+def extract_pages_from_pdf(pdf_file: bytes, pages: Optional[str] = None, section: Optional[str] = None) -> Dict[str, Any]:
+    """Extract text from a PDF, optionally only for a page range or section.
+
+    Returns the per-page text (keyed by 1-based page number), the total page
+    count, the detected sections, the requested scope (None for the whole
+    document) and the pages that had to be skipped. Pages outside the scope
+    are only extracted when there is no outline and the section has to be
+    found from headings.
+    """
+    scope = None
+    sections = []
+
+    def choose_pages(page_count: int, outline: List[tuple]) -> List[int]:
+        nonlocal scope, sections
+        sections = sections_from_starts(outline, page_count)
+        if pages:
+            scope = parse_page_range(pages, page_count)
+        elif section and sections:
+            match = find_section(sections, section)
+            scope = list(range(match.start_page, match.end_page + 1))
+        return scope or list(range(1, page_count + 1))
+
+    try:
+        extracted = run_extraction(pdf_file, choose_pages)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error extracting text from PDF: {str(e)}")
 
+    page_texts = extracted["pages"]
+    page_count = extracted["page_count"]
+    if not sections and scope is None:
+        sections = heading_sections(page_texts, page_count)
+        if section and not pages:
+            match = find_section(sections, section)
+            scope = list(range(match.start_page, match.end_page + 1))
+
+    return {
+        "pages": page_texts,
+        "page_count": page_count,
+        "sections": sections,
+        "scope": scope,
+        "skipped_pages": sorted(extracted["skipped"])
+    }
+
+def resolve_page_scope(document: dict, pages: Optional[str], section: Optional[str]) -> Optional[List[int]]:
+    """Translate pages/section request parameters into page numbers for a stored document"""
+    if not pages and not section:
+        return None
+    if not document.get('page_count'):
+        raise HTTPException(status_code=400, detail="Page information is not available for this document")
+    if pages:
+        selected = parse_page_range(pages, document['page_count'])
+    else:
+        sections = [DocumentSection(**s) for s in document.get('sections', [])]
+        if not sections:
+            raise HTTPException(status_code=400, detail="No sections were detected for this document")
+        match = find_section(sections, section)
+        selected = list(range(match.start_page, match.end_page + 1))
+
+    missing = set(selected) - set(document.get('extracted_pages', []))
+    if missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Pages {format_page_list(sorted(missing))} were not extracted for this document"
+        )
+    return selected
+
+async def load_pages(document_id: str, pages: Optional[List[int]] = None) -> Dict[int, str]:
+    """Load page text by page number, optionally only the given pages"""
+    query = {"document_id": document_id}
+    if pages:
+        query["page"] = {"$in": pages}
+    cursor = db.document_pages.find(query, {"_id": 0, "page": 1, "text": 1}).sort("page", 1)
+    return {page["page"]: page["text"] async for page in cursor}
+
+async def load_page_text(document_id: str, pages: List[int]) -> str:
+    """Load only the requested pages of a document from the page store"""
+    cursor = db.document_pages.find(
+        {"document_id": document_id, "page": {"$in": pages}},
+        {"_id": 0, "page": 1, "text": 1}
+    ).sort("page", 1)
+    return "\n".join([page["text"] async for page in cursor]).strip()
+
+def chunk_count_for(text: str) -> int:
+    return max(1, -(-len(text) // GENERATION_CHUNK_CHARS))
+
+def get_chunk(text: str, index: int) -> str:
+    start = index * GENERATION_CHUNK_CHARS
+    return text[start:start + GENERATION_CHUNK_CHARS]
+
+def format_page_list(pages: List[int]) -> str:
+    """Format [1, 2, 3, 7] as "1-3,7" """
+    ranges = []
+    for page in pages:
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+# Datetime fields stored as native BSON dates, per collection
+DATETIME_FIELDS = {
+    "documents": "upload_time",
+    "study_materials": "created_at",
+    "chat_messages": "timestamp",
+}
+
 def prepare_for_mongo(data: dict) -> dict:
-    """Prepare data for MongoDB storage"""
-    if isinstance(data.get('upload_time'), datetime):
-        data['upload_time'] = data['upload_time'].isoformat()
-    if isinstance(data.get('created_at'), datetime):
-        data['created_at'] = data['created_at'].isoformat()
-    if isinstance(data.get('timestamp'), datetime):
-        data['timestamp'] = data['timestamp'].isoformat()
+    """Prepare data for MongoDB storage.
+
+    Datetimes are stored as native BSON dates (UTC) so they support range
+    queries and TTL indexes; naive values are assumed to already be UTC.
+    """
+    for field in DATETIME_FIELDS.values():
+        value = data.get(field)
+        if isinstance(value, datetime) and value.tzinfo is None:
+            data[field] = value.replace(tzinfo=timezone.utc)
     return data
 
-async def generate_mcqs(content: str, num_questions: int = 10) -> List[MCQuestion]:
-    """Generate multiple choice questions from content using AI"""
+async def migrate_iso_datetimes(database, batch_size: int = 1000) -> Dict[str, int]:
+    """Convert datetimes stored as ISO strings by older versions into BSON dates"""
+    migrated = {}
+    for collection_name, field in DATETIME_FIELDS.items():
+        collection = database[collection_name]
+        cursor = collection.find({field: {"$type": "string"}}, {"_id": 1, field: 1})
+        count = 0
+        batch = []
+        async for record in cursor:
+            try:
+                value = datetime.fromisoformat(record[field].replace('Z', '+00:00'))
+            except ValueError:
+                logging.warning(f"Skipping unparseable {collection_name}.{field}: {record[field]!r}")
+                continue
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            batch.append(UpdateOne({"_id": record["_id"]}, {"$set": {field: value}}))
+            if len(batch) >= batch_size:
+                count += (await collection.bulk_write(batch, ordered=False)).modified_count
+                batch = []
+        if batch:
+            count += (await collection.bulk_write(batch, ordered=False)).modified_count
+        migrated[collection_name] = count
+    return migrated
+
+# Retention and archival
+class ThrottleLog:
+    """When each key was last acted on, so repeated writes can be skipped within ``interval``.
+
+    Entries are kept in time order; expired ones are dropped as new ones come
+    in, and beyond ``max_entries`` the oldest go first (at worst costing one
+    extra write later).
+    """
+
+    def __init__(self, interval: timedelta, max_entries: int):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._times: "OrderedDict[Any, datetime]" = OrderedDict()
+
+    def due(self, key: Any, now: datetime) -> bool:
+        """True (and the time is recorded) unless ``key`` was acted on within the interval"""
+        last = self._times.get(key)
+        if last and now - last < self.interval:
+            return False
+        self._times[key] = now
+        self._times.move_to_end(key)
+        while self._times:
+            oldest_key, oldest = next(iter(self._times.items()))
+            if now - oldest < self.interval and len(self._times) <= self.max_entries:
+                break
+            del self._times[oldest_key]
+        return True
+
+    def discard(self, predicate):
+        for key in [key for key in self._times if predicate(key)]:
+            del self._times[key]
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+_last_touched = ThrottleLog(ACCESS_TOUCH_INTERVAL, ACCESS_TOUCH_MAX_ENTRIES)
+
+async def touch_document(document_id: str):
+    """Record that a document was used, throttled so hot documents don't cost a write per request"""
+    now = datetime.now(timezone.utc)
+    if not _last_touched.due(document_id, now):
+        return
+    await db.documents.update_one({"id": document_id}, {"$set": {"last_accessed": now}})
+
+async def get_document(document_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+    """Fetch a document, transparently rehydrating it from the archive and recording the access"""
+    projection = dict(projection or {"_id": 0})
+    if any(value == 1 for value in projection.values()):
+        projection["archived"] = 1
+    document = await db.documents.find_one({"id": document_id}, projection)
+    if document is None:
+        return None
+    if document.get("archived"):
+        await rehydrate_document(document_id)
+        document = await db.documents.find_one({"id": document_id}, projection)
+    await touch_document(document_id)
+    return document
+
+def stale_document_filter(cutoff: datetime) -> dict:
+    """Hot documents last accessed before ``cutoff``"""
+    return {
+        "archived": {"$ne": True},
+        "$or": [
+            {"last_accessed": {"$lt": cutoff}},
+            # Documents from before access tracking
+            {"last_accessed": {"$exists": False}, "upload_time": {"$lt": cutoff}}
+        ]
+    }
+
+async def archive_document(document: dict, cutoff: Optional[datetime] = None) -> bool:
+    """Move a document's content and page text into the compressed cold collection
+
+    With a ``cutoff``, nothing is archived if the document was accessed since.
+    """
+    document_id = document["id"]
+    pages = await db.document_pages.find(
+        {"document_id": document_id}, {"_id": 0, "page": 1, "text": 1}
+    ).to_list(None)
+    payload = orjson.dumps({"content": document.get("content", ""), "pages": pages})
+    await db.archived_documents.replace_one(
+        {"document_id": document_id},
+        {
+            "document_id": document_id,
+            "data": zlib.compress(payload, 9),
+            "original_size": len(payload),
+            "archived_at": datetime.now(timezone.utc)
+        },
+        upsert=True
+    )
+    result = await db.documents.update_one(
+        {"id": document_id, **(stale_document_filter(cutoff) if cutoff else {"archived": {"$ne": True}})},
+        {"$set": {"archived": True}, "$unset": {"content": ""}}
+    )
+    if not result.matched_count:
+        # Accessed since it was read: the hot copy stays and the archive written above is dropped
+        # (the retention lease makes this the only archiver, so the archive is ours)
+        await db.archived_documents.delete_one({"document_id": document_id})
+        return False
+    await db.document_pages.delete_many({"document_id": document_id})
+    return True
+
+async def rehydrate_document(document_id: str):
+    """Restore an archived document's content and pages into the hot collections"""
+    archive = await db.archived_documents.find_one({"document_id": document_id})
+    if archive is None:
+        # Another request already rehydrated it
+        return
+    payload = orjson.loads(zlib.decompress(archive["data"]))
+    if payload["pages"]:
+        await db.document_pages.bulk_write([
+            ReplaceOne(
+                {"document_id": document_id, "page": page["page"]},
+                {"document_id": document_id, "page": page["page"], "text": page["text"]},
+                upsert=True
+            )
+            for page in payload["pages"]
+        ], ordered=False)
+    await db.documents.update_one(
+        {"id": document_id},
+        {"$set": {"content": payload["content"], "archived": False, "last_accessed": datetime.now(timezone.utc)}}
+    )
+    await db.archived_documents.delete_one({"document_id": document_id})
+    logging.info(f"Rehydrated archived document {document_id}")
+
+async def archive_stale_documents() -> int:
+    """Archive documents that have not been accessed for DOCUMENT_ARCHIVE_DAYS"""
+    if DOCUMENT_ARCHIVE_DAYS <= 0:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(days=DOCUMENT_ARCHIVE_DAYS)
+    cursor = db.documents.find(stale_document_filter(cutoff), {"_id": 0, "id": 1, "content": 1})
+    archived = 0
+    async for document in cursor:
+        if await archive_document(document, cutoff):
+            archived += 1
+    if archived:
+        logging.info(f"Archived {archived} documents not accessed in {DOCUMENT_ARCHIVE_DAYS} days")
+    return archived
+
+async def ensure_ttl_index(collection: str, field: str, name: str, days: int):
+    """Create, update or drop the TTL index that expires records ``days`` after ``field``; 0 keeps them"""
+    if days <= 0:
+        existing = await db[collection].index_information()
+        if name in existing:
+            await db[collection].drop_index(name)
+        return
+    seconds = days * 86400
+    try:
+        await db[collection].create_index(field, name=name, expireAfterSeconds=seconds)
+    except OperationFailure:
+        # The index exists with a different retention period
+        await db.command("collMod", collection, index={"name": name, "expireAfterSeconds": seconds})
+
+async def retention_loop():
+    while True:
+        try:
+            # Every worker runs this loop; the lease lets one of them do each pass
+            if await shared_state.try_lock("lock:retention", RETENTION_INTERVAL_SECONDS * 0.9):
+                await archive_stale_documents()
+        except Exception as e:
+            logging.error(f"Error archiving documents: {str(e)}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+# Search
+# BM25 parameters and the number of highest-impact postings read per query term
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_POSTINGS_PER_TERM = int(os.environ.get('SEARCH_POSTINGS_PER_TERM', '2000'))
+SEARCH_SNIPPET_CHARS = 200
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have in is it its of on or that the this
+to was were which with not no can will would should may also than then there these those
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+def search_units_for(document_id: str, page_texts: Dict[int, str], mcqs: List[dict], flashcards: List[dict]) -> List[dict]:
+    """Split a document into searchable units: one per page, MCQ and flashcard"""
+    units = [
+        {"_id": f"page:{document_id}:{number}", "document_id": document_id, "kind": "page", "page": number, "text": text}
+        for number, text in page_texts.items()
+    ]
+    units += [
+        {"_id": f"mcq:{mcq['id']}", "document_id": document_id, "kind": "mcq", "item_id": mcq['id'],
+         "text": " ".join([mcq['question'], *mcq['options']])}
+        for mcq in mcqs
+    ]
+    units += [
+        {"_id": f"flashcard:{card['id']}", "document_id": document_id, "kind": "flashcard", "item_id": card['id'],
+         "text": f"{card['front']}\n{card['back']}"}
+        for card in flashcards
+    ]
+    return units
+
+async def index_for_search(units: List[dict]):
+    """Add units to the inverted index.
+
+    Postings store a precomputed BM25 term-frequency component ("impact")
+    using the corpus average length at indexing time, so a query only has to
+    read the top postings per term and multiply by the current IDF.
+    """
+    if not units:
+        return
+    stats = await db.search_stats.find_one({"_id": "corpus"}) or {"units": 0, "length": 0}
+    
+    postings = []
+    term_counts = Counter()
+    total_length = 0
+    for indexed, unit in enumerate(units, start=1):
+        counts = Counter(tokenize(unit["text"]))
+        length = sum(counts.values())
+        total_length += length
+        unit["length"] = length
+        avg_length = (stats["length"] + total_length) / (stats["units"] + indexed) or 1
+        for term, tf in counts.items():
+            impact = tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+            postings.append({
+                "term": term, "unit": unit["_id"], "document_id": unit["document_id"],
+                "kind": unit["kind"], "impact": impact
+            })
+        term_counts.update(counts.keys())
+    
+    # Page text already lives in document_pages; only keep it for MCQs and flashcards
+    await db.search_units.bulk_write([
+        ReplaceOne({"_id": unit["_id"]}, {k: v for k, v in unit.items() if unit["kind"] != "page" or k != "text"}, upsert=True)
+        for unit in units
+    ], ordered=False)
+    if postings:
+        await db.search_postings.insert_many(postings, ordered=False)
+    if term_counts:
+        await db.search_terms.bulk_write([
+            UpdateOne({"_id": term}, {"$inc": {"df": count}}, upsert=True)
+            for term, count in term_counts.items()
+        ], ordered=False)
+    await db.search_stats.update_one(
+        {"_id": "corpus"},
+        {"$inc": {"units": len(units), "length": total_length}},
+        upsert=True
+    )
+
+async def remove_from_search_index(document_id: str):
+    """Drop all of a document's units and postings, keeping document frequencies consistent"""
+    term_counts = Counter()
+    async for posting in db.search_postings.find({"document_id": document_id}, {"_id": 0, "term": 1}):
+        term_counts[posting["term"]] += 1
+    units = await db.search_units.find({"document_id": document_id}, {"_id": 0, "length": 1}).to_list(None)
+    if not units:
+        return
+    
+    if term_counts:
+        await db.search_terms.bulk_write([
+            UpdateOne({"_id": term}, {"$inc": {"df": -count}})
+            for term, count in term_counts.items()
+        ], ordered=False)
+    await db.search_postings.delete_many({"document_id": document_id})
+    await db.search_units.delete_many({"document_id": document_id})
+    await db.search_stats.update_one(
+        {"_id": "corpus"},
+        {"$inc": {"units": -len(units), "length": -sum(unit.get("length", 0) for unit in units)}}
+    )
+
+def highlight_snippet(text: str, terms: set) -> str:
+    """HTML-escaped excerpt around the first matching term, with matches wrapped in <mark>"""
+    matches = [m for m in TOKEN_PATTERN.finditer(text.lower()) if m.group() in terms]
+    start = max(0, matches[0].start() - SEARCH_SNIPPET_CHARS // 3) if matches else 0
+    if start > 0:
+        # Don't start in the middle of a word
+        boundary = text.find(" ", start, matches[0].start())
+        start = boundary + 1 if boundary != -1 else start
+    end = min(len(text), start + SEARCH_SNIPPET_CHARS)
+    parts = ["..." if start > 0 else ""]
+    position = start
+    for match in matches:
+        if match.start() < start:
+            continue
+        if match.end() > end:
+            break
+        parts.append(html.escape(text[position:match.start()]))
+        parts.append(f"<mark>{html.escape(text[match.start():match.end()])}</mark>")
+        position = match.end()
+    parts.append(html.escape(text[position:end]))
+    parts.append("..." if end < len(text) else "")
+    return " ".join("".join(parts).split())
+
+async def search_index(query: str, limit: int = 10, kind: Optional[str] = None, document_id: Optional[str] = None) -> List[dict]:
+    terms = list(dict.fromkeys(tokenize(query)))[:10]
+    if not terms:
+        return []
+    stats = await db.search_stats.find_one({"_id": "corpus"})
+    if not stats or stats["units"] <= 0:
+        return []
+    document_frequencies = {
+        record["_id"]: record["df"]
+        async for record in db.search_terms.find({"_id": {"$in": terms}})
+    }
+    
+    posting_filter = {}
+    if kind:
+        posting_filter["kind"] = kind
+    if document_id:
+        posting_filter["document_id"] = document_id
+    async def top_postings(term: str) -> List[dict]:
+        return await db.search_postings.find(
+            {"term": term, **posting_filter}, {"_id": 0, "unit": 1, "impact": 1}
+        ).sort("impact", -1).limit(SEARCH_POSTINGS_PER_TERM).to_list(None)
+    
+    scores = Counter()
+    for term, postings in zip(terms, await asyncio.gather(*(top_postings(t) for t in terms))):
+        df = document_frequencies.get(term, 0)
+        if df <= 0:
+            continue
+        idf = math.log(1 + (stats["units"] - df + 0.5) / (df + 0.5))
+        for posting in postings:
+            scores[posting["unit"]] += idf * posting["impact"]
+    if not scores:
+        return []
+    
+    candidates = [unit for unit, _ in scores.most_common(limit)]
+    units = {unit["_id"]: unit async for unit in db.search_units.find({"_id": {"$in": candidates}})}
+    ranked = [units[unit] for unit in candidates if unit in units]
+    
+    page_keys = [(unit["document_id"], unit["page"]) for unit in ranked if unit["kind"] == "page"]
+    page_texts = {}
+    if page_keys:
+        cursor = db.document_pages.find(
+            {"$or": [{"document_id": d, "page": p} for d, p in page_keys]},
+            {"_id": 0, "document_id": 1, "page": 1, "text": 1}
+        )
+        page_texts = {(page["document_id"], page["page"]): page["text"] async for page in cursor}
+    # Archived documents keep their index entries; their page text is in the archive
+    for archived_id in {d for d, p in page_keys if (d, p) not in page_texts}:
+        for number, text in (await archived_page_texts(archived_id)).items():
+            page_texts[(archived_id, number)] = text
+    filenames = {
+        document["id"]: document["filename"]
+        async for document in db.documents.find(
+            {"id": {"$in": list({unit["document_id"] for unit in ranked})}},
+            {"_id": 0, "id": 1, "filename": 1}
+        )
+    }
+    
+    term_set = set(terms)
+    results = []
+    for unit in ranked:
+        text = page_texts.get((unit["document_id"], unit.get("page"))) or unit.get("text", "")
+        results.append({
+            "document_id": unit["document_id"],
+            "filename": filenames.get(unit["document_id"]),
+            "kind": unit["kind"],
+            "page": unit.get("page"),
+            "item_id": unit.get("item_id"),
+            "score": round(scores[unit["_id"]], 4),
+            "snippet": highlight_snippet(text, term_set)
+        })
+    return results
+
+async def reindex_all_documents() -> int:
+    """Rebuild the search index from scratch (for documents uploaded before search existed)"""
+    for collection in ("search_units", "search_postings", "search_terms", "search_stats"):
+        await db[collection].delete_many({})
+    count = 0
+    async for document in db.documents.find({}, {"_id": 0, "id": 1, "content": 1}):
+        await index_document(document)
+        count += 1
+    return count
+
+async def archived_page_texts(document_id: str) -> Dict[int, str]:
+    """Page text of an archived document, read from its compressed copy in the cold collection"""
+    archive = await db.archived_documents.find_one({"document_id": document_id}, {"_id": 0, "data": 1})
+    if not archive:
+        return {}
+    return {page["page"]: page["text"] for page in orjson.loads(zlib.decompress(archive["data"]))["pages"]}
+
+async def index_document(document: dict):
+    """Index one document's pages (or whole content if it has none), MCQs and flashcards"""
+    page_texts = {
+        page["page"]: page["text"]
+        async for page in db.document_pages.find({"document_id": document["id"]}, {"_id": 0, "page": 1, "text": 1})
+    }
+    if not page_texts and document.get("content"):
+        page_texts = {1: document["content"]}
+    if not page_texts:
+        page_texts = await archived_page_texts(document["id"])
+    materials = await db.study_materials.find_one({"document_id": document["id"]}, {"_id": 0, "mcqs": 1, "flashcards": 1}) or {}
+    await index_for_search(search_units_for(
+        document["id"], page_texts, materials.get("mcqs", []), materials.get("flashcards", [])
+    ))
+
+async def reindex_documents(document_ids: List[str]):
+    """Replace the search index entries of the given documents, e.g. after an import"""
+    for document_id in document_ids:
+        await remove_from_search_index(document_id)
+        document = await db.documents.find_one({"id": document_id}, {"_id": 0, "id": 1, "content": 1})
+        if document:
+            await index_document(document)
+
+# Near-duplicate detection
+MINHASH_PERMUTATIONS = 128
+# 32 bands of 4 rows: pairs above ~0.6 similarity share a band with >99% probability
+LSH_BANDS = 32
+SHINGLE_SIZE = 5
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get('NEAR_DUPLICATE_THRESHOLD', '0.8'))
+# A page counts as changed when this share of its shingles is not in the original
+CHANGED_PAGE_NOVELTY = 0.5
+_minhash_parameters = None
+
+def shingle_hashes(text: str):
+    """Unique 32-bit hashes of the document's overlapping 5-token shingles"""
+    np = load_numpy()
+    tokens = tokenize(text)
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = [" ".join(tokens)] if tokens else []
+    else:
+        shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    return np.unique(hashes)
+
+def minhash_signature(text: str) -> Optional[List[int]]:
+    """MinHash signature using multiply-shift hashing, vectorized over blocks of shingles"""
+    global _minhash_parameters
+    np = load_numpy()
+    hashes = shingle_hashes(text)
+    if hashes.size == 0:
+        return None
+    if _minhash_parameters is None:
+        rng = np.random.default_rng(20240501)
+        a = rng.integers(1, 2**63, size=MINHASH_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+        b = rng.integers(0, 2**63, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+        _minhash_parameters = (a[:, None], b[:, None])
+    a, b = _minhash_parameters
+    signature = np.full(MINHASH_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, hashes.size, 4096):
+        # uint64 arithmetic wraps around, which is what multiply-shift hashing expects
+        values = (a * hashes[None, start:start + 4096] + b) >> np.uint64(32)
+        signature = np.minimum(signature, values.min(axis=1))
+    return signature.tolist()
+
+def lsh_bands(signature: List[int]) -> List[str]:
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    return [
+        f"{band}:{hashlib.blake2b(orjson.dumps(signature[band * rows:(band + 1) * rows]), digest_size=8).hexdigest()}"
+        for band in range(LSH_BANDS)
+    ]
+
+async def find_near_duplicate(signature: List[int]) -> Optional[dict]:
+    """Most similar earlier whole-document upload that has study materials, if above the threshold"""
+    np = load_numpy()
+    query = np.array(signature, dtype=np.uint64)
+    candidates = []
+    async for candidate in db.documents.find(
+        {"lsh_bands": {"$in": lsh_bands(signature)}},
+        {"_id": 0, "id": 1, "filename": 1, "minhash": 1}
+    ).limit(100):
+        similarity = float(np.mean(np.array(candidate["minhash"], dtype=np.uint64) == query))
+        if similarity >= NEAR_DUPLICATE_THRESHOLD:
+            candidates.append((similarity, candidate))
+    
+    for similarity, candidate in sorted(candidates, key=lambda c: c[0], reverse=True):
+        if await db.study_materials.count_documents({"document_id": candidate["id"], "pages": None}, limit=1):
+            return {"id": candidate["id"], "filename": candidate["filename"], "similarity": similarity}
+    return None
+
+async def find_changed_pages(original_id: str, page_texts: Dict[int, str]) -> List[int]:
+    """Pages of a new revision whose content is mostly absent from the original document"""
+    np = load_numpy()
+    # Make sure the original's pages are available if it has been archived
+    await get_document(original_id, {"_id": 0, "id": 1})
+    original_text = "\n".join([
+        page["text"] async for page in db.document_pages.find({"document_id": original_id}, {"_id": 0, "text": 1})
+    ])
+    original_hashes = shingle_hashes(original_text)
+    changed = []
+    for number, text in page_texts.items():
+        hashes = shingle_hashes(text)
+        if hashes.size and np.mean(~np.isin(hashes, original_hashes, assume_unique=True)) > CHANGED_PAGE_NOVELTY:
+            changed.append(number)
+    return changed
+
+def copy_with_new_ids(items: List[dict], model):
+    """Copy MCQs/flashcards for another document; ids must stay unique across documents"""
+    return [model(**{**item, "id": str(uuid.uuid4())}) for item in items]
+
+# Spaced repetition
+_last_enrolled = ThrottleLog(ACCESS_TOUCH_INTERVAL, ACCESS_TOUCH_MAX_ENTRIES)
+
+def sm2_schedule(review: dict, quality: int, now: datetime) -> dict:
+    """Apply one SM-2 grade to a card's review state and return the fields to update"""
+    easiness = max(1.3, review["easiness"] + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    if quality < 3:
+        repetitions, interval = 0, 1
+    else:
+        repetitions = review["repetitions"] + 1
+        if repetitions == 1:
+            interval = 1
+        elif repetitions == 2:
+            interval = 6
+        else:
+            interval = round(review["interval"] * easiness)
+    return {
+        "easiness": round(easiness, 4),
+        "interval": interval,
+        "repetitions": repetitions,
+        "due_at": now + timedelta(days=interval),
+        "last_reviewed": now
+    }
+
+async def enroll_flashcards(user_id: str, document_id: str, flashcards: List[dict]) -> int:
+    """Create review state for cards the user has not seen yet; existing state is left alone"""
+    if not flashcards:
+        return 0
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "card_id": card["id"]},
+            {"$setOnInsert": prepare_for_mongo(FlashcardReview(
+                user_id=user_id, card_id=card["id"], document_id=document_id,
+                front=card["front"], back=card["back"]
+            ).dict())},
+            upsert=True
+        )
+        for card in flashcards
+    ]
+    result = await db.flashcard_reviews.bulk_write(operations, ordered=False)
+    return result.upserted_count
+
+async def enroll_document_flashcards(user_id: str, document_id: str):
+    """Enroll all of a document's flashcards for a user, at most once per ACCESS_TOUCH_INTERVAL per worker"""
+    if not _last_enrolled.due((user_id, document_id), datetime.now(timezone.utc)):
+        return
+    study_material = await db.study_materials.find_one(
+        {"document_id": document_id},
+        {"_id": 0, "flashcards.id": 1, "flashcards.front": 1, "flashcards.back": 1}
+    )
+    if study_material:
+        enrolled = await enroll_flashcards(user_id, document_id, study_material.get("flashcards", []))
+        if enrolled:
+            logger.info(f"Enrolled {enrolled} flashcards of document {document_id} for review by {user_id}")
+
+async def drop_deleted_documents(batch: List[dict]) -> List[dict]:
+    """The records of a buffered batch whose document still exists; it may have been deleted while they were buffered or spilled"""
+    document_ids = list({record["document_id"] for record in batch})
+    existing = set(await db.documents.distinct("id", {"id": {"$in": document_ids}}))
+    return [record for record in batch if record["document_id"] in existing]
+
+# Quiz attempts and item analysis
+async def quiz_attempts_flushed(batch: List[dict]):
+    await response_cache.invalidate(*{f"quiz-analytics:{attempt['document_id']}" for attempt in batch})
+
+quiz_attempts_buffer = BulkWriteBuffer(
+    "quiz_attempts", QUIZ_BUFFER_SIZE, QUIZ_FLUSH_INTERVAL_SECONDS, quiz_attempts_flushed, WRITE_SPILL_DIR,
+    drop_deleted_documents
+)
+
+async def chat_messages_flushed(batch: List[dict]):
+    await response_cache.invalidate(*{f"chat-history:{message['document_id']}" for message in batch})
+
+chat_messages_buffer = BulkWriteBuffer(
+    "chat_messages", CHAT_BUFFER_SIZE, CHAT_FLUSH_INTERVAL_SECONDS, chat_messages_flushed, WRITE_SPILL_DIR,
+    drop_deleted_documents
+)
+RECORD_BUFFERS = (quiz_attempts_buffer, chat_messages_buffer)
+
+async def load_quiz_answers(document_id: str) -> Dict[str, list]:
+    """All answers to a document's quiz as columns, one row per answered question"""
+    columns = {"attempt": [], "question_id": [], "selected": [], "correct": []}
+    cursor = db.quiz_attempts.find({"document_id": document_id}, {"_id": 0, "answers": 1}, batch_size=1000)
+    attempt = 0
+    async for record in cursor:
+        for answer in record["answers"]:
+            columns["attempt"].append(attempt)
+            columns["question_id"].append(answer["question_id"])
+            columns["selected"].append(answer["selected"])
+            columns["correct"].append(answer["correct"])
+        attempt += 1
+    return columns
+
+def quiz_item_statistics(columns: Dict[str, list], mcqs: List[dict]) -> dict:
+    """Classical item analysis of a quiz.
+
+    Per question: difficulty (share of correct answers), discrimination (the
+    point-biserial correlation between answering it correctly and the score
+    on the attempt's other questions) and how often each option was picked.
+    """
+    pd = load_pandas()
+    np = load_numpy()
+    answers = pd.DataFrame({
+        "attempt": np.asarray(columns["attempt"], dtype=np.int64),
+        "question_id": pd.Categorical(columns["question_id"]),
+        "selected": np.asarray(columns["selected"], dtype=np.int16),
+        "correct": np.asarray(columns["correct"], dtype=np.int64),
+    })
+    attempts = int(answers["attempt"].nunique())
+
+    stats = pd.DataFrame()
+    option_counts = pd.DataFrame()
+    if attempts:
+        # Pearson correlation from grouped sums; with a 0/1 item this is the point-biserial
+        answers["rest"] = answers.groupby("attempt")["correct"].transform("sum") - answers["correct"]
+        answers["xy"] = answers["correct"] * answers["rest"]
+        answers["yy"] = answers["rest"] ** 2
+        sums = answers.groupby("question_id", observed=True).agg(
+            n=("correct", "size"), x=("correct", "sum"), y=("rest", "sum"), xy=("xy", "sum"), yy=("yy", "sum")
+        ).astype(np.float64)
+        variance = (sums["n"] * sums["x"] - sums["x"] ** 2) * (sums["n"] * sums["yy"] - sums["y"] ** 2)
+        stats = pd.DataFrame({
+            "responses": sums["n"],
+            "difficulty": sums["x"] / sums["n"],
+            "discrimination": ((sums["n"] * sums["xy"] - sums["x"] * sums["y"]) / np.sqrt(variance)).where(variance > 0),
+        })
+        option_counts = answers.groupby(["question_id", "selected"], observed=True).size().unstack(fill_value=0)
+
+    questions = []
+    for mcq in mcqs:
+        question_id = mcq["id"]
+        if question_id not in stats.index:
+            questions.append({"question_id": question_id, "question": mcq["question"], "responses": 0,
+                              "difficulty": None, "discrimination": None, "options": [], "flags": []})
+            continue
+        row = stats.loc[question_id]
+        responses = int(row["responses"])
+        counts = option_counts.loc[question_id] if question_id in option_counts.index else {}
+        options = [
+            {
+                "option": index,
+                "text": text,
+                "correct": index == mcq["correct_answer"],
+                "count": int(counts.get(index, 0)),
+                "frequency": round(int(counts.get(index, 0)) / responses, 4)
+            }
+            for index, text in enumerate(mcq["options"])
+        ]
+        difficulty = float(row["difficulty"])
+        discrimination = None if pd.isna(row["discrimination"]) else round(float(row["discrimination"]), 4)
+
+        flags = []
+        if responses >= QUIZ_MIN_RESPONSES:
+            if difficulty > 0.9:
+                flags.append("too_easy")
+            elif difficulty < 0.3:
+                flags.append("too_hard")
+            key_count = options[mcq["correct_answer"]]["count"] if mcq["correct_answer"] < len(options) else 0
+            if (discrimination is not None and discrimination < 0) or any(
+                    not option["correct"] and option["count"] > key_count for option in options):
+                flags.append("possible_miskey")
+            elif discrimination is not None and discrimination < 0.2:
+                flags.append("low_discrimination")
+            if any(not option["correct"] and option["frequency"] < 0.05 for option in options):
+                flags.append("unused_distractor")
+
+        questions.append({
+            "question_id": question_id,
+            "question": mcq["question"],
+            "responses": responses,
+            "difficulty": round(difficulty, 4),
+            "discrimination": discrimination,
+            "options": options,
+            "flags": flags
+        })
+
+    scores = answers.groupby("attempt")["correct"].sum() if attempts else None
+    return {
+        "attempts": attempts,
+        "mean_score": round(float(scores.mean()), 4) if attempts else None,
+        "questions": questions
+    }
+
+# LLM calls and usage accounting
+LLM_PROVIDER, LLM_MODEL = "openai", "gpt-4o-mini"
+LLM_OUTCOMES = ("ok", "error", "fallback", "rejected")
+
+# Endpoint and document that LLM calls made in the current request are charged to
+llm_usage_scope: ContextVar[dict] = ContextVar("llm_usage_scope", default={})
+
+def set_usage_scope(endpoint: str, document_id: Optional[str] = None):
+    llm_usage_scope.set({"endpoint": endpoint, "document_id": document_id})
+
+def count_tokens(text: str) -> int:
+    """Tokens for accounting: litellm's tokenizer once the LLM client has loaded it, else ~4 characters per token.
+
+    The chat client only returns the completion text, so provider-reported usage is not available.
+    """
+    litellm = sys.modules.get("litellm")
+    if litellm is not None:
+        try:
+            return litellm.token_counter(model=LLM_MODEL, text=text)
+        except Exception:
+            pass
+    return max(1, len(text) // 4)
+
+async def record_llm_usage(purpose: str, outcome: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                           latency: float = 0.0):
+    """Add one LLM call (or a fallback/rejection) to the per-minute rollup of its endpoint, document and model"""
+    scope = llm_usage_scope.get()
+    now = datetime.now(timezone.utc)
+    minute = now.replace(second=0, microsecond=0)
+    document_id = scope.get("document_id")
+    endpoint = scope.get("endpoint", "internal")
+    tokens = prompt_tokens + completion_tokens
+    increments = {f"outcomes.{outcome}": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    maximums = {}
+    if outcome in ("ok", "error"):
+        increments.update({"calls": 1, "latency_ms": round(latency * 1000, 1)})
+        maximums["max_latency_ms"] = round(latency * 1000, 1)
+    if tokens:
+        llm_usage_buffer.count(f"llm-tokens:day:{minute.strftime('%Y-%m-%d')}", tokens, ttl=2 * 86400)
+        if document_id:
+            llm_usage_buffer.count(f"llm-tokens:document:{document_id}", tokens)
+    try:
+        await llm_usage_buffer.add(
+            {"minute": minute, "endpoint": endpoint, "document_id": document_id, "model": LLM_MODEL, "purpose": purpose},
+            increments,
+            maximums,
+            on_insert={"hour": minute.strftime("%Y-%m-%dT%H:00"), "day": minute.strftime("%Y-%m-%d")}
+        )
+    except Exception as e:
+        logging.error(f"Error recording LLM usage: {str(e)}")
+
+async def token_usage(key: str) -> int:
+    """Tokens counted against a budget, including this worker's not yet written to shared state"""
+    return await shared_state.get(key, 0) + llm_usage_buffer.unwritten(key)
+
+async def check_token_budget(purpose: str, estimated_tokens: int, document_id: Optional[str] = None):
+    """Reject work up front (429) if it would take the document or today's total over its token budget"""
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    budgets = [("daily", LLM_DAILY_TOKEN_BUDGET, f"llm-tokens:day:{day}")]
+    if document_id:
+        budgets.append(("document", LLM_DOCUMENT_TOKEN_BUDGET, f"llm-tokens:document:{document_id}"))
+    for name, budget, key in budgets:
+        if not budget:
+            continue
+        used = await token_usage(key)
+        if used + estimated_tokens > budget:
+            await record_llm_usage(purpose, "rejected")
+            raise HTTPException(
+                status_code=429,
+                detail=f"The {name} LLM token budget is exhausted ({used} of {budget} tokens used)"
+            )
+
+llm_usage_buffer = RollupBuffer("llm_usage", LLM_USAGE_BUFFER_SIZE, LLM_USAGE_FLUSH_INTERVAL_SECONDS)
+WRITE_BUFFERS = RECORD_BUFFERS + (llm_usage_buffer,)
+
+def estimate_generation_tokens(count: int) -> int:
+    """Rough prompt plus completion size of one MCQ/flashcard generation, for budget checks"""
+    return GENERATION_CHUNK_CHARS // 4 + 200 + 80 * count
+
+USAGE_DIMENSIONS = ("minute", "hour", "day", "document_id", "endpoint", "model", "purpose")
+
+def usage_cost(prompt_tokens: int, completion_tokens: int) -> float:
+    """Estimated spend in USD at the configured per-million-token prices"""
+    return round((prompt_tokens * LLM_PROMPT_COST_PER_MTOK + completion_tokens * LLM_COMPLETION_COST_PER_MTOK) / 1e6, 6)
+
+async def llm_complete(api_key: str, purpose: str, system_message: str, prompt: str) -> str:
+    """Send one prompt to the chat model; identical concurrent prompts share a single call"""
+    key = hashlib.sha256("\0".join([
+        LLM_PROVIDER, LLM_MODEL, " ".join(system_message.split()), " ".join(prompt.split())
+    ]).encode()).hexdigest()
+    
+    async def call() -> str:
+        LlmChat, UserMessage = load_llm_client()
+        chat = LlmChat(
+            api_key=api_key,
+            session_id=f"{purpose}_{uuid.uuid4()}",
+            system_message=system_message
+        ).with_model(LLM_PROVIDER, LLM_MODEL)
+        prompt_tokens = count_tokens(system_message) + count_tokens(prompt)
+        started = time.perf_counter()
+        try:
+            response = await chat.send_message(UserMessage(text=prompt))
+        except Exception:
+            await record_llm_usage(purpose, "error", prompt_tokens, 0, time.perf_counter() - started)
+            raise
+        await record_llm_usage(purpose, "ok", prompt_tokens, count_tokens(response), time.perf_counter() - started)
+        return response
+    
+    # Coalesced callers share the leader's call, which is only recorded once
+    return await llm_flight.do(key, call)
+
+async def generate_mcqs(content: str, num_questions: int = 10, fallback: bool = True) -> List[MCQuestion]:
+    """Generate multiple choice questions from content using AI
+
+    Without ``fallback``, errors are raised instead of returning a sample question.
+    """
     try:
         # Get API key from environment
         api_key = os.environ.get('EMERGENT_LLM_KEY', os.environ.get('OPENAI_API_KEY'))
         if not api_key:
             raise HTTPException(status_code=500, detail="No API key configured")
         
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"mcq_generation_{uuid.uuid4()}",
-            system_message="You are an expert educational content creator. Generate high-quality multiple choice questions based on the provided content."
-        ).with_model("openai", "gpt-4o-mini")
+        system_message = "You are an expert educational content creator. Generate high-quality multiple choice questions based on the provided content."
         
         prompt = f"""
         Based on the following content, create {num_questions} multiple choice questions. 
@@ -122,13 +2202,12 @@ async def generate_mcqs(content: str, num_questions: int = 10) -> List[MCQuestio
         - explanation: brief explanation of why the answer is correct
         
         Content:
-        {content[:3000]}  # Limit content to avoid token limits
+        {content[:GENERATION_CHUNK_CHARS]}  # Limit content to avoid token limits
         
         Return ONLY the JSON array, no other text.
         """
         
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await llm_complete(api_key, "mcq_generation", system_message, prompt)
         
         # Parse the JSON response
         try:
@@ -167,6 +2246,9 @@ async def generate_mcqs(content: str, num_questions: int = 10) -> List[MCQuestio
             return mcqs
         except (KeyError, TypeError, ValueError) as e:
             logging.error(f"Error processing MCQ data: {str(e)}")
+            if not fallback:
+                raise
+            await record_llm_usage("mcq_generation", "fallback")
             # Fallback: create sample questions if AI response structure is invalid
             return [
                 MCQuestion(
@@ -178,6 +2260,9 @@ async def generate_mcqs(content: str, num_questions: int = 10) -> List[MCQuestio
             ]
     except Exception as e:
         logging.error(f"Error generating MCQs: {str(e)}")
+        if not fallback:
+            raise
+        await record_llm_usage("mcq_generation", "fallback")
         # Return a fallback question
         return [
             MCQuestion(
@@ -188,19 +2273,18 @@ async def generate_mcqs(content: str, num_questions: int = 10) -> List[MCQuestio
             )
         ]
 
-async def generate_flashcards(content: str, num_cards: int = 15) -> List[Flashcard]:
-    """Generate flashcards from content using AI"""
+async def generate_flashcards(content: str, num_cards: int = 15, fallback: bool = True) -> List[Flashcard]:
+    """Generate flashcards from content using AI
+
+    Without ``fallback``, errors are raised instead of returning a sample card.
+    """
     try:
         # Get API key from environment
         api_key = os.environ.get('EMERGENT_LLM_KEY', os.environ.get('OPENAI_API_KEY'))
         if not api_key:
             raise HTTPException(status_code=500, detail="No API key configured")
         
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"flashcard_generation_{uuid.uuid4()}",
-            system_message="You are an expert educational content creator. Generate effective flashcards for studying."
-        ).with_model("openai", "gpt-4o-mini")
+        system_message = "You are an expert educational content creator. Generate effective flashcards for studying."
         
         prompt = f"""
         Based on the following content, create {num_cards} flashcards for studying.
@@ -211,13 +2295,12 @@ async def generate_flashcards(content: str, num_cards: int = 15) -> List[Flashca
         - back: the answer or definition
         
         Content:
-        {content[:3000]}  # Limit content to avoid token limits
+        {content[:GENERATION_CHUNK_CHARS]}  # Limit content to avoid token limits
         
         Return ONLY the JSON array, no other text.
         """
         
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
+        response = await llm_complete(api_key, "flashcard_generation", system_message, prompt)
         
         # Parse the JSON response
         try:
@@ -254,6 +2337,9 @@ async def generate_flashcards(content: str, num_cards: int = 15) -> List[Flashca
             return flashcards
         except (KeyError, TypeError, ValueError) as e:
             logging.error(f"Error processing flashcard data: {str(e)}")
+            if not fallback:
+                raise
+            await record_llm_usage("flashcard_generation", "fallback")
             # Fallback: create sample flashcards
             return [
                 Flashcard(
@@ -263,6 +2349,9 @@ async def generate_flashcards(content: str, num_cards: int = 15) -> List[Flashca
             ]
     except Exception as e:
         logging.error(f"Error generating flashcards: {str(e)}")
+        if not fallback:
+            raise
+        await record_llm_usage("flashcard_generation", "fallback")
         # Return fallback flashcards
         return [
             Flashcard(
@@ -271,40 +2360,554 @@ async def generate_flashcards(content: str, num_cards: int = 15) -> List[Flashca
             )
         ]
 
-async def chat_with_document(document_content: str, user_question: str) -> str:
-    """Chat with document using RAG-like approach"""
+async def chat_with_document(document_content: str, user_question: str, system_prefix: Optional[str] = None) -> str:
+    """Chat with document using RAG-like approach.
+
+    With a digest, ``system_prefix`` is the document's stored system prompt
+    (identical bytes on every call, so provider-side prompt caching applies)
+    and ``document_content`` holds the excerpts picked for this question.
+    """
     try:
         # Get API key from environment
         api_key = os.environ.get('EMERGENT_LLM_KEY', os.environ.get('OPENAI_API_KEY'))
         if not api_key:
             raise HTTPException(status_code=500, detail="No API key configured")
         
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"document_chat_{uuid.uuid4()}",
-            system_message=f"""You are an AI tutor. Answer questions based ONLY on the provided document content. 
+        if system_prefix:
+            system_message = system_prefix
+            user_text = f"Relevant excerpts:\n{document_content}\n\nQuestion: {user_question}"
+        else:
+            system_message = f"""You are an AI tutor. Answer questions based ONLY on the provided document content. 
             If the answer isn't in the document, say so politely.
             
             Document content:
             {document_content[:4000]}"""  # Limit content to avoid token limits
-        ).with_model("openai", "gpt-4o-mini")
-        
-        user_message = UserMessage(text=user_question)
-        response = await chat.send_message(user_message)
+            user_text = user_question
         
-        return response
+        return await llm_complete(api_key, "document_chat", system_message, user_text)
     except Exception as e:
         logging.error(f"Error in chat: {str(e)}")
+        await record_llm_usage("document_chat", "fallback")
         return "I'm sorry, I encountered an error while processing your question. Please try again."
 
+# Document digests
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+# Common words that make poor key terms, on top of the search stopwords
+DIGEST_STOPWORDS = STOPWORDS | frozenset("""
+about after again against all any because been before being between both does during each few
+further here how into just more most other over same some such their them they through under
+until very what when where while who why your using used
+""".split())
+
+def digest_units(document: dict, page_texts: Dict[int, str]) -> List[dict]:
+    """Outline entries for the digest: the document's sections, or even page groups without them"""
+    sections = document.get("sections") or []
+    if sections:
+        # Runs of adjacent sections share an entry once there are too many
+        size = -(-len(sections) // DIGEST_MAX_SECTIONS)
+        units = [
+            {"title": group[0]["title"] if len(group) == 1 else f"{group[0]['title']} to {group[-1]['title']}",
+             "start_page": group[0]["start_page"], "end_page": group[-1]["end_page"]}
+            for group in (sections[i:i + size] for i in range(0, len(sections), size))
+        ]
+    else:
+        numbers = sorted(page_texts)
+        if not numbers:
+            return []
+        size = -(-len(numbers) // DIGEST_MAX_SECTIONS)
+        units = [
+            {"title": f"Pages {group[0]}-{group[-1]}" if len(group) > 1 else f"Page {group[0]}",
+             "start_page": group[0], "end_page": group[-1]}
+            for group in (numbers[i:i + size] for i in range(0, len(numbers), size))
+        ]
+    for unit in units:
+        unit["text"] = "\n".join(
+            text for number, text in page_texts.items() if unit["start_page"] <= number <= unit["end_page"]
+        )
+    return [unit for unit in units if unit["text"].strip()]
+
+def term_candidates(text: str) -> Counter:
+    """Unigrams and adjacent-word bigrams, without stopwords"""
+    words = TOKEN_PATTERN.findall(text.lower())
+    counts = Counter(word for word in words if len(word) > 3 and word not in DIGEST_STOPWORDS)
+    counts.update(
+        f"{first} {second}" for first, second in zip(words, words[1:])
+        if len(first) > 2 and len(second) > 2 and first not in DIGEST_STOPWORDS and second not in DIGEST_STOPWORDS
+    )
+    return counts
+
+def rank_terms(counts: Counter, limit: int, document_frequency: Optional[Counter] = None, units: int = 1) -> List[str]:
+    """Top terms by frequency, or TF-IDF across outline entries; unigrams covered by a chosen bigram are dropped"""
+    def weight(term: str) -> float:
+        return math.log(1 + units / document_frequency[term]) if document_frequency else 1.0
+    scored = sorted(counts.items(), key=lambda item: (-item[1] * weight(item[0]), item[0]))
+    terms = []
+    for term, _ in scored:
+        if any(term in chosen.split() or chosen in term.split() for chosen in terms):
+            continue
+        terms.append(term)
+        if len(terms) == limit:
+            break
+    return terms
+
+def extractive_summary(text: str, terms: List[str], limit: int = DIGEST_SUMMARY_CHARS) -> str:
+    """The sentences that mention the most key terms, in document order, within ``limit`` characters"""
+    text = "\n".join(line for line in text.splitlines() if not CHAPTER_HEADING.match(line))
+    sentences = [" ".join(sentence.split()) for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+    scored = sorted(
+        range(len(sentences)),
+        key=lambda i: (-sum(term in sentences[i].lower() for term in terms), i)
+    )
+    chosen, length = [], 0
+    for index in scored:
+        if length + len(sentences[index]) > limit and chosen:
+            break
+        chosen.append(index)
+        length += len(sentences[index]) + 1
+    return " ".join(sentences[i] for i in sorted(chosen))[:limit]
+
+async def summarize_units(units: List[dict], document_id: str) -> List[str]:
+    """One short LLM summary per outline entry, in a single call; falls back to the extractive summaries"""
+    fallback = [unit["extract"] for unit in units]
+    try:
+        api_key = os.environ.get('EMERGENT_LLM_KEY', os.environ.get('OPENAI_API_KEY'))
+        if not api_key:
+            return fallback
+        await check_token_budget("document_digest", 2 * GENERATION_CHUNK_CHARS // 4 + 100 * len(units), document_id)
+        
+        # The most term-dense sentences of each section, within roughly two generation chunks overall
+        budget = max(400, 2 * GENERATION_CHUNK_CHARS // len(units))
+        sections = "\n\n".join(
+            f"Section {i + 1}: {unit['title']}\n{extractive_summary(unit['text'], unit['key_terms'], budget)}"
+            for i, unit in enumerate(units)
+        )
+        prompt = f"""
+        Summarize each of the following {len(units)} sections of a study document in one or two sentences.
+        
+        Format your response as a JSON array of {len(units)} strings, in the same order as the sections.
+        
+        {sections}
+        
+        Return ONLY the JSON array, no other text.
+        """
+        response = await llm_complete(
+            api_key, "document_digest",
+            "You are an expert educational content creator. Write concise, factual summaries.", prompt
+        )
+        match = re.search(r'(\[.*\])', response, re.DOTALL)
+        summaries = json.loads(match.group(1)) if match else None
+        if not isinstance(summaries, list) or len(summaries) != len(units):
+            raise ValueError("Summary response did not contain one summary per section")
+        return [" ".join(str(summary).split())[:DIGEST_SUMMARY_CHARS] or extract
+                for summary, extract in zip(summaries, fallback)]
+    except Exception as e:
+        logging.warning(f"Using extractive section summaries: {str(e)}")
+        await record_llm_usage("document_digest", "fallback")
+        return fallback
+
+def render_digest_prefix(document: dict, key_terms: List[str], outline: List[dict]) -> str:
+    """The chat system prompt for a document; rendered once and stored so it is byte-identical on every call
+
+    Detail is dropped until the prompt fits DIGEST_PREFIX_TOKENS: first the
+    per-entry key terms, then the summaries are cut to their first sentence,
+    then dropped, and finally trailing outline entries are left out.
+    """
+    header = [
+        "You are an AI tutor. Answer questions based ONLY on the document described below and the excerpts "
+        "sent with each question. If the answer isn't in them, say so politely.",
+        "",
+        f"Document: {document['filename']} ({document.get('page_count') or 'unknown'} pages)",
+        f"Key terms: {', '.join(key_terms)}",
+        "",
+        "Outline:",
+    ]
+    
+    def render(entries: List[dict], terms: bool, summary: Optional[str]) -> str:
+        lines = list(header)
+        for number, entry in enumerate(entries, start=1):
+            lines.append(f"{number}. {entry['title']} (pages {format_page_list(list(range(entry['start_page'], entry['end_page'] + 1)))})")
+            if terms and entry["key_terms"]:
+                lines.append(f"   Key terms: {', '.join(entry['key_terms'])}")
+            if summary == "full":
+                lines.append(f"   Summary: {entry['summary']}")
+            elif summary == "short":
+                lines.append(f"   Summary: {SENTENCE_BOUNDARY.split(entry['summary'], 1)[0]}")
+        if len(entries) < len(outline):
+            lines.append(f"(and {len(outline) - len(entries)} more sections)")
+        return "\n".join(lines)
+    
+    for terms, summary in ((True, "full"), (False, "full"), (False, "short"), (False, None)):
+        prefix = render(outline, terms, summary)
+        if count_tokens(prefix) <= DIGEST_PREFIX_TOKENS:
+            return prefix
+    entries = len(outline)
+    while entries and count_tokens(prefix) > DIGEST_PREFIX_TOKENS:
+        entries -= 1
+        prefix = render(outline[:entries], False, None)
+    return prefix
+
+async def content_pages(document_id: str) -> Dict[int, str]:
+    """Documents uploaded before per-page storage only have the joined text; split it into chunk-sized pseudo-pages"""
+    content = (await db.documents.find_one({"id": document_id}, {"_id": 0, "content": 1}) or {}).get("content") or ""
+    return {number + 1: get_chunk(content, number) for number in range(chunk_count_for(content))} if content else {}
+
+async def build_document_digest(document_id: str):
+    """Background stage: outline, key terms and section summaries for chat prompts"""
+    # A lease per build: two builds queued in this worker must not both run
+    lease = f"{shared_state.owner}:{uuid.uuid4()}"
+    if not await shared_state.try_lock(f"digest-lock:{document_id}", 600, lease):
+        return
+    set_usage_scope("digest", document_id)
+    await shared_state.set(f"digest-status:{document_id}", {"state": "running"}, ttl=86400)
+    try:
+        document = await get_document(document_id, {"_id": 0, "id": 1, "filename": 1, "page_count": 1, "sections": 1})
+        if not document:
+            await shared_state.delete(f"digest-status:{document_id}")
+            return
+        page_texts = await load_pages(document_id) or await content_pages(document_id)
+        
+        units = digest_units(document, page_texts)
+        unit_terms = [term_candidates(unit["text"]) for unit in units]
+        document_frequency = Counter()
+        for counts in unit_terms:
+            document_frequency.update(counts.keys())
+        document_terms = sum(unit_terms, Counter())
+        key_terms = rank_terms(document_terms, DIGEST_KEY_TERMS * 2)
+        for unit, counts in zip(units, unit_terms):
+            unit["key_terms"] = rank_terms(counts, DIGEST_KEY_TERMS, document_frequency, len(units))
+            unit["extract"] = extractive_summary(unit["text"], unit["key_terms"])
+        summaries = await summarize_units(units, document_id) if units else []
+        
+        outline = [
+            {"title": unit["title"], "start_page": unit["start_page"], "end_page": unit["end_page"],
+             "key_terms": unit["key_terms"], "summary": summary}
+            for unit, summary in zip(units, summaries)
+        ]
+        digest = {
+            "document_id": document_id,
+            "key_terms": key_terms,
+            "outline": outline,
+            "prefix": render_digest_prefix(document, key_terms, outline),
+            "created_at": datetime.now(timezone.utc)
+        }
+        await db.document_digests.replace_one({"document_id": document_id}, digest, upsert=True)
+        await shared_state.set(f"digest-status:{document_id}", {"state": "ready"}, ttl=86400)
+        logger.info(f"Built digest for document {document_id}: {len(outline)} outline entries, {len(digest['prefix'])} characters")
+    except Exception as e:
+        logging.error(f"Error building digest for document {document_id}: {str(e)}")
+        await shared_state.set(f"digest-status:{document_id}", {"state": "failed", "error": str(e)}, ttl=86400)
+    finally:
+        await shared_state.unlock(f"digest-lock:{document_id}", lease)
+
+async def queue_document_digest(document_id: str, background_tasks: BackgroundTasks):
+    await shared_state.set(f"digest-status:{document_id}", {"state": "queued"}, ttl=86400)
+    background_tasks.add_task(build_document_digest, document_id)
+
+def best_passage(text: str, terms: set) -> str:
+    """The ~CHAT_EXCERPT_CHARS run of sentences in ``text`` that mentions the question terms most often"""
+    passages, current = [], ""
+    for sentence in SENTENCE_BOUNDARY.split(" ".join(text.split())):
+        if current and len(current) + len(sentence) > CHAT_EXCERPT_CHARS:
+            passages.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        passages.append(current)
+    if not passages:
+        return ""
+    return max(passages, key=lambda passage: sum(token in terms for token in tokenize(passage)))[:CHAT_EXCERPT_CHARS * 2]
+
+async def select_excerpts(document_id: str, question: str, page_scope: Optional[List[int]] = None) -> str:
+    """Passages from the pages that best match the question, in page order
+
+    Pages are ranked with the search index (BM25 impacts of the question terms
+    in this document's page postings), so only the CHAT_EXCERPTS chosen pages
+    are read and scanned for their best passage.
+    """
+    terms = set(tokenize(question))
+    pages = []
+    if terms:
+        document_frequencies = {
+            record["_id"]: record["df"]
+            async for record in db.search_terms.find({"_id": {"$in": list(terms)}})
+        }
+        stats = await db.search_stats.find_one({"_id": "corpus"}) or {"units": 0}
+        scope = set(page_scope or [])
+        scores = Counter()
+        async for posting in db.search_postings.find(
+            {"document_id": document_id, "kind": "page", "term": {"$in": list(terms)}},
+            {"_id": 0, "unit": 1, "term": 1, "impact": 1}
+        ):
+            number = int(posting["unit"].rsplit(":", 1)[1])
+            if scope and number not in scope:
+                continue
+            df = document_frequencies.get(posting["term"], 0)
+            scores[number] += math.log(1 + (stats["units"] - df + 0.5) / (df + 0.5)) * posting["impact"]
+        pages = sorted(number for number, _ in scores.most_common(CHAT_EXCERPTS))
+    if not pages:
+        # No indexed match: start of the scope (or document)
+        pages = (page_scope or [1])[:1]
+    
+    page_texts = await load_pages(document_id, pages)
+    if not page_texts:
+        # Documents from before per-page storage are indexed as a single page of their whole content
+        chunks = await content_pages(document_id)
+        page_texts = dict(sorted(chunks.items(), key=lambda item: -sum(item[1].lower().count(term) for term in terms))[:CHAT_EXCERPTS])
+    return "\n".join(f"[Page {number}] {best_passage(text, terms)}" for number, text in sorted(page_texts.items()))
+
+async def add_study_materials(document_id: str, kind: str, count: int, background_tasks: BackgroundTasks) -> dict:
+    """Generate ``count`` more items of ``kind`` from the first chunk not yet covered and store them"""
+    study_material = await db.study_materials.find_one(
+        {"document_id": document_id},
+        {"_id": 0, "pages": 1, "chunk_count": 1, "coverage": 1}
+    )
+    if not study_material:
+        raise HTTPException(status_code=404, detail="Study materials not found")
+    
+    # Load the text the materials were generated from (the whole document or its page scope)
+    pages = study_material.get("pages")
+    document = await get_document(document_id, {"_id": 0, "id": 1} if pages else {"_id": 0, "content": 1})
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    text = await load_page_text(document_id, pages) if pages else document["content"]
+    
+    # Records created before coverage tracking only ever saw the first chunk
+    chunk_count = study_material.get("chunk_count") or chunk_count_for(text)
+    coverage = study_material.get("coverage", {}).get(kind)
+    covered = set(coverage if coverage is not None else [0])
+    
+    # Claim a chunk before generating, so concurrent requests on any worker fill different chunks
+    uncovered = [i for i in range(chunk_count) if i not in covered]
+    for position, chunk_index in enumerate(uncovered):
+        claim = await db.study_materials.update_one(
+            {"document_id": document_id, f"coverage.{kind}": {"$ne": chunk_index}},
+            {
+                "$addToSet": {f"coverage.{kind}": {"$each": [chunk_index] if coverage is not None else [0, chunk_index]}},
+                "$set": {"chunk_count": chunk_count}
+            }
+        )
+        if claim.matched_count:
+            break
+    else:
+        raise HTTPException(status_code=409, detail=f"All parts of this document are already covered by {kind}")
+    
+    chunk = get_chunk(text, chunk_index)
+    try:
+        # No sample items here: they would be stored and the chunk marked as covered
+        if kind == "mcqs":
+            items = await generate_mcqs(chunk, num_questions=count, fallback=False)
+        else:
+            items = await generate_flashcards(chunk, num_cards=count, fallback=False)
+    except BaseException as e:
+        # Let a later request try this chunk again
+        await db.study_materials.update_one({"document_id": document_id}, {"$pull": {f"coverage.{kind}": chunk_index}})
+        if isinstance(e, Exception) and not isinstance(e, HTTPException):
+            raise HTTPException(status_code=502, detail=f"Could not generate {kind}: {str(e)}")
+        raise
+    item_dicts = [item.dict() for item in items]
+    
+    await db.study_materials.update_one({"document_id": document_id}, {"$push": {kind: {"$each": item_dicts}}})
+    # Quiz analytics list every MCQ, answered or not
+    await response_cache.invalidate(f"study-materials:{document_id}", *([f"quiz-analytics:{document_id}"] if kind == "mcqs" else []))
+    background_tasks.add_task(index_for_search, search_units_for(
+        document_id, {},
+        item_dicts if kind == "mcqs" else [],
+        item_dicts if kind == "flashcards" else []
+    ))
+    logger.info(f"Added {len(item_dicts)} {kind} for chunk {chunk_index + 1}/{chunk_count} of document {document_id}")
+    
+    return {
+        "document_id": document_id,
+        "kind": kind,
+        "chunk": chunk_index,
+        "chunk_count": chunk_count,
+        "remaining_chunks": len(uncovered) - position - 1,
+        kind: item_dicts
+    }
+
+# Library export and import
+# Exported collections and the fields that identify a record, so that
+# importing the same export twice replaces rather than duplicates. Digests and
+# the search index are derived data and are rebuilt after an import.
+EXPORT_COLLECTIONS = {
+    "documents": ("id",),
+    "document_pages": ("document_id", "page"),
+    "archived_documents": ("document_id",),
+    "study_materials": ("document_id",),
+    "chat_messages": ("id",),
+    "flashcard_reviews": ("user_id", "card_id"),
+    "quiz_attempts": ("id",),
+}
+EXPORT_FORMAT, EXPORT_VERSION = "studygenie-export", 1
+# Uncompressed bytes gathered before each compress/decompress step
+EXPORT_CHUNK_BYTES = 256 * 1024
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '500'))
+IMPORT_MAX_LINE_BYTES = int(os.environ.get('IMPORT_MAX_LINE_BYTES', str(64 * 1024 * 1024)))
+
+async def export_library(collections: List[str]) -> AsyncIterator[bytes]:
+    """Gzip-compressed NDJSON: a header line, then one {"collection", "record"} line per record.
+
+    Records are read from the cursors and compressed in EXPORT_CHUNK_BYTES
+    steps, so memory stays flat however large the library is. Records use
+    MongoDB extended JSON, which keeps dates and the archives' binary data intact.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    lines, size = [], 0
+    
+    def compress() -> bytes:
+        nonlocal lines, size
+        data = compressor.compress(b"".join(lines))
+        lines, size = [], 0
+        return data
+    
+    header = {"format": EXPORT_FORMAT, "version": EXPORT_VERSION, "exported_at": datetime.now(timezone.utc), "collections": collections}
+    lines.append(json_util.dumps(header).encode() + b"\n")
+    for collection in collections:
+        async for record in db[collection].find({}, {"_id": 0}):
+            line = json_util.dumps({"collection": collection, "record": record}).encode() + b"\n"
+            lines.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_BYTES:
+                data = compress()
+                if data:
+                    yield data
+    yield compress() + compressor.flush()
+
+async def ndjson_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Lines of a gzip-compressed or plain NDJSON byte stream, holding at most one line in memory"""
+    decompressor = None
+    compressed = None
+    # The unfinished last line, in pieces, so long lines are not copied over and over
+    tail, tail_size = [], 0
+    
+    def inflate(chunk: bytes):
+        # Bounded steps, so a small chunk of highly compressed data cannot expand all at once;
+        # concatenated gzip members are read as one stream
+        nonlocal decompressor
+        while chunk:
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(31)
+            try:
+                yield decompressor.decompress(chunk, EXPORT_CHUNK_BYTES)
+            except zlib.error:
+                raise HTTPException(status_code=400, detail="The import stream is not valid gzip data")
+            chunk = decompressor.unconsumed_tail or decompressor.unused_data
+    
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if compressed is None:
+            compressed = chunk[:1] == b"\x1f"
+            decompressor = zlib.decompressobj(31) if compressed else None
+        for data in (inflate(chunk) if compressed else (chunk,)):
+            lines = data.split(b"\n")
+            if len(lines) > 1:
+                yield b"".join(tail + lines[:1])
+                for line in lines[1:-1]:
+                    yield line
+                tail, tail_size = [], 0
+            tail.append(lines[-1])
+            tail_size += len(lines[-1])
+            if tail_size > IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(status_code=413, detail=f"Import lines are limited to {IMPORT_MAX_LINE_BYTES} bytes")
+    if compressed and not decompressor.eof:
+        raise HTTPException(status_code=400, detail="The import stream ends in the middle of its gzip data")
+    if tail_size:
+        yield b"".join(tail)
+
+async def import_library(chunks: AsyncIterator[bytes]) -> dict:
+    """Upsert the records of an export stream in batches of IMPORT_BATCH_SIZE per collection.
+
+    Each record replaces the one with the same identifying fields, so an
+    import that failed halfway can simply be run again. Returns per-collection
+    counts of new and replaced records and the ids of every document touched.
+    """
+    batches = {collection: [] for collection in EXPORT_COLLECTIONS}
+    counts = {collection: {"inserted": 0, "replaced": 0} for collection in EXPORT_COLLECTIONS}
+    document_ids = set()
+    
+    async def write(collection: str):
+        result = await db[collection].bulk_write(batches[collection], ordered=False)
+        counts[collection]["inserted"] += result.upserted_count
+        counts[collection]["replaced"] += result.matched_count
+        batches[collection] = []
+    
+    header = None
+    number = 0
+    async for line in ndjson_lines(chunks):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            item = json_util.loads(line)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Line {number} is not valid JSON")
+        # Every export starts with a header; several exports may be concatenated
+        if header is None or (isinstance(item, dict) and "format" in item):
+            header = item
+            if not isinstance(header, dict) or header.get("format") != EXPORT_FORMAT:
+                raise HTTPException(status_code=400, detail="Not a StudyGenie export")
+            if header.get("version", 0) > EXPORT_VERSION:
+                raise HTTPException(status_code=400, detail=f"Unsupported export version {header.get('version')}")
+            continue
+        
+        collection = item.get("collection") if isinstance(item, dict) else None
+        record = item.get("record") if collection else None
+        keys = EXPORT_COLLECTIONS.get(collection)
+        # Every record belongs to a document, whose digest and search entries are rebuilt afterwards
+        owner = "id" if collection == "documents" else "document_id"
+        if (not keys or not isinstance(record, dict) or any(key not in record for key in keys)
+                or not isinstance(record.get(owner), str)):
+            raise HTTPException(status_code=400, detail=f"Line {number} is not a record of an exported collection")
+        record.pop("_id", None)
+        batches[collection].append(ReplaceOne({key: record[key] for key in keys}, record, upsert=True))
+        document_ids.add(record[owner])
+        if len(batches[collection]) >= IMPORT_BATCH_SIZE:
+            await write(collection)
+    
+    if header is None:
+        raise HTTPException(status_code=400, detail="The import stream is empty")
+    for collection in EXPORT_COLLECTIONS:
+        if batches[collection]:
+            await write(collection)
+    return {"counts": counts, "document_ids": sorted(document_ids)}
+
 # API Routes
 @api_router.get("/")
 async def root():
     return {"message": "StudyGenie API is running!"}
 
+@api_router.get("/health/live")
+async def liveness():
+    """Liveness probe: the process is up and serving requests"""
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    """Readiness probe: the database is reachable and warm-up has finished"""
+    state = dict(warmup_state)
+    ready = state["database"] == "ready"
+    if PREWARM_ON_STARTUP:
+        ready = ready and state["dependencies"] == "warm"
+    if ready:
+        try:
+            await asyncio.wait_for(db.command("ping"), timeout=2)
+        except Exception as e:
+            state["database"] = f"unreachable: {str(e)}"
+            ready = False
+    return ORJSONResponse({"status": "ready" if ready else "warming", **state}, status_code=200 if ready else 503)
+
 @api_router.post("/upload")
-async def upload_document(file: UploadFile = File(...)):
-    """Upload and process a PDF document"""
+async def upload_document(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    pages: Optional[str] = Form(None),
+    section: Optional[str] = Form(None),
+    generate_diff: bool = Form(False),
+    x_user_id: Optional[str] = Header(None),
+):
+    """Upload and process a PDF document, optionally only a page range or section"""
+    set_usage_scope("upload")
     logger.info(f"Received upload request - filename: {file.filename}, content_type: {file.content_type}")
     
     if not file.filename:
@@ -324,51 +2927,119 @@ async def upload_document(file: UploadFile = File(...)):
             logger.error("Empty file content")
             raise HTTPException(status_code=400, detail="Empty file")
         
-        text_content = extract_text_from_pdf(content)
-        logger.info(f"Text extracted, length: {len(text_content)} characters")
+        async with extraction_slots:
+            extracted = await asyncio.to_thread(extract_pages_from_pdf, content, pages, section)
+        page_texts = extracted["pages"]
+        scoped_pages = extracted["scope"]
+        text_content = "\n".join(page_texts.values()).strip()
+        logger.info(f"Text extracted from {len(page_texts)}/{extracted['page_count']} pages, length: {len(text_content)} characters")
         
         if not text_content.strip():
             logger.error("No text found in PDF")
             raise HTTPException(status_code=400, detail="No text found in PDF")
         
+        # Near-duplicate detection only applies to whole-document uploads
+        signature = None if scoped_pages else await asyncio.to_thread(minhash_signature, text_content)
+        duplicate = await find_near_duplicate(signature) if signature else None
+        original = None
+        if duplicate:
+            original = await db.study_materials.find_one(
+                {"document_id": duplicate["id"]},
+                {"_id": 0, "mcqs": 1, "flashcards": 1, "coverage": 1}
+            )
+            if original is None:
+                # Deleted since the lookup; nothing to reuse
+                duplicate = None
+        changed = await find_changed_pages(duplicate["id"], page_texts) if duplicate and generate_diff else []
+        if not duplicate:
+            await check_token_budget("upload", estimate_generation_tokens(10) + estimate_generation_tokens(15))
+        elif changed:
+            await check_token_budget("upload", estimate_generation_tokens(3) + estimate_generation_tokens(5))
+        
         # Save document to database
         document = Document(
             filename=file.filename,
-            content=text_content
+            content=text_content,
+            page_count=extracted["page_count"],
+            extracted_pages=sorted(page_texts),
+            sections=extracted["sections"],
+            skipped_pages=extracted["skipped_pages"],
+            minhash=signature,
+            lsh_bands=lsh_bands(signature) if signature else []
         )
+        set_usage_scope("upload", document.id)
         
         document_dict = prepare_for_mongo(document.dict())
         await db.documents.insert_one(document_dict)
+        await db.document_pages.insert_many([
+            {"document_id": document.id, "page": number, "text": text}
+            for number, text in page_texts.items()
+        ])
         logger.info(f"Document saved with ID: {document.id}")
         
-        # Generate study materials
-        logger.info("Starting MCQ generation...")
-        mcqs = await generate_mcqs(text_content)
-        logger.info(f"Generated {len(mcqs)} MCQs")
+        # Generate from the requested pages only
+        if scoped_pages:
+            text_content = "\n".join(page_texts[number] for number in scoped_pages if number in page_texts).strip()
         
-        logger.info("Starting flashcard generation...")
-        flashcards = await generate_flashcards(text_content)
-        logger.info(f"Generated {len(flashcards)} flashcards")
+        if duplicate:
+            # Reuse the near-duplicate's materials instead of generating from scratch
+            logger.info(f"Document is {duplicate['similarity']:.0%} similar to {duplicate['id']}, reusing its study materials")
+            mcqs = copy_with_new_ids(original["mcqs"], MCQuestion)
+            flashcards = copy_with_new_ids(original["flashcards"], Flashcard)
+            coverage = original.get("coverage") or {"mcqs": [0], "flashcards": [0]}
+            
+            if changed:
+                changed_text = "\n".join(page_texts[number] for number in changed)
+                logger.info(f"Generating materials for changed pages {format_page_list(changed)}")
+                mcqs += await generate_mcqs(changed_text, num_questions=3)
+                flashcards += await generate_flashcards(changed_text, num_cards=5)
+        else:
+            # Generate study materials
+            logger.info("Starting MCQ generation...")
+            mcqs = await generate_mcqs(text_content)
+            logger.info(f"Generated {len(mcqs)} MCQs")
+            
+            logger.info("Starting flashcard generation...")
+            flashcards = await generate_flashcards(text_content)
+            logger.info(f"Generated {len(flashcards)} flashcards")
+            coverage = {"mcqs": [0], "flashcards": [0]}
         
         # Save study materials
         study_material = StudyMaterial(
             document_id=document.id,
             mcqs=mcqs,
-            flashcards=flashcards
+            flashcards=flashcards,
+            pages=scoped_pages,
+            chunk_count=chunk_count_for(text_content),
+            coverage=coverage,
+            reused_from=duplicate["id"] if duplicate else None
         )
         
         study_material_dict = prepare_for_mongo(study_material.dict())
         await db.study_materials.insert_one(study_material_dict)
+        await response_cache.invalidate("documents", f"study-materials:{document.id}")
         logger.info("Study materials saved to database")
         
-        return {
+        # Index after the response has been sent
+        background_tasks.add_task(index_for_search, search_units_for(
+            document.id, page_texts, study_material_dict["mcqs"], study_material_dict["flashcards"]
+        ))
+        background_tasks.add_task(enroll_flashcards, x_user_id or DEFAULT_USER_ID, document.id, study_material_dict["flashcards"])
+        await queue_document_digest(document.id, background_tasks)
+        
+        return ORJSONResponse({
             "document_id": document.id,
             "filename": file.filename,
+            "page_count": document.page_count,
+            "pages": format_page_list(scoped_pages or document.extracted_pages),
+            "sections": [s.dict() for s in document.sections],
+            "skipped_pages": format_page_list(document.skipped_pages),
             "text_preview": text_content[:200] + "..." if len(text_content) > 200 else text_content,
-            "mcqs": [mcq.dict() for mcq in mcqs],
-            "flashcards": [card.dict() for card in flashcards],
-            "message": "Document processed successfully!"
-        }
+            "mcqs": study_material_dict["mcqs"],
+            "flashcards": study_material_dict["flashcards"],
+            "duplicate_of": duplicate,
+            "message": "Reused study materials from a near-duplicate document" if duplicate else "Document processed successfully!"
+        })
         
     except HTTPException:
         raise
@@ -377,16 +3048,36 @@ async def upload_document(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error processing document: {str(e)}")
 
 @api_router.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, background_tasks: BackgroundTasks):
     """Chat with a specific document"""
     try:
-        # Get document from database
-        document = await db.documents.find_one({"id": request.document_id})
+        # Get document metadata; text is loaded below, only for the pages in scope
+        set_usage_scope("chat", request.document_id)
+        document = await get_document(request.document_id, {"_id": 0, "content": 0})
         if not document:
             raise HTTPException(status_code=404, detail="Document not found")
+        await check_token_budget("document_chat", count_tokens(request.message) + 1500, request.document_id)
         
-        # Get AI response
-        ai_response = await chat_with_document(document['content'], request.message)
+        page_scope = resolve_page_scope(document, request.pages, request.section)
+        # Hot reads when many students open the same document at once; shared results are read-only
+        digest = await read_flight.do(
+            f"digest:{request.document_id}",
+            lambda: db.document_digests.find_one({"document_id": request.document_id}, {"_id": 0, "prefix": 1})
+        )
+        excerpts = await select_excerpts(request.document_id, request.message, page_scope) if digest else ""
+        
+        if excerpts:
+            # Stable digest prefix plus the passages relevant to this question
+            ai_response = await chat_with_document(excerpts, request.message, digest["prefix"])
+        else:
+            if page_scope:
+                document_content = await load_page_text(request.document_id, page_scope)
+            else:
+                document_content = (await db.documents.find_one({"id": request.document_id}, {"_id": 0, "content": 1}))["content"]
+            status = await shared_state.get(f"digest-status:{request.document_id}", {})
+            if not digest and status.get("state") not in ("queued", "running"):
+                await queue_document_digest(request.document_id, background_tasks)
+            ai_response = await chat_with_document(document_content, request.message)
         
         # Save chat message to database
         chat_message = ChatMessage(
@@ -395,8 +3086,12 @@ async def chat_endpoint(request: ChatRequest):
             ai_response=ai_response
         )
         
+        # Written behind; history merges messages that are still buffered
         chat_dict = prepare_for_mongo(chat_message.dict())
-        await db.chat_messages.insert_one(chat_dict)
+        await chat_messages_buffer.add(chat_dict)
+        # This worker's history includes buffered messages right away; the flush
+        # bumps the cache version for the other workers
+        response_cache.discard(f"chat-history:{request.document_id}")
         
         return ChatResponse(response=ai_response)
         
@@ -407,35 +3102,358 @@ async def chat_endpoint(request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"Error in chat: {str(e)}")
 
 @api_router.get("/documents")
-async def get_documents():
+async def get_documents(request: Request):
     """Get all uploaded documents"""
-    documents = await db.documents.find().to_list(1000)
-    return [{"id": doc["id"], "filename": doc["filename"], "upload_time": doc["upload_time"]} for doc in documents]
+    async def load():
+        return await db.documents.find(
+            {}, {"_id": 0, "id": 1, "filename": 1, "upload_time": 1}
+        ).to_list(1000)
+    
+    return await cached_json_response(request, "documents", load)
+
+@api_router.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
+    """Delete a document together with its pages, archive, study materials and chat history"""
+    result = await db.documents.delete_one({"id": document_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    deleted = {"documents": 1}
+    # Records of the document still buffered or spilled are dropped when they are written
+    # (drop_deleted_documents); a batch being written now may have been checked before the
+    # delete, so the cascade below waits for it
+    for buffer in RECORD_BUFFERS:
+        buffer.discard(lambda record: record["document_id"] == document_id)
+        await buffer.wait_for_writes()
+    for collection in ("document_pages", "archived_documents", "study_materials", "chat_messages", "flashcard_reviews", "quiz_attempts", "document_digests"):
+        deleted[collection] = (await db[collection].delete_many({"document_id": document_id})).deleted_count
+    await remove_from_search_index(document_id)
+    await shared_state.delete(f"digest-status:{document_id}")
+    llm_usage_buffer.discard_counter(f"llm-tokens:document:{document_id}")
+    await shared_state.delete(f"llm-tokens:document:{document_id}")
+    _last_touched.discard(lambda key: key == document_id)
+    _last_enrolled.discard(lambda key: key[1] == document_id)
+    await response_cache.invalidate("documents", f"study-materials:{document_id}", f"chat-history:{document_id}", f"quiz-analytics:{document_id}")
+    logger.info(f"Deleted document {document_id}: {deleted}")
+    
+    return {"message": "Document deleted", "document_id": document_id, "deleted": deleted}
+
+@api_router.get("/search")
+async def search_library(q: str, limit: int = 10, kind: Optional[Literal["page", "mcq", "flashcard"]] = None, document_id: Optional[str] = None):
+    """Full-text search over document pages, MCQs and flashcards, ranked with BM25"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Query must not be empty")
+    started = time.perf_counter()
+    results = await search_index(q, limit=max(1, min(limit, 50)), kind=kind, document_id=document_id)
+    return {
+        "query": q,
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+@api_router.get("/documents/{document_id}/sections")
+async def get_document_sections(document_id: str):
+    """Get the page count and detected chapters/sections of a document"""
+    document = await db.documents.find_one(
+        {"id": document_id},
+        {"_id": 0, "id": 1, "filename": 1, "page_count": 1, "extracted_pages": 1, "sections": 1}
+    )
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    return {
+        "document_id": document["id"],
+        "filename": document["filename"],
+        "page_count": document.get("page_count", 0),
+        "extracted_pages": format_page_list(document.get("extracted_pages", [])),
+        "sections": document.get("sections", [])
+    }
+
+@api_router.get("/documents/{document_id}/digest")
+async def get_document_digest(document_id: str):
+    """The document's outline, key terms and section summaries, or the status of the job building them"""
+    digest = await db.document_digests.find_one({"document_id": document_id}, {"_id": 0})
+    if digest:
+        return {"document_id": document_id, "state": "ready", **digest}
+    if not await db.documents.find_one({"id": document_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Document not found")
+    status = await shared_state.get(f"digest-status:{document_id}", {"state": "missing"})
+    return {"document_id": document_id, **status}
 
 @api_router.get("/study-materials/{document_id}")
-async def get_study_materials(document_id: str):
+async def get_study_materials(document_id: str, request: Request, background_tasks: BackgroundTasks, x_user_id: Optional[str] = Header(None)):
     """Get study materials for a specific document"""
-    study_material = await db.study_materials.find_one({"document_id": document_id})
-    if not study_material:
-        raise HTTPException(status_code=404, detail="Study materials not found")
+    async def load():
+        study_material = await db.study_materials.find_one({"document_id": document_id}, {"_id": 0})
+        if not study_material:
+            raise HTTPException(status_code=404, detail="Study materials not found")
+        
+        return study_material
     
-    # Remove MongoDB ObjectId to make it JSON serializable
-    if '_id' in study_material:
-        del study_material['_id']
+    response = await cached_json_response(request, f"study-materials:{document_id}", load)
+    await touch_document(document_id)
+    background_tasks.add_task(enroll_document_flashcards, x_user_id or DEFAULT_USER_ID, document_id)
+    return response
+
+@api_router.post("/study-materials/{document_id}/more")
+async def generate_more_study_materials(document_id: str, request: MoreMaterialsRequest, background_tasks: BackgroundTasks, x_user_id: Optional[str] = Header(None)):
+    """Generate extra MCQs or flashcards from a part of the document not yet covered"""
+    set_usage_scope("more", document_id)
+    purpose = "mcq_generation" if request.kind == "mcqs" else "flashcard_generation"
+    await check_token_budget(purpose, estimate_generation_tokens(request.count), document_id)
     
-    return study_material
+    # Identical concurrent requests would otherwise all pick, and fill, the same chunk
+    result = await generation_flight.do(
+        f"more:{document_id}:{request.kind}:{request.count}",
+        lambda: add_study_materials(document_id, request.kind, request.count, background_tasks)
+    )
+    if request.kind == "flashcards":
+        background_tasks.add_task(enroll_flashcards, x_user_id or DEFAULT_USER_ID, document_id, result["flashcards"])
+    
+    return ORJSONResponse(result)
 
 @api_router.get("/chat-history/{document_id}")
-async def get_chat_history(document_id: str):
+async def get_chat_history(document_id: str, request: Request):
     """Get chat history for a specific document"""
-    chat_messages = await db.chat_messages.find({"document_id": document_id}).to_list(1000)
+    async def load():
+        messages = await db.chat_messages.find({"document_id": document_id}, {"_id": 0}).to_list(1000)
+        stored = {message["id"] for message in messages}
+        buffered = chat_messages_buffer.buffered(lambda message: message["document_id"] == document_id)
+        return messages + [
+            {key: value for key, value in message.items() if key != "_id"}
+            for message in buffered if message["id"] not in stored
+        ]
+    
+    return await cached_json_response(request, f"chat-history:{document_id}", load)
+
+@api_router.get("/review/due")
+async def get_due_cards(limit: int = 20, document_id: Optional[str] = None, x_user_id: Optional[str] = Header(None)):
+    """Flashcards due for review, most overdue first (an index range scan on due_at)"""
+    user_id = x_user_id or DEFAULT_USER_ID
+    now = datetime.now(timezone.utc)
+    limit = max(1, min(limit, 200))
+    query = {"user_id": user_id, "due_at": {"$lte": now}}
+    if document_id:
+        query["document_id"] = document_id
+
+    cards = await db.flashcard_reviews.find(query, {"_id": 0}).sort("due_at", 1).limit(limit).to_list(limit)
+    return {"user_id": user_id, "now": now, "cards": cards}
+
+@api_router.post("/review/{card_id}")
+async def review_card(card_id: str, request: ReviewRequest, x_user_id: Optional[str] = Header(None)):
+    """Grade a flashcard (SM-2 quality 0-5) and schedule its next review"""
+    user_id = x_user_id or DEFAULT_USER_ID
+    review = await db.flashcard_reviews.find_one({"user_id": user_id, "card_id": card_id}, {"_id": 0})
+    if not review:
+        # Cards can be reviewed before the enrollment background task has run
+        study_material = await db.study_materials.find_one(
+            {"flashcards.id": card_id},
+            {"_id": 0, "document_id": 1, "flashcards": {"$elemMatch": {"id": card_id}}}
+        )
+        if not study_material:
+            raise HTTPException(status_code=404, detail="Flashcard not found")
+        await enroll_flashcards(user_id, study_material["document_id"], study_material["flashcards"])
+        review = await db.flashcard_reviews.find_one({"user_id": user_id, "card_id": card_id}, {"_id": 0})
+
+    updates = sm2_schedule(review, request.quality, datetime.now(timezone.utc))
+    return await db.flashcard_reviews.find_one_and_update(
+        {"user_id": user_id, "card_id": card_id},
+        {"$set": updates},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+@api_router.post("/quiz/{document_id}/attempts")
+async def submit_quiz_attempt(document_id: str, request: QuizAttemptRequest, x_user_id: Optional[str] = Header(None)):
+    """Grade a batch of MCQ answers and record them as one quiz attempt"""
+    study_material = await db.study_materials.find_one(
+        {"document_id": document_id},
+        {"_id": 0, "mcqs.id": 1, "mcqs.options": 1, "mcqs.correct_answer": 1}
+    )
+    if not study_material:
+        raise HTTPException(status_code=404, detail="Study materials not found")
+    questions = {mcq["id"]: mcq for mcq in study_material.get("mcqs", [])}
+
+    answers = []
+    for answer in request.answers:
+        mcq = questions.get(answer.question_id)
+        if mcq is None:
+            raise HTTPException(status_code=400, detail=f"Unknown question: {answer.question_id}")
+        if answer.selected >= len(mcq["options"]):
+            raise HTTPException(status_code=400, detail=f"Invalid option {answer.selected} for question {answer.question_id}")
+        answers.append({
+            "question_id": answer.question_id,
+            "selected": answer.selected,
+            "correct": answer.selected == mcq["correct_answer"]
+        })
+    if len({answer["question_id"] for answer in answers}) != len(answers):
+        raise HTTPException(status_code=400, detail="Each question can only be answered once per attempt")
+
+    attempt = QuizAttempt(
+        document_id=document_id,
+        user_id=x_user_id or DEFAULT_USER_ID,
+        answers=answers,
+        score=sum(answer["correct"] for answer in answers)
+    )
+    await quiz_attempts_buffer.add(prepare_for_mongo(attempt.dict()))
+
+    return {
+        "attempt_id": attempt.id,
+        "score": attempt.score,
+        "total": len(answers),
+        "results": [
+            {**answer, "correct_answer": questions[answer["question_id"]]["correct_answer"]}
+            for answer in answers
+        ]
+    }
+
+@api_router.get("/quiz/{document_id}/analytics")
+async def get_quiz_analytics(document_id: str, request: Request):
+    """Per-question difficulty, discrimination and distractor statistics over all recorded attempts"""
+    async def load():
+        study_material = await db.study_materials.find_one(
+            {"document_id": document_id},
+            {"_id": 0, "mcqs.id": 1, "mcqs.question": 1, "mcqs.options": 1, "mcqs.correct_answer": 1}
+        )
+        if not study_material:
+            raise HTTPException(status_code=404, detail="Study materials not found")
+        columns = await load_quiz_answers(document_id)
+        analytics = await asyncio.to_thread(quiz_item_statistics, columns, study_material.get("mcqs", []))
+        return {"document_id": document_id, **analytics}
+
+    return await cached_json_response(request, f"quiz-analytics:{document_id}", load)
+
+@api_router.get("/admin/coalescing")
+async def get_coalescing_metrics():
+    """How many LLM calls, generations and reads this worker coalesced into shared in-flight work"""
+    return {
+        "worker": shared_state.owner,
+        "groups": {flight.name: flight.stats() for flight in SINGLE_FLIGHTS}
+    }
+
+@api_router.get("/admin/usage")
+async def get_llm_usage(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    group_by: str = "day",
+    document_id: Optional[str] = None,
+    endpoint: Optional[str] = None
+):
+    """LLM calls, tokens, latency, outcomes and estimated cost, aggregated from the per-minute rollups.
+
+    ``group_by`` is a comma separated list of minute, hour, day, document_id,
+    endpoint, model and purpose; the default window is the last 24 hours.
+    """
+    dimensions = [dimension.strip() for dimension in group_by.split(",") if dimension.strip()]
+    unknown = set(dimensions) - set(USAGE_DIMENSIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot group usage by: {', '.join(sorted(unknown))}")
+    until = until or datetime.now(timezone.utc)
+    since = since or until - timedelta(days=1)
+    # Naive timestamps are taken to be UTC, like everything stored
+    since, until = (value if value.tzinfo else value.replace(tzinfo=timezone.utc) for value in (since, until))
+    
+    match = {"minute": {"$gte": since, "$lt": until}}
+    if document_id:
+        match["document_id"] = document_id
+    if endpoint:
+        match["endpoint"] = endpoint
+    try:
+        await llm_usage_buffer.flush()
+    except Exception as e:
+        logging.error(f"Error flushing buffered LLM usage: {str(e)}")
+    group = {
+        "_id": {dimension: f"${dimension}" for dimension in dimensions},
+        "calls": {"$sum": "$calls"},
+        "prompt_tokens": {"$sum": "$prompt_tokens"},
+        "completion_tokens": {"$sum": "$completion_tokens"},
+        "latency_ms": {"$sum": "$latency_ms"},
+        "max_latency_ms": {"$max": "$max_latency_ms"},
+        **{outcome: {"$sum": f"$outcomes.{outcome}"} for outcome in LLM_OUTCOMES}
+    }
+    groups = await db.llm_usage.aggregate([{"$match": match}, {"$group": group}]).to_list(None)
     
-    # Remove MongoDB ObjectId from each message to make them JSON serializable
-    for message in chat_messages:
-        if '_id' in message:
-            del message['_id']
+    rows = []
+    for item in groups:
+        row = dict(item["_id"] or {})
+        row.update({
+            "calls": item["calls"],
+            "prompt_tokens": item["prompt_tokens"],
+            "completion_tokens": item["completion_tokens"],
+            "total_tokens": item["prompt_tokens"] + item["completion_tokens"],
+            "avg_latency_ms": round(item["latency_ms"] / item["calls"], 1) if item["calls"] else None,
+            "max_latency_ms": item["max_latency_ms"],
+            "outcomes": {outcome: item[outcome] for outcome in LLM_OUTCOMES},
+            "cost_usd": usage_cost(item["prompt_tokens"], item["completion_tokens"])
+        })
+        rows.append(row)
+    # Time series in time order, everything else biggest spender first
+    if {"minute", "hour", "day"} & set(dimensions):
+        rows.sort(key=lambda row: tuple(str(row.get(dimension)) for dimension in dimensions))
+    else:
+        rows.sort(key=lambda row: -row["total_tokens"])
+    
+    totals = {field: sum(row[field] for row in rows) for field in ("calls", "prompt_tokens", "completion_tokens", "total_tokens")}
+    totals["outcomes"] = {outcome: sum(row["outcomes"][outcome] for row in rows) for outcome in LLM_OUTCOMES}
+    totals["cost_usd"] = usage_cost(totals["prompt_tokens"], totals["completion_tokens"])
+    
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    budgets = {"daily": {"budget": LLM_DAILY_TOKEN_BUDGET or None, "used": await token_usage(f"llm-tokens:day:{day}")}}
+    if document_id:
+        budgets["document"] = {
+            "budget": LLM_DOCUMENT_TOKEN_BUDGET or None,
+            "used": await token_usage(f"llm-tokens:document:{document_id}")
+        }
     
-    return chat_messages
+    return {"since": since, "until": until, "group_by": dimensions, "totals": totals, "rows": rows, "budgets": budgets}
+
+@api_router.get("/export")
+async def export_documents(collections: Optional[str] = None):
+    """Stream the library (documents, pages, study materials, chat history, reviews, quiz attempts) as gzip-compressed NDJSON
+
+    ``collections`` optionally limits the export to a comma separated subset.
+    """
+    requested = {collection.strip() for collection in collections.split(",") if collection.strip()} if collections else set(EXPORT_COLLECTIONS)
+    unknown = requested - set(EXPORT_COLLECTIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot export: {', '.join(sorted(unknown))}")
+    
+    # Include chat messages and quiz attempts that are still buffered
+    for buffer in RECORD_BUFFERS:
+        try:
+            await buffer.flush()
+        except Exception as e:
+            logging.error(f"Error flushing buffered {buffer.collection} before export: {str(e)}")
+    filename = f"studygenie-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.ndjson.gz"
+    return StreamingResponse(
+        export_library([collection for collection in EXPORT_COLLECTIONS if collection in requested]),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.post("/import")
+async def import_documents(request: Request, background_tasks: BackgroundTasks):
+    """Import an /api/export stream, sent as the raw request body (gzip-compressed or plain NDJSON)
+
+    Records replace those with the same ids, so re-running an import is safe.
+    """
+    result = await import_library(request.stream())
+    document_ids = result["document_ids"]
+    
+    # Digests and search entries are rebuilt from the imported content
+    for start in range(0, len(document_ids), IMPORT_BATCH_SIZE):
+        batch = document_ids[start:start + IMPORT_BATCH_SIZE]
+        await db.document_digests.delete_many({"document_id": {"$in": batch}})
+        await shared_state.delete_many([f"digest-status:{document_id}" for document_id in batch])
+        await response_cache.invalidate_many([
+            f"{prefix}:{document_id}" for document_id in batch
+            for prefix in ("study-materials", "chat-history", "quiz-analytics")
+        ])
+    await response_cache.invalidate("documents")
+    background_tasks.add_task(reindex_documents, document_ids)
+    logger.info(f"Imported {len(document_ids)} documents: {result['counts']}")
+    
+    return {"message": "Import complete", "documents": len(document_ids), "counts": result["counts"]}
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -455,10 +3473,64 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+def default_worker_count() -> int:
+    """WEB_CONCURRENCY if set, otherwise the CPUs this process may run on"""
+    if os.environ.get('WEB_CONCURRENCY'):
+        return int(os.environ['WEB_CONCURRENCY'])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-if __name__ == "__main__":
+def run_production(host: str, port: int, workers: int):
+    """Run uvicorn with one worker per CPU and settings tuned for sitting behind a load balancer"""
     import uvicorn
-    uvicorn.run("server:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    # Workers are separate processes; give them a node-local state tier on tmpfs by default
+    shm = Path("/dev/shm")
+    os.environ.setdefault(
+        'SHARED_STATE_LOCAL_PATH',
+        str((shm if shm.is_dir() else Path(tempfile.gettempdir())) / f"studygenie-state-{port}.sqlite")
+    )
+    uvicorn.run(
+        "server:app",
+        host=host,
+        port=port,
+        workers=workers,
+        # Longer than the usual 60s load balancer idle timeout so the LB closes first
+        timeout_keep_alive=int(os.environ.get('KEEP_ALIVE_SECONDS', '75')),
+        backlog=int(os.environ.get('LISTEN_BACKLOG', '2048')),
+        timeout_graceful_shutdown=int(os.environ.get('GRACEFUL_SHUTDOWN_SECONDS', '30')),
+        access_log=os.environ.get('ACCESS_LOG', '').lower() in ('1', 'true', 'yes'),
+    )
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="StudyGenie API server")
+    parser.add_argument("--production", action="store_true",
+                        help="run multiple workers without auto-reload")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes in production mode (default: CPU count)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get('PORT', '8001')))
+    parser.add_argument("--migrate-datetimes", action="store_true",
+                        help="convert ISO-string datetimes from older versions to BSON dates and exit")
+    parser.add_argument("--reindex-search", action="store_true",
+                        help="rebuild the full-text search index from all documents and exit")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="import all lazily loaded dependencies and exit (e.g. while building an image)")
+    args = parser.parse_args()
+
+    if args.prewarm:
+        prewarm()
+    elif args.migrate_datetimes:
+        connect_database()
+        result = asyncio.run(migrate_iso_datetimes(db))
+        print(", ".join(f"{name}: {count} migrated" for name, count in result.items()))
+    elif args.reindex_search:
+        connect_database()
+        print(f"Indexed {asyncio.run(reindex_all_documents())} documents")
+    elif args.production:
+        run_production(args.host, args.port, args.workers or default_worker_count())
+    else:
+        import uvicorn
+        uvicorn.run("server:app", host=args.host, port=args.port, reload=True)
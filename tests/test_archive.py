@@ -0,0 +1,40 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def test_archive_skips_document_accessed_since_scan(db):
+    async def scenario():
+        stale = datetime.now(timezone.utc) - timedelta(days=100)
+        cutoff = datetime.now(timezone.utc) - timedelta(days=30)
+        await db.documents.insert_one({"id": "a", "content": "text", "last_accessed": stale})
+        await db.document_pages.insert_one({"document_id": "a", "page": 1, "text": "text"})
+        scanned = await db.documents.find_one({"id": "a"}, {"_id": 0})
+
+        # Touched between the scan and the archive step
+        await db.documents.update_one({"id": "a"}, {"$set": {"last_accessed": datetime.now(timezone.utc)}})
+        assert not await server.archive_document(scanned, cutoff)
+        assert await db.document_pages.count_documents({}) == 1
+        assert await db.archived_documents.count_documents({}) == 0
+        assert (await db.documents.find_one({"id": "a"}))["content"] == "text"
+
+    asyncio.run(scenario())
+
+
+def test_archive_and_rehydrate_round_trip(db):
+    async def scenario():
+        stale = datetime.now(timezone.utc) - timedelta(days=100)
+        await db.documents.insert_one({"id": "a", "content": "text", "last_accessed": stale})
+        await db.document_pages.insert_one({"document_id": "a", "page": 1, "text": "page one"})
+        document = await db.documents.find_one({"id": "a"}, {"_id": 0})
+
+        assert await server.archive_document(document, datetime.now(timezone.utc) - timedelta(days=30))
+        assert await db.document_pages.count_documents({}) == 0
+        assert "content" not in await db.documents.find_one({"id": "a"})
+
+        await server.rehydrate_document("a")
+        assert (await db.documents.find_one({"id": "a"}))["content"] == "text"
+        assert (await db.document_pages.find_one({"document_id": "a"}))["text"] == "page one"
+
+    asyncio.run(scenario())
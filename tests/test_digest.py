@@ -0,0 +1,111 @@
+import asyncio
+
+import server
+
+
+def outline_entry(number):
+    return {
+        "title": f"Chapter {number}: Thermodynamics and entropy",
+        "start_page": number * 10 + 1,
+        "end_page": number * 10 + 10,
+        "key_terms": ["entropy", "kinetic energy", "momentum", "heat engines", "equilibrium"],
+        "summary": "Entropy measures disorder and grows in isolated systems. " * 4,
+    }
+
+
+def test_digest_prefix_fits_token_budget():
+    document = {"filename": "physics.pdf", "page_count": 400}
+    outline = [outline_entry(number) for number in range(24)]
+    prefix = server.render_digest_prefix(document, ["entropy", "momentum"], outline)
+    assert server.count_tokens(prefix) <= server.DIGEST_PREFIX_TOKENS
+    assert "Outline:" in prefix and "1. Chapter 0" in prefix
+
+
+def test_small_digest_prefix_keeps_full_detail():
+    prefix = server.render_digest_prefix({"filename": "a.pdf", "page_count": 20}, ["entropy"], [outline_entry(0)])
+    assert "Key terms: entropy, kinetic energy" in prefix
+    assert prefix.count("Entropy measures disorder") == 4
+
+
+def test_digest_units_merge_adjacent_sections():
+    sections = [{"title": f"Chapter {i}", "start_page": i, "end_page": i} for i in range(1, 31)]
+    page_texts = {i: f"text of page {i}" for i in range(1, 31)}
+    units = server.digest_units({"sections": sections}, page_texts)
+    assert len(units) <= server.DIGEST_MAX_SECTIONS
+    assert units[0]["title"] == "Chapter 1 to Chapter 3"
+    assert [unit["start_page"] for unit in units] == list(range(1, 31, 3))
+
+
+def test_chat_excerpts_come_from_the_best_indexed_pages(db):
+    page_texts = {
+        1: "Supply and demand set prices in a market economy.",
+        2: "Entropy always increases in an isolated system. Heat flows from hot to cold.",
+        3: "Momentum is conserved when no external force acts.",
+    }
+
+    async def scenario():
+        await db.document_pages.insert_many(
+            [{"document_id": "doc", "page": number, "text": text} for number, text in page_texts.items()]
+        )
+        await server.index_for_search(server.search_units_for("doc", page_texts, [], []))
+
+        excerpts = await server.select_excerpts("doc", "Why does entropy increase?")
+        assert excerpts.startswith("[Page 2] Entropy always increases")
+        assert "[Page 1]" not in excerpts
+
+        # Out-of-scope matches are ignored; the start of the scope is used instead
+        assert (await server.select_excerpts("doc", "entropy", [3])).startswith("[Page 3] Momentum")
+
+    asyncio.run(scenario())
+
+
+def test_digest_lease_admits_one_build_per_document_within_a_worker(db, monkeypatch):
+    started, release = asyncio.Event(), asyncio.Event()
+    builds = []
+
+    async def summarize_units(units, document_id):
+        builds.append(document_id)
+        started.set()
+        await release.wait()
+        return [unit["extract"] for unit in units]
+    monkeypatch.setattr(server, "summarize_units", summarize_units)
+
+    async def scenario():
+        await db.documents.insert_one({"id": "doc", "filename": "a.pdf", "page_count": 1})
+        await db.document_pages.insert_one({"document_id": "doc", "page": 1, "text": "Entropy grows in isolated systems."})
+        first = asyncio.create_task(server.build_document_digest("doc"))
+        await started.wait()
+        # Same worker, second build: must not run alongside the first
+        await asyncio.wait_for(server.build_document_digest("doc"), 5)
+        assert builds == ["doc"]
+        release.set()
+        await first
+        assert await db.document_digests.count_documents({"document_id": "doc"}) == 1
+        assert await db.shared_state.find_one({"_id": "digest-lock:doc"}) is None
+    asyncio.run(scenario())
+
+
+def test_unlock_leaves_a_lease_taken_over_by_someone_else(db):
+    async def scenario():
+        assert await server.shared_state.try_lock("lease", 60, "build-1")
+        assert not await server.shared_state.try_lock("lease", 60, "build-2")
+        assert await server.shared_state.try_lock("lease", 60, "build-1")
+        await server.shared_state.unlock("lease", "build-2")
+        assert not await server.shared_state.try_lock("lease", 60, "build-2")
+        await server.shared_state.unlock("lease", "build-1")
+        assert await server.shared_state.try_lock("lease", 60, "build-2")
+    asyncio.run(scenario())
+
+
+def test_fake_llm_answers_the_summary_prompt(db, monkeypatch):
+    from benchmarks.fake_llm import FakeLlmChat, FakeLlmConfig, FakeUserMessage
+    FakeLlmChat.configure(FakeLlmConfig(distribution="fixed", latency=0, tokens_per_second=0))
+    monkeypatch.setattr(server, "load_llm_client", lambda: (FakeLlmChat, FakeUserMessage))
+    monkeypatch.setenv("OPENAI_API_KEY", "benchmark")
+    units = [
+        {"title": f"Chapter {i}", "text": "Flashcards and multiple choice questions about entropy.",
+         "key_terms": ["entropy"], "extract": "extract"}
+        for i in range(3)
+    ]
+    summaries = asyncio.run(server.summarize_units(units, "doc"))
+    assert summaries == [f"Section {i + 1} summarized by the fake LLM provider." for i in range(3)]
@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import server
+from benchmarks.make_corpus import build_variant
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"other", W/"abc"', True),
+    ('*', True),
+    ('"other"', False),
+    ('W/"other"', False),
+])
+def test_etag_matches(header, matches):
+    assert server.etag_matches(header, '"abc"') is matches
+
+
+async def fake_llm(api_key, purpose, system_message, prompt):
+    if purpose == "mcq_generation":
+        return json.dumps([{
+            "question": "What does photosynthesis produce?", "options": ["Glucose", "Nitrogen", "Iron", "Salt"],
+            "correct_answer": 0, "explanation": "Light energy is stored as glucose."
+        }])
+    if purpose == "flashcard_generation":
+        return json.dumps([{"front": "Chlorophyll", "back": "The pigment that absorbs light"}])
+    raise RuntimeError("not needed here")
+
+
+def test_cached_gets_answer_304_until_the_data_changes(db, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(server, "llm_complete", fake_llm)
+    monkeypatch.setattr(server, "PDF_EXTRACTION_ISOLATION", "inline")
+
+    async def upload(client, variant):
+        files = {"file": (f"notes-{variant}.pdf", build_variant("medium", variant), "application/pdf")}
+        response = await client.post("/api/upload", files=files)
+        assert response.status_code == 200, response.text
+        return response.json()["document_id"]
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = await client.get("/api/documents")
+            assert first.status_code == 200 and first.json() == []
+            etag = first.headers["etag"]
+            cached = await client.get("/api/documents", headers={"If-None-Match": etag})
+            assert cached.status_code == 304 and cached.content == b""
+            assert cached.headers["etag"] == etag
+            assert (await client.get("/api/documents", headers={"If-None-Match": f"W/{etag}"})).status_code == 304
+
+            document_id = await upload(client, 1)
+            listed = await client.get("/api/documents", headers={"If-None-Match": etag})
+            assert listed.status_code == 200
+            assert [document["id"] for document in listed.json()] == [document_id]
+            assert listed.headers["etag"] != etag
+
+            path = f"/api/study-materials/{document_id}"
+            materials = await client.get(path)
+            etag = materials.headers["etag"]
+            assert (await client.get(path, headers={"If-None-Match": etag})).status_code == 304
+            more = await client.post(f"{path}/more", json={"kind": "mcqs", "count": 1})
+            assert more.status_code == 200, more.text
+            changed = await client.get(path, headers={"If-None-Match": etag})
+            assert changed.status_code == 200
+            assert changed.headers["etag"] != etag
+            assert len(changed.json()["mcqs"]) == len(materials.json()["mcqs"]) + 1
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+import asyncio
+import gzip
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+from bson import Binary, json_util
+from fastapi import HTTPException
+
+import server
+
+TIMESTAMP = datetime(2026, 3, 1, 12, 30, tzinfo=timezone.utc)
+
+LIBRARY = {
+    "documents": [{"id": "doc-1", "filename": "notes.pdf", "upload_date": TIMESTAMP}],
+    "document_pages": [{"document_id": "doc-1", "page": page, "text": f"Page {page}"} for page in (1, 2)],
+    "archived_documents": [{"document_id": "doc-1", "content": Binary(b"\x00compressed\xff")}],
+    "study_materials": [{"document_id": "doc-1", "mcqs": [], "flashcards": [{"id": "card-1", "front": "Q", "back": "A"}]}],
+    "chat_messages": [{"id": "msg-1", "document_id": "doc-1", "message": "Hi", "timestamp": TIMESTAMP}],
+    "flashcard_reviews": [{"user_id": "anonymous", "card_id": "card-1", "document_id": "doc-1", "due_at": TIMESTAMP}],
+    "quiz_attempts": [{"id": "attempt-1", "document_id": "doc-1", "answers": [], "timestamp": TIMESTAMP}],
+}
+
+
+async def chunks(data: bytes, size: int = 1000):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def dump(database):
+    """Every exported collection as sorted extended JSON, so bytes and Binary(subtype 0) compare equal"""
+    library = {}
+    for collection in server.EXPORT_COLLECTIONS:
+        records = await database[collection].find({}, {"_id": 0}).to_list(None)
+        library[collection] = sorted(json_util.dumps(record) for record in records)
+    return library
+
+
+def test_export_delete_import_round_trip(db):
+    async def scenario():
+        for collection, records in LIBRARY.items():
+            await db[collection].insert_many([dict(record) for record in records])
+        before = await dump(db)
+
+        exported = b"".join([chunk async for chunk in server.export_library(list(server.EXPORT_COLLECTIONS))])
+        await server.delete_document("doc-1")
+        assert all(not records for records in (await dump(db)).values())
+
+        result = await server.import_library(chunks(exported))
+        assert result["document_ids"] == ["doc-1"]
+        assert result["counts"]["document_pages"] == {"inserted": 2, "replaced": 0}
+        assert await dump(db) == before
+        # Extended JSON keeps binary data byte for byte
+        archive = await db.archived_documents.find_one({"document_id": "doc-1"})
+        assert bytes(archive["content"]) == b"\x00compressed\xff"
+
+        # Importing again replaces every record instead of adding copies
+        result = await server.import_library(chunks(exported))
+        assert result["counts"]["document_pages"] == {"inserted": 0, "replaced": 2}
+        assert all(counts["inserted"] == 0 for counts in result["counts"].values())
+        assert await dump(db) == before
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("item", [
+    {"collection": "chat_messages", "record": {"id": "msg-1", "message": "No document"}},
+    {"collection": "quiz_attempts", "record": {"id": "attempt-1", "document_id": None}},
+    {"collection": "documents", "record": {"filename": "no-id.pdf"}},
+    {"collection": "search_postings", "record": {"document_id": "doc-1"}},
+])
+def test_import_rejects_records_without_their_document(db, item):
+    header = {"format": server.EXPORT_FORMAT, "version": server.EXPORT_VERSION}
+    data = gzip.compress(f"{json_util.dumps(header)}\n{json_util.dumps(item)}\n".encode())
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.import_library(chunks(data)))
+    assert error.value.status_code == 400
+    assert "Line 2" in error.value.detail
+
+
+def test_import_endpoint_clears_digest_status_and_cached_responses(db, monkeypatch):
+    monkeypatch.setattr(server, "IMPORT_BATCH_SIZE", 2)
+    reindexed = []
+
+    async def reindex_documents(document_ids):
+        reindexed.extend(document_ids)
+    monkeypatch.setattr(server, "reindex_documents", reindex_documents)
+    document_ids = [f"doc-{number}" for number in range(5)]
+
+    async def scenario():
+        await db.documents.insert_many([{"id": document_id, "filename": f"{document_id}.pdf"} for document_id in document_ids])
+        exported = b"".join([chunk async for chunk in server.export_library(["documents"])])
+        generations = {}
+        for document_id in document_ids:
+            await server.shared_state.set(f"digest-status:{document_id}", {"status": "ready"})
+            key = f"study-materials:{document_id}"
+            generations[key] = await server.response_cache.generation(key)
+            server.response_cache.set(key, generations[key], '"etag"', b"{}")
+
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/api/import", content=exported)
+        assert response.status_code == 200 and response.json()["documents"] == 5
+        assert reindexed == document_ids
+        assert await db.shared_state.count_documents({"_id": {"$regex": "^digest-status:"}}) == 0
+        for key, generation in generations.items():
+            assert await server.response_cache.generation(key) == generation + 1
+            assert (await server.response_cache.get(key))[1] is None
+    asyncio.run(scenario())
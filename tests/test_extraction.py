@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import server
+
+
+class FlakyEngine(server.PdfExtractionEngine):
+    """Five pages; page 2 hangs, page 3 raises and page 4 kills the process"""
+    name = "flaky-stub"
+
+    def __init__(self, pdf_file: bytes):
+        self.page_count = 5
+        self.in_child = multiprocessing.parent_process() is not None
+
+    def page_text(self, number: int) -> str:
+        if number == 2 and self.in_child:
+            time.sleep(60)
+        if number == 3:
+            raise ValueError("broken content stream")
+        if number == 4 and self.in_child:
+            os._exit(1)
+        return f"Text of page {number}"
+
+
+@pytest.fixture
+def flaky_engine(monkeypatch):
+    monkeypatch.setitem(server.EXTRACTION_ENGINES, FlakyEngine.name, FlakyEngine)
+
+
+def test_inline_extraction_skips_pages_that_fail(flaky_engine):
+    extracted = server.run_extraction(b"%PDF", lambda page_count, outline: [1, 3, 5], engine=FlakyEngine.name, isolation="inline")
+    assert extracted == {"page_count": 5, "pages": {1: "Text of page 1", 5: "Text of page 5"}, "skipped": [3]}
+
+
+@pytest.fixture
+def forked_workers(flaky_engine, monkeypatch):
+    # Forked children inherit the stub engine; forkserver and spawn children would not know it
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("needs the fork start method")
+    server.stop_extraction_workers()
+    monkeypatch.setattr(server, "_extraction_context", multiprocessing.get_context("fork"))
+    yield
+    server.stop_extraction_workers()
+
+
+def test_process_extraction_skips_hanging_failing_and_crashing_pages(forked_workers):
+    chosen = []
+
+    def choose_pages(page_count, outline):
+        chosen.append(page_count)
+        return list(range(1, page_count + 1))
+
+    started = time.perf_counter()
+    extracted = server.run_extraction(b"%PDF", choose_pages, engine=FlakyEngine.name, isolation="process", timeout=0.5)
+    assert time.perf_counter() - started < 10
+    assert chosen == [5]
+    assert extracted["page_count"] == 5
+    assert extracted["pages"] == {1: "Text of page 1", 5: "Text of page 5"}
+    assert sorted(extracted["skipped"]) == [2, 3, 4]
+
+    # The worker that finished the request is kept for the next upload; the hung and crashed ones are gone
+    assert len(server._idle_extraction_workers) == 1
+    worker = server._idle_extraction_workers[0]
+    extracted = server.run_extraction(b"%PDF", lambda page_count, outline: [5], engine=FlakyEngine.name, isolation="process", timeout=0.5)
+    assert extracted["pages"] == {5: "Text of page 5"}
+    assert server._idle_extraction_workers == [worker]
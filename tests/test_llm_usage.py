@@ -0,0 +1,129 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+class DownDatabase:
+    def __getitem__(self, name):
+        return self
+
+    async def bulk_write(self, operations, ordered=True):
+        raise RuntimeError("database down")
+
+
+class HangingDatabase(DownDatabase):
+    async def bulk_write(self, operations, ordered=True):
+        await asyncio.sleep(10)
+
+
+def record_calls(document_id, calls):
+    async def scenario():
+        server.set_usage_scope("chat", document_id)
+        for latency in calls:
+            await server.record_llm_usage("document_chat", "ok", 100, 20, latency)
+        await server.record_llm_usage("document_chat", "fallback")
+    asyncio.run(scenario())
+
+
+def test_calls_are_rolled_up_in_process_and_written_in_one_upsert(db, monkeypatch):
+    buffer = server.RollupBuffer("llm_usage")
+    monkeypatch.setattr(server, "llm_usage_buffer", buffer)
+    document_id = str(uuid.uuid4())
+
+    record_calls(document_id, [0.5, 1.5, 1.0])
+    assert asyncio.run(db.llm_usage.count_documents({})) == 0
+    assert buffer.unwritten(f"llm-tokens:document:{document_id}") == 360
+
+    assert asyncio.run(buffer.flush()) == 1
+    rollup = asyncio.run(db.llm_usage.find_one({"document_id": document_id}))
+    assert rollup["calls"] == 3
+    assert rollup["prompt_tokens"] == 300 and rollup["completion_tokens"] == 60
+    assert rollup["latency_ms"] == 3000
+    assert rollup["max_latency_ms"] == 1500
+    assert rollup["outcomes"] == {"ok": 3, "fallback": 1}
+    assert rollup["day"] == rollup["minute"].strftime("%Y-%m-%d")
+    assert buffer.unwritten(f"llm-tokens:document:{document_id}") == 0
+    assert asyncio.run(server.shared_state.get(f"llm-tokens:document:{document_id}")) == 360
+
+    # Later flushes add to the stored rollup
+    record_calls(document_id, [2.0])
+    asyncio.run(buffer.flush())
+    rollup = asyncio.run(db.llm_usage.find_one({"document_id": document_id}))
+    assert rollup["calls"] == 4 and rollup["max_latency_ms"] == 2000
+    assert asyncio.run(server.shared_state.get(f"llm-tokens:document:{document_id}")) == 480
+
+
+def test_failed_flush_keeps_rollups_and_counters(db, monkeypatch):
+    buffer = server.RollupBuffer("llm_usage")
+    monkeypatch.setattr(server, "llm_usage_buffer", buffer)
+    document_id = str(uuid.uuid4())
+    record_calls(document_id, [0.5])
+
+    monkeypatch.setattr(server, "db", DownDatabase())
+    with pytest.raises(RuntimeError):
+        asyncio.run(buffer.flush())
+    assert buffer.unwritten(f"llm-tokens:document:{document_id}") == 120
+
+    # Calls made while the database was down are merged into the same rollup
+    record_calls(document_id, [2.5])
+    monkeypatch.setattr(server, "db", db)
+    assert asyncio.run(buffer.flush()) == 1
+    rollup = asyncio.run(db.llm_usage.find_one({"document_id": document_id}))
+    assert rollup["calls"] == 2 and rollup["max_latency_ms"] == 2500
+    assert rollup["outcomes"] == {"ok": 2, "fallback": 2}
+    assert asyncio.run(server.shared_state.get(f"llm-tokens:document:{document_id}")) == 240
+
+
+def test_cancelled_flush_keeps_rollups(db, monkeypatch):
+    buffer = server.RollupBuffer("llm_usage")
+    monkeypatch.setattr(server, "llm_usage_buffer", buffer)
+    document_id = str(uuid.uuid4())
+    record_calls(document_id, [0.5])
+
+    async def cancel_flush():
+        task = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    monkeypatch.setattr(server, "db", HangingDatabase())
+    asyncio.run(cancel_flush())
+    assert len(buffer.pending) == 1
+    assert buffer.unwritten(f"llm-tokens:document:{document_id}") == 120
+
+    monkeypatch.setattr(server, "db", db)
+    asyncio.run(buffer.close())
+    rollup = asyncio.run(db.llm_usage.find_one({"document_id": document_id}))
+    assert rollup["calls"] == 1 and rollup["outcomes"] == {"ok": 1, "fallback": 1}
+
+
+def test_budget_counts_tokens_not_yet_written(db, monkeypatch):
+    buffer = server.RollupBuffer("llm_usage")
+    monkeypatch.setattr(server, "llm_usage_buffer", buffer)
+    monkeypatch.setattr(server, "LLM_DOCUMENT_TOKEN_BUDGET", 300)
+    document_id = str(uuid.uuid4())
+    record_calls(document_id, [0.1, 0.1])
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.check_token_budget("document_chat", 100, document_id))
+    assert error.value.status_code == 429
+    assert "240 of 300" in error.value.detail
+
+    # Deleting the document drops its unwritten tokens along with the stored counter
+    buffer.discard_counter(f"llm-tokens:document:{document_id}")
+    asyncio.run(server.check_token_budget("document_chat", 100, document_id))
+
+
+def test_ttl_index_is_dropped_when_retention_is_disabled(db):
+    async def scenario():
+        await server.ensure_ttl_index("llm_usage", "minute", "minute_1", 90)
+        indexes = await db.llm_usage.index_information()
+        assert indexes["minute_1"]["expireAfterSeconds"] == 90 * 86400
+
+        await server.ensure_ttl_index("llm_usage", "minute", "minute_1", 0)
+        assert "minute_1" not in await db.llm_usage.index_information()
+    asyncio.run(scenario())
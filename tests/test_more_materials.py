@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+
+import server
+
+CONTENT = "Photosynthesis turns light into chemical energy. " * 200
+
+
+@pytest.fixture
+def materials(db, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+
+    async def seed():
+        await db.documents.insert_one({"id": "doc", "content": CONTENT})
+        await db.study_materials.insert_one({
+            "document_id": "doc", "mcqs": [], "flashcards": [], "chunk_count": 3, "coverage": {"mcqs": [0]}
+        })
+    asyncio.run(seed())
+    return db
+
+
+def stored(db):
+    return asyncio.run(db.study_materials.find_one({"document_id": "doc"}))
+
+
+@pytest.mark.parametrize("reply", [RuntimeError("provider unavailable"), "not json", "[{\"question\": \"missing fields\"}]"])
+def test_failed_generation_releases_the_chunk_and_stores_nothing(materials, monkeypatch, reply):
+    async def llm_complete(api_key, purpose, system_message, prompt):
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+    monkeypatch.setattr(server, "llm_complete", llm_complete)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.add_study_materials("doc", "mcqs", 2, BackgroundTasks()))
+    assert error.value.status_code == 502
+    record = stored(materials)
+    assert record["coverage"]["mcqs"] == [0]
+    assert record["mcqs"] == []
+
+
+def test_generation_claims_the_next_chunk(materials, monkeypatch):
+    async def llm_complete(api_key, purpose, system_message, prompt):
+        return json.dumps([{"question": "Q?", "options": ["a", "b", "c", "d"], "correct_answer": 1, "explanation": "E"}])
+    monkeypatch.setattr(server, "llm_complete", llm_complete)
+
+    result = asyncio.run(server.add_study_materials("doc", "mcqs", 1, BackgroundTasks()))
+    assert (result["chunk"], result["remaining_chunks"]) == (1, 1)
+    record = stored(materials)
+    assert sorted(record["coverage"]["mcqs"]) == [0, 1]
+    assert [mcq["question"] for mcq in record["mcqs"]] == ["Q?"]
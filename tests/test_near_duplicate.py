@@ -0,0 +1,74 @@
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+import server
+from benchmarks.make_corpus import page_lines
+
+PAGE_COUNT = 20
+
+
+def deck(seed: str) -> dict:
+    rng = random.Random(seed)
+    return {number: " ".join(page_lines(rng, number)) for number in range(1, PAGE_COUNT + 1)}
+
+
+def similarity(first: dict, second: dict) -> float:
+    signatures = [np.array(server.minhash_signature("\n".join(pages.values())), dtype=np.uint64) for pages in (first, second)]
+    return float(np.mean(signatures[0] == signatures[1]))
+
+
+@pytest.fixture
+def original(db):
+    pages = deck("lecture")
+
+    async def seed():
+        signature = server.minhash_signature("\n".join(pages.values()))
+        await db.documents.insert_one({
+            "id": "original", "filename": "lecture.pdf", "minhash": signature, "lsh_bands": server.lsh_bands(signature)
+        })
+        await db.document_pages.insert_many([
+            {"document_id": "original", "page": number, "text": text} for number, text in pages.items()
+        ])
+        await db.study_materials.insert_one({"document_id": "original", "pages": None, "mcqs": [], "flashcards": []})
+    asyncio.run(seed())
+    return pages
+
+
+def revise(pages: dict, number: int) -> dict:
+    return {**pages, number: deck("new slide")[number]}
+
+
+def test_one_slide_revision_is_a_near_duplicate(original):
+    revision = revise(original, 7)
+    assert similarity(original, revision) >= server.NEAR_DUPLICATE_THRESHOLD
+
+    match = asyncio.run(server.find_near_duplicate(server.minhash_signature("\n".join(revision.values()))))
+    assert match["id"] == "original" and match["filename"] == "lecture.pdf"
+    assert match["similarity"] >= server.NEAR_DUPLICATE_THRESHOLD
+
+
+def test_unrelated_document_is_not_a_near_duplicate(original):
+    unrelated = deck("another course")
+    assert similarity(original, unrelated) < 0.3
+    assert asyncio.run(server.find_near_duplicate(server.minhash_signature("\n".join(unrelated.values())))) is None
+
+
+def test_near_duplicate_needs_whole_document_materials(original, db):
+    asyncio.run(db.study_materials.update_one({"document_id": "original"}, {"$set": {"pages": [1, 2]}}))
+    assert asyncio.run(server.find_near_duplicate(server.minhash_signature("\n".join(original.values())))) is None
+
+
+def test_minhash_signature_is_deterministic():
+    text = "\n".join(deck("lecture").values())
+    assert server.minhash_signature(text) == server.minhash_signature(text)
+    assert len(server.minhash_signature(text)) == server.MINHASH_PERMUTATIONS
+    assert server.minhash_signature("a an the") is None
+
+
+def test_changed_pages_are_detected(original):
+    revision = revise(revise(original, 7), 12)
+    assert asyncio.run(server.find_changed_pages("original", revision)) == [7, 12]
+    assert asyncio.run(server.find_changed_pages("original", original)) == []
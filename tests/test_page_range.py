@@ -0,0 +1,131 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.mark.parametrize("spec, expected", [
+    ("3", [3]),
+    ("1-5,8", [1, 2, 3, 4, 5, 8]),
+    (" 2 - 4 , 3,, 10", [2, 3, 4, 10]),
+])
+def test_parse_page_range(spec, expected):
+    assert server.parse_page_range(spec) == expected
+
+
+@pytest.mark.parametrize("spec", ["", ",", "0", "5-3", "a-b", "1-"])
+def test_parse_page_range_rejects_invalid_specs(spec):
+    with pytest.raises(HTTPException) as error:
+        server.parse_page_range(spec)
+    assert error.value.status_code == 400
+
+
+def test_parse_page_range_checks_document_length():
+    assert server.parse_page_range("9-10", page_count=10) == [9, 10]
+    with pytest.raises(HTTPException):
+        server.parse_page_range("9-11", page_count=10)
+
+
+DOCUMENT = {
+    "page_count": 10,
+    "extracted_pages": [1, 2, 3, 4, 5, 6, 7, 8, 10],
+    "sections": [
+        {"title": "Chapter 1: Cells", "start_page": 1, "end_page": 4},
+        {"title": "Chapter 2: Genetics", "start_page": 5, "end_page": 10},
+    ],
+}
+
+
+def test_resolve_page_scope():
+    assert server.resolve_page_scope(DOCUMENT, None, None) is None
+    assert server.resolve_page_scope(DOCUMENT, "2-3", None) == [2, 3]
+    # Pages win over a section
+    assert server.resolve_page_scope(DOCUMENT, "1", "2") == [1]
+    assert server.resolve_page_scope(DOCUMENT, None, "1") == [1, 2, 3, 4]
+    assert server.resolve_page_scope(DOCUMENT, None, "chapter 1: cells") == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("document, pages, section, status", [
+    (DOCUMENT, "8-10", None, 400),  # page 9 was skipped during extraction
+    (DOCUMENT, None, "Chapter 2", 400),
+    (DOCUMENT, None, "Ecology", 404),
+    (dict(DOCUMENT, sections=[]), None, "1", 400),
+    ({"extracted_pages": []}, "1", None, 400),
+])
+def test_resolve_page_scope_rejects_unusable_scopes(document, pages, section, status):
+    with pytest.raises(HTTPException) as error:
+        server.resolve_page_scope(document, pages, section)
+    assert error.value.status_code == status
+
+
+def test_heading_sections():
+    pages = {
+        1: "Preface\nAbout this book",
+        2: "CHAPTER 1 Introduction\nText",
+        3: "More text\nthat mentions chapter 2 in passing",
+        4: "\n  Unit IV - Plants  \nText",
+        5: "Text",
+    }
+    sections = server.heading_sections(pages, 6)
+    assert [(s.title, s.start_page, s.end_page) for s in sections] == [
+        ("CHAPTER 1 Introduction", 2, 3),
+        ("Unit IV - Plants", 4, 6),
+    ]
+
+
+def test_sections_from_starts_drops_empty_and_repeated_starts():
+    sections = server.sections_from_starts([(5, "B"), (1, "A"), (5, "B again"), (9, "C")], 9)
+    assert [(s.title, s.start_page, s.end_page) for s in sections] == [
+        ("A", 1, 4),
+        ("B again", 5, 8),
+        ("C", 9, 9),
+    ]
+
+
+class OutlineEngine(server.PdfExtractionEngine):
+    name = "outline-stub"
+    starts = [(1, "Introduction"), (3, "Methods")]
+
+    def __init__(self, pdf_file: bytes):
+        self.page_count = 4
+
+    def outline(self):
+        return self.starts
+
+    def page_text(self, number: int) -> str:
+        return f"Text of page {number}"
+
+
+class HeadingEngine(OutlineEngine):
+    name = "heading-stub"
+    starts = []
+
+    def page_text(self, number: int) -> str:
+        return "Chapter 2 Results\nText" if number == 3 else f"Text of page {number}"
+
+
+@pytest.fixture
+def stub_engines(monkeypatch):
+    monkeypatch.setitem(server.EXTRACTION_ENGINES, OutlineEngine.name, OutlineEngine)
+    monkeypatch.setitem(server.EXTRACTION_ENGINES, HeadingEngine.name, HeadingEngine)
+    monkeypatch.setattr(server, "PDF_EXTRACTION_ISOLATION", "inline")
+
+
+def test_outline_sections_scope_extraction(stub_engines, monkeypatch):
+    monkeypatch.setattr(server, "PDF_EXTRACTION_ENGINE", OutlineEngine.name)
+    extracted = server.extract_pages_from_pdf(b"%PDF", section="methods")
+    assert [(s.title, s.start_page, s.end_page) for s in extracted["sections"]] == [
+        ("Introduction", 1, 2),
+        ("Methods", 3, 4),
+    ]
+    assert extracted["scope"] == [3, 4]
+    # Only the section's pages are extracted when the outline gives the boundaries
+    assert sorted(extracted["pages"]) == [3, 4]
+
+
+def test_heading_sections_are_found_without_an_outline(stub_engines, monkeypatch):
+    monkeypatch.setattr(server, "PDF_EXTRACTION_ENGINE", HeadingEngine.name)
+    extracted = server.extract_pages_from_pdf(b"%PDF", section="results")
+    assert [(s.title, s.start_page, s.end_page) for s in extracted["sections"]] == [("Chapter 2 Results", 3, 4)]
+    assert extracted["scope"] == [3, 4]
+    assert sorted(extracted["pages"]) == [1, 2, 3, 4]
@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import server
+
+# Correct (1) or not per attempt for questions q1..q4; q5 is never answered
+CORRECT = [
+    (1, 1, 0, 1),
+    (1, 1, 0, 1),
+    (1, 1, 1, 0),
+    (1, 0, 1, 0),
+    (1, 0, 0, 0),
+    (1, 0, 1, 0),
+]
+# Options picked on the wrong answers, per question, in attempt order
+WRONG_PICKS = {"q2": [0, 2, 3], "q3": [1, 2, 3], "q4": [0, 1, 2, 0]}
+KEYS = {"q1": 0, "q2": 1, "q3": 0, "q4": 3, "q5": 2}
+MCQS = [
+    {"id": question_id, "question": f"Question {question_id}?", "options": ["A", "B", "C", "D"],
+     "correct_answer": key, "explanation": ""}
+    for question_id, key in KEYS.items()
+]
+
+
+def attempts():
+    wrong = {question_id: iter(picks) for question_id, picks in WRONG_PICKS.items()}
+    for row in CORRECT:
+        yield [
+            {"question_id": question_id, "selected": KEYS[question_id] if correct else next(wrong[question_id])}
+            for question_id, correct in zip(KEYS, row)
+        ]
+
+
+def columns():
+    columns = {"attempt": [], "question_id": [], "selected": [], "correct": []}
+    for number, answers in enumerate(attempts()):
+        for answer in answers:
+            columns["attempt"].append(number)
+            columns["question_id"].append(answer["question_id"])
+            columns["selected"].append(answer["selected"])
+            columns["correct"].append(answer["selected"] == KEYS[answer["question_id"]])
+    return columns
+
+
+@pytest.fixture
+def min_responses(monkeypatch):
+    monkeypatch.setattr(server, "QUIZ_MIN_RESPONSES", 6)
+
+
+def test_item_statistics(min_responses):
+    analytics = server.quiz_item_statistics(columns(), MCQS)
+    assert analytics["attempts"] == 6
+    assert analytics["mean_score"] == pytest.approx(14 / 6, abs=1e-4)
+
+    questions = {question["question_id"]: question for question in analytics["questions"]}
+    expected = {
+        # difficulty, point-biserial against the rest of the attempt, flags
+        "q1": (1.0, None, ["too_easy", "unused_distractor"]),
+        "q2": (0.5, 0.4472, []),
+        "q3": (0.5, -0.5571, ["possible_miskey"]),
+        "q4": (0.3333, 0.0, ["low_discrimination"]),
+    }
+    for question_id, (difficulty, discrimination, flags) in expected.items():
+        question = questions[question_id]
+        assert question["responses"] == 6
+        assert question["difficulty"] == difficulty
+        assert question["discrimination"] == discrimination
+        assert question["flags"] == flags
+    assert [option["count"] for option in questions["q1"]["options"]] == [6, 0, 0, 0]
+    assert [option["count"] for option in questions["q4"]["options"]] == [2, 1, 1, 2]
+    assert questions["q4"]["options"][3]["correct"] and questions["q4"]["options"][3]["frequency"] == 0.3333
+    assert questions["q5"] == {"question_id": "q5", "question": "Question q5?", "responses": 0,
+                               "difficulty": None, "discrimination": None, "options": [], "flags": []}
+
+
+def test_items_are_not_flagged_below_the_minimum_responses(monkeypatch):
+    monkeypatch.setattr(server, "QUIZ_MIN_RESPONSES", 7)
+    analytics = server.quiz_item_statistics(columns(), MCQS)
+    assert all(question["flags"] == [] for question in analytics["questions"])
+
+
+def test_no_attempts():
+    analytics = server.quiz_item_statistics({"attempt": [], "question_id": [], "selected": [], "correct": []}, MCQS)
+    assert analytics["attempts"] == 0 and analytics["mean_score"] is None
+    assert all(question["responses"] == 0 for question in analytics["questions"])
+
+
+def test_attempts_and_analytics_endpoints(db, min_responses, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+
+    async def llm_complete(api_key, purpose, system_message, prompt):
+        return json.dumps([{"question": "Which gas do plants release?", "options": ["Oxygen", "Argon", "Neon", "Helium"],
+                            "correct_answer": 0, "explanation": "Photosynthesis releases oxygen."}])
+    monkeypatch.setattr(server, "llm_complete", llm_complete)
+
+    async def scenario():
+        await db.documents.insert_one({"id": "doc", "filename": "quiz.pdf", "content": "Plants release oxygen. " * 300})
+        await db.study_materials.insert_one({"document_id": "doc", "mcqs": MCQS, "flashcards": [], "chunk_count": 2})
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            for answers in attempts():
+                response = await client.post("/api/quiz/doc/attempts", json={"answers": answers})
+                assert response.status_code == 200
+            last = response.json()
+            assert (last["score"], last["total"]) == (2, 4)
+            assert last["results"][0] == {"question_id": "q1", "selected": 0, "correct": True, "correct_answer": 0}
+
+            bad = await client.post("/api/quiz/doc/attempts", json={"answers": [{"question_id": "q1", "selected": 4}]})
+            assert bad.status_code == 400
+            twice = [{"question_id": "q1", "selected": 0}, {"question_id": "q1", "selected": 1}]
+            assert (await client.post("/api/quiz/doc/attempts", json={"answers": twice})).status_code == 400
+
+            await server.quiz_attempts_buffer.flush()
+            analytics = (await client.get("/api/quiz/doc/analytics")).json()
+            assert analytics["attempts"] == 6
+            assert {question["question_id"]: question["flags"] for question in analytics["questions"]}["q3"] == ["possible_miskey"]
+
+            # MCQs added by /more show up in the analytics right away
+            more = await client.post("/api/study-materials/doc/more", json={"kind": "mcqs", "count": 1})
+            assert more.status_code == 200, more.text
+            analytics = (await client.get("/api/quiz/doc/analytics")).json()
+            assert len(analytics["questions"]) == len(MCQS) + 1
+            assert analytics["questions"][-1]["responses"] == 0
+    asyncio.run(scenario())
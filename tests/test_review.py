@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+NEW_CARD = {"easiness": 2.5, "interval": 0, "repetitions": 0}
+
+
+def review_sequence(grades):
+    state = dict(NEW_CARD)
+    for grade in grades:
+        state.update(server.sm2_schedule(state, grade, NOW))
+    return state
+
+
+def test_sm2_intervals_grow_with_correct_answers():
+    assert [review_sequence([5] * n)["interval"] for n in (1, 2, 3)] == [1, 6, 17]
+
+
+def test_sm2_failure_resets_repetitions_and_lowers_easiness():
+    state = review_sequence([5, 5, 5, 2])
+    assert state["repetitions"] == 0
+    assert state["interval"] == 1
+    assert state["easiness"] < review_sequence([5, 5, 5])["easiness"]
+    assert state["due_at"] == NOW + timedelta(days=1)
+
+
+def test_sm2_easiness_has_a_floor():
+    assert review_sequence([3] * 20)["easiness"] == 1.3
+
+
+def test_throttle_log_skips_within_interval_and_stays_bounded():
+    log = server.ThrottleLog(timedelta(hours=1), max_entries=3)
+    assert log.due("a", NOW)
+    assert not log.due("a", NOW + timedelta(minutes=59))
+    assert log.due("a", NOW + timedelta(hours=1))
+
+    for i in range(10):
+        log.due(i, NOW + timedelta(hours=1))
+    assert len(log) == 3
+
+    # Expired entries are dropped as new ones arrive
+    log.due("late", NOW + timedelta(hours=3))
+    assert len(log) == 1
@@ -0,0 +1,114 @@
+import asyncio
+from collections import Counter
+
+import server
+
+
+async def add_document(db, document_id, pages, mcqs=(), flashcards=()):
+    await db.documents.insert_one({"id": document_id, "filename": f"{document_id}.pdf"})
+    await db.document_pages.insert_many([
+        {"document_id": document_id, "page": number, "text": text} for number, text in pages.items()
+    ])
+    await server.index_for_search(server.search_units_for(document_id, pages, list(mcqs), list(flashcards)))
+
+
+def test_bm25_ranks_term_frequency_rarity_and_length(db):
+    async def scenario():
+        await add_document(db, "biology", {
+            1: "Mitochondria produce energy. Mitochondria are organelles with their own DNA.",
+            2: "Mitochondria are mentioned once in this much longer page about cells, membranes, "
+               "ribosomes, vacuoles, cytoplasm, nuclei, lysosomes and the endoplasmic reticulum.",
+            3: "Cells need energy to divide.",
+        })
+        await add_document(db, "physics", {1: "Kinetic energy and potential energy add up to mechanical energy."})
+
+        results = await server.search_index("mitochondria")
+        assert [(r["document_id"], r["page"]) for r in results] == [("biology", 1), ("biology", 2)]
+        assert results[0]["score"] > results[1]["score"] > 0
+
+        # "energy" is on three of the four pages; the rare "mitochondria" decides the ranking
+        results = await server.search_index("mitochondria energy")
+        assert (results[0]["document_id"], results[0]["page"]) == ("biology", 1)
+        assert {(r["document_id"], r["page"]) for r in results} == {("biology", 1), ("biology", 2), ("biology", 3), ("physics", 1)}
+
+        results = await server.search_index("energy", document_id="physics")
+        assert [(r["document_id"], r["filename"]) for r in results] == [("physics", "physics.pdf")]
+        assert await server.search_index("the of and") == []
+    asyncio.run(scenario())
+
+
+def test_items_are_searchable_by_kind(db):
+    async def scenario():
+        await add_document(
+            db, "biology", {1: "Chlorophyll absorbs light."},
+            mcqs=[{"id": "m1", "question": "Which pigment absorbs light?", "options": ["Chlorophyll", "Keratin", "Melanin", "Heme"]}],
+            flashcards=[{"id": "f1", "front": "Chlorophyll", "back": "Green pigment in chloroplasts"}],
+        )
+        results = await server.search_index("chlorophyll", kind="flashcard")
+        assert [(r["kind"], r["item_id"]) for r in results] == [("flashcard", "f1")]
+        assert "<mark>Chlorophyll</mark>" in results[0]["snippet"]
+    asyncio.run(scenario())
+
+
+def test_removing_a_document_keeps_frequencies_and_stats_consistent(db):
+    async def scenario():
+        await add_document(db, "a", {1: "alpha beta gamma", 2: "alpha delta"})
+        await add_document(db, "b", {1: "alpha epsilon epsilon", 2: "zeta"})
+        await server.remove_from_search_index("a")
+
+        postings = await db.search_postings.find({}).to_list(None)
+        assert {posting["document_id"] for posting in postings} == {"b"}
+        expected = Counter(posting["term"] for posting in postings)
+        frequencies = {term["_id"]: term["df"] for term in await db.search_terms.find({}).to_list(None)}
+        assert {term: df for term, df in frequencies.items() if df} == expected
+        assert all(df >= 0 for df in frequencies.values())
+
+        units = await db.search_units.find({}).to_list(None)
+        stats = await db.search_stats.find_one({"_id": "corpus"})
+        assert stats["units"] == len(units) == 2
+        assert stats["length"] == sum(unit["length"] for unit in units) == 4
+        assert [r["document_id"] for r in await server.search_index("alpha")] == ["b"]
+
+        # Removing it again changes nothing
+        await server.remove_from_search_index("a")
+        assert await db.search_stats.find_one({"_id": "corpus"}) == stats
+    asyncio.run(scenario())
+
+
+def test_units_without_searchable_terms_are_indexed(db):
+    async def scenario():
+        await add_document(db, "short", {1: "a b c"})
+        await add_document(db, "word", {1: "Osmosis"})
+        stats = await db.search_stats.find_one({"_id": "corpus"})
+        assert stats["units"] == 2
+        assert [r["document_id"] for r in await server.search_index("osmosis")] == ["word"]
+    asyncio.run(scenario())
+
+
+def test_archived_page_hits_have_snippets(db):
+    async def scenario():
+        await add_document(db, "old", {1: "Enzymes speed up reactions.", 2: "Nothing to see."})
+        assert await server.archive_document({"id": "old", "content": "Enzymes speed up reactions."})
+        assert await db.document_pages.count_documents({"document_id": "old"}) == 0
+
+        results = await server.search_index("enzymes")
+        assert [r["page"] for r in results] == [1]
+        assert results[0]["snippet"] == "<mark>Enzymes</mark> speed up reactions."
+    asyncio.run(scenario())
+
+
+def test_highlight_snippet_marks_terms_and_escapes_html():
+    text = "Use <b>bold</b> & mark Enzyme names; enzymes matter."
+    assert server.highlight_snippet(text, {"enzymes", "bold"}) == (
+        "Use &lt;b&gt;<mark>bold</mark>&lt;/b&gt; &amp; mark Enzyme names; <mark>enzymes</mark> matter."
+    )
+
+
+def test_highlight_snippet_starts_near_the_first_match():
+    text = "filler " * 100 + "the photosynthesis step " + "more " * 100
+    snippet = server.highlight_snippet(text, {"photosynthesis"})
+    assert snippet.startswith("...filler") and snippet.endswith("...")
+    assert "<mark>photosynthesis</mark>" in snippet
+    assert len(snippet) < server.SEARCH_SNIPPET_CHARS + 40
+    # Without a match the snippet is the start of the text
+    assert server.highlight_snippet("plain text", {"absent"}) == "plain text"
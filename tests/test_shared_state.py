@@ -0,0 +1,68 @@
+import asyncio
+import sqlite3
+
+import server
+
+
+class FailingTier(server.LocalStateTier):
+    def get(self, key):
+        raise sqlite3.OperationalError("database is locked")
+
+    def set(self, key, value):
+        raise sqlite3.OperationalError("database is locked")
+
+    def delete(self, key):
+        raise sqlite3.OperationalError("database is locked")
+
+
+class CountingState(server.SharedState):
+    reads = 0
+
+    async def get(self, key, default=None):
+        self.reads += 1
+        return await super().get(key, default)
+
+
+def test_cached_versions_skip_mongo_until_invalidated(db, monkeypatch):
+    state = CountingState()
+    monkeypatch.setattr(server, "shared_state", state)
+    cache = server.ResponseCache(version_ttl=60)
+
+    async def scenario():
+        generation, entry = await cache.get("documents")
+        assert entry is None
+        cache.set("documents", generation, '"etag"', b"[]")
+        for _ in range(5):
+            assert (await cache.get("documents"))[1] == ('"etag"', b"[]")
+        assert state.reads == 1
+
+        await cache.invalidate("documents")
+        assert (await cache.get("documents"))[1] is None
+        assert state.reads == 1
+
+    asyncio.run(scenario())
+
+
+def test_locked_local_tier_falls_back_to_mongo(db, tmp_path, monkeypatch):
+    state = server.SharedState(FailingTier(str(tmp_path / "state.db")))
+    monkeypatch.setattr(server, "shared_state", state)
+
+    async def scenario():
+        await state.set("key", {"a": 1})
+        assert await state.get("key") == {"a": 1}
+        assert await state.incr("counter") == 1
+        await state.delete("key")
+        assert await state.get("key", "gone") == "gone"
+
+    asyncio.run(scenario())
+
+
+def test_local_tier_serves_reads(db, tmp_path):
+    state = server.SharedState(server.LocalStateTier(str(tmp_path / "state.db"), ttl=60))
+
+    async def scenario():
+        await state.set("key", 5)
+        await db.shared_state.delete_many({})
+        assert await state.get("key") == 5
+
+    asyncio.run(scenario())
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = server.SingleFlight("test")
+    executions = 0
+
+    async def work():
+        nonlocal executions
+        executions += 1
+        await asyncio.sleep(0.01)
+        return {"value": 42}
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(10)))
+        assert all(result is results[0] for result in results)
+        # Finished keys are forgotten, so the next call executes again
+        await flight.do("key", work)
+
+    asyncio.run(scenario())
+    assert executions == 2
+    assert flight.stats() == {"in_flight": 0, "calls": 11, "executions": 2, "coalesced": 9, "cancelled": 0, "errors": 0}
+
+
+def test_errors_reach_every_waiter():
+    flight = server.SingleFlight("test")
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def scenario():
+        results = await asyncio.gather(*(flight.do("key", failing) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(scenario())
+    assert flight.stats()["errors"] == 1
+    assert flight.stats()["executions"] == 1
+
+
+def test_caller_after_last_waiter_cancelled_starts_a_new_task():
+    flight = server.SingleFlight("test")
+    started = 0
+
+    async def work():
+        nonlocal started
+        started += 1
+        await asyncio.sleep(0.05)
+        return started
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # The cancelled task's done-callback has not run yet; this caller must not join it
+        assert await flight.do("key", work) == 2
+
+    asyncio.run(scenario())
+    assert flight.stats()["cancelled"] == 1
+
+
+def test_cancelling_one_of_several_waiters_keeps_the_task():
+    flight = server.SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do("key", work))
+        second = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "done"
+
+    asyncio.run(scenario())
+    assert flight.stats()["cancelled"] == 0
@@ -0,0 +1,202 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+
+from bson import ObjectId, json_util
+
+import server
+
+
+def unused_pid() -> int:
+    pid = 999999
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return pid
+        except PermissionError:
+            pass
+        pid -= 1
+
+
+def make_buffer(tmp_path, flushed=None):
+    async def on_flush(batch):
+        if flushed is not None:
+            flushed.extend(batch)
+    return server.BulkWriteBuffer("messages", max_size=100, interval=0.01, on_flush=on_flush, spill_dir=tmp_path)
+
+
+def test_failed_insert_spills_to_disk_and_replays(db, tmp_path):
+    flushed = []
+    buffer = make_buffer(tmp_path, flushed)
+
+    async def database_down(batch):
+        raise RuntimeError("database down")
+
+    async def scenario():
+        timestamp = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        for number in range(3):
+            await buffer.add({"id": str(number), "document_id": "doc", "timestamp": timestamp})
+
+        buffer._insert = database_down
+        assert await buffer.flush() == 0
+        spill_file = tmp_path / f"messages-{os.getpid()}.jsonl"
+        assert len(spill_file.read_text().splitlines()) == 3
+        assert not buffer.pending
+        # Spilled records still count as accepted
+        assert len(buffer.buffered(lambda record: record["document_id"] == "doc")) == 3
+
+        # Still down: the records go back to disk rather than being lost
+        assert await buffer.flush() == 0
+        try:
+            await buffer.replay_spilled()
+        except RuntimeError:
+            pass
+        assert len(spill_file.read_text().splitlines()) == 3
+
+        del buffer._insert  # the database is back
+        assert await buffer.replay_spilled() == 3
+        assert not list(tmp_path.iterdir())
+        assert buffer.buffered(lambda record: True) == []
+        stored = await db.messages.find({}, {"_id": 0}).sort("id", 1).to_list(None)
+        assert [record["id"] for record in stored] == ["0", "1", "2"]
+        assert stored[0]["timestamp"].replace(tzinfo=timezone.utc) == timestamp
+        assert len(flushed) == 3
+
+    asyncio.run(scenario())
+
+
+def test_spill_files_of_dead_processes_are_reclaimed(db, tmp_path):
+    buffer = make_buffer(tmp_path)
+    dead = tmp_path / f"messages-{unused_pid()}.jsonl"
+    dead.write_text(json_util.dumps({"id": "orphan", "document_id": "doc"}) + "\npartial{")
+    alive = tmp_path / f"messages-{os.getppid()}.jsonl"
+    alive.write_text(json_util.dumps({"id": "other-worker", "document_id": "doc"}) + "\n")
+
+    async def scenario():
+        # The truncated last line is skipped, the live worker's file left alone
+        assert await buffer.replay_spilled() == 1
+        assert await db.messages.count_documents({"id": "orphan"}) == 1
+        assert not dead.exists()
+        assert alive.exists()
+
+    asyncio.run(scenario())
+
+
+def test_replay_tolerates_records_already_written(db, tmp_path):
+    buffer = make_buffer(tmp_path)
+
+    async def scenario():
+        record = {"id": "once", "document_id": "doc"}
+        await db.messages.insert_one(record)
+        (tmp_path / f"messages-{os.getpid()}.jsonl").write_text(json_util.dumps(record) + "\n")
+        assert await buffer.replay_spilled() == 1
+        assert await db.messages.count_documents({}) == 1
+
+    asyncio.run(scenario())
+
+
+def test_run_flushes_in_the_background_until_stopped(db, tmp_path):
+    buffer = make_buffer(tmp_path)
+
+    async def scenario():
+        stopping = asyncio.Event()
+        task = asyncio.ensure_future(buffer.run(stopping))
+        await buffer.add({"id": "a", "document_id": "doc"})
+        await asyncio.sleep(0.05)
+        assert await db.messages.count_documents({}) == 1
+        stopping.set()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_flush_keeps_the_batch(db, tmp_path):
+    buffer = make_buffer(tmp_path)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow_insert(batch):
+            started.set()
+            await asyncio.sleep(10)
+        buffer._insert = slow_insert
+        for number in range(3):
+            await buffer.add({"id": str(number), "document_id": "doc"})
+        task = asyncio.ensure_future(buffer.flush())
+        await started.wait()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert [record["id"] for record in buffer.pending] == ["0", "1", "2"]
+        assert buffer.writing == [] and not list(tmp_path.iterdir())
+
+        del buffer._insert
+        assert await buffer.flush() == 3
+        assert await db.messages.count_documents({}) == 3
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_replay_keeps_the_spill_file(db, tmp_path):
+    buffer = server.BulkWriteBuffer("messages", max_size=2, interval=0.01, spill_dir=tmp_path)
+    spill_file = tmp_path / f"messages-{unused_pid()}.jsonl"
+    records = [{"_id": ObjectId(), "id": str(number), "document_id": "doc"} for number in range(6)]
+    spill_file.write_text("".join(json_util.dumps(record) + "\n" for record in records))
+
+    async def scenario():
+        started = asyncio.Event()
+        real_insert = buffer._insert
+
+        async def insert_then_hang(batch):
+            if started.is_set():
+                await asyncio.sleep(10)
+            started.set()
+            await real_insert(batch)
+        buffer._insert = insert_then_hang
+        task = asyncio.ensure_future(buffer.replay_spilled())
+        await started.wait()
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert await db.messages.count_documents({}) == 2
+        # The whole file is still there, under its original name
+        assert [path.name for path in tmp_path.iterdir()] == [spill_file.name]
+        assert len(spill_file.read_text().splitlines()) == 6
+
+        del buffer._insert
+        assert await buffer.replay_spilled() == 6
+        assert await db.messages.count_documents({}) == 6
+        assert not list(tmp_path.iterdir())
+
+    asyncio.run(scenario())
+
+
+def test_records_of_deleted_documents_are_not_written_back(db, tmp_path, monkeypatch):
+    buffer = server.chat_messages_buffer
+    monkeypatch.setattr(buffer, "spill_dir", tmp_path)
+
+    async def database_down(batch):
+        raise RuntimeError("database down")
+
+    async def scenario():
+        await db.documents.insert_many([{"id": "deleted"}, {"id": "kept"}])
+        for document_id in ("deleted", "kept"):
+            await buffer.add({"id": f"message-{document_id}", "document_id": document_id, "message": "hi"})
+        buffer._insert = database_down
+        await buffer.flush()
+        assert len(buffer.spilled) == 2
+        del buffer._insert
+
+        await server.delete_document("deleted")
+        assert [record["document_id"] for record in buffer.buffered(lambda record: True)] == ["kept"]
+        assert await buffer.replay_spilled() == 2
+        stored = await db.chat_messages.find({}, {"_id": 0, "document_id": 1}).to_list(None)
+        assert stored == [{"document_id": "kept"}]
+
+    asyncio.run(scenario())